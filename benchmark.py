@@ -0,0 +1,787 @@
+#!/usr/bin/env python3
+"""
+Grok Chat 性能基准测试
+
+用法:
+    # 对比 threading 与 eventlet 模式下可同时处理的会话数量
+    python benchmark.py capacity --concurrency 100,500,1000 --latency 1.0
+
+    # 会话日志重启恢复时间（目标：10万条消息 < 1秒）
+    python benchmark.py recovery --messages 100000
+
+    # 会话淘汰：旧的排序式清理 vs LRU（1万 / 10万个会话）
+    python benchmark.py eviction --conversations 10000,100000
+
+    # 单个会话的消息历史：列表重建 vs 环形缓冲区（达到上限后的追加与读取）
+    python benchmark.py history --max-messages 30
+
+    # 端到端负载测试：本地模拟 xAI 服务器 + 真实 chat.py 服务进程 + 并发 Socket.IO 客户端
+    python benchmark.py load --clients 50 --messages 20 --latency 0.5 --token-delay 0.01 --record load.jsonl
+
+    # 每条消息的日志开销：旧的同步 DEBUG + f-string vs 异步队列、JSON、采样
+    # （--write-delay-us 模拟 stdout 管道被日志收集器阻塞时每次写入的等待）
+    python benchmark.py logging --messages 5000 --write-delay-us 100
+
+    # 会话历史压缩：5万个会话的常驻内存，以及读取最新页 / 最旧页 / 构建上下文的耗时
+    python benchmark.py compression --conversations 50000 --hot-messages 0,4,8
+
+capacity 与 compression 测试的每个级别在独立子进程中运行（eventlet 需要在导入前 monkey patch，
+内存测量需要干净的进程），
+上游 API 由本地模拟服务器（mock_xai_server.py）代替，不会访问真实的 xAI API。
+load 测试的结果可用 --record 追加到 JSONL 文件，便于跨版本对比性能回归。
+"""
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+
+RESULT_PREFIX = 'BENCH_RESULT '
+
+
+# ===== Mock upstream =====
+def start_mock_upstream(latency=1.0, port=0, **options):
+    """Start a local stand-in for API_URL in this process (see mock_xai_server.py)
+
+    Returns:
+        Tuple of (server, api_url)
+    """
+    from mock_xai_server import MockXAIServer
+    options.setdefault('tokens', 2)
+    server = MockXAIServer(port=port, latency=latency, **options).start()
+    return server, server.api_url
+
+
+def free_port():
+    """A TCP port that is free on localhost right now"""
+    import socket
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers (0 when empty)"""
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+def peak_rss_mb():
+    """Peak resident memory of the current process in MB"""
+    import resource
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KB on Linux and bytes on macOS
+    return usage / (1024 * 1024) if sys.platform == 'darwin' else usage / 1024
+
+
+# ===== Capacity benchmark =====
+def run_capacity_worker(concurrency, timeout):
+    """Run N concurrent send_message calls in this process and print the result
+
+    Must run in a fresh process: importing chat applies the async mode
+    (and eventlet monkey patching) selected by SOCKETIO_ASYNC_MODE.
+    """
+    import logging
+    import chat
+    logging.disable(logging.CRITICAL)
+
+    results = []
+    messages = [{'role': 'user', 'content': 'benchmark'}]
+
+    def conversation():
+        started = time.time()
+        response = chat.send_message(messages, api_key='bench-key')
+        results.append(('error' not in response, time.time() - started))
+
+    started = time.time()
+    for _ in range(concurrency):
+        chat.socketio.start_background_task(conversation)
+    while len(results) < concurrency and time.time() - started < timeout:
+        chat.socketio.sleep(0.05)
+    wall = time.time() - started
+
+    ok_latencies = [latency for ok, latency in results if ok]
+    print(RESULT_PREFIX + json.dumps({
+        'mode': chat.socketio.async_mode,
+        'concurrency': concurrency,
+        'completed': len(ok_latencies),
+        'failed': len(results) - len(ok_latencies),
+        'wall_time': round(wall, 3),
+        'throughput': round(len(ok_latencies) / wall, 1) if wall > 0 else 0,
+        # Average number of conversations that were in flight at the same time
+        'effective_concurrency': round(sum(ok_latencies) / wall, 1) if wall > 0 else 0,
+        'peak_rss_mb': round(peak_rss_mb(), 1)
+    }), flush=True)
+
+
+def run_capacity(args):
+    """Compare concurrent-conversation capacity across async modes"""
+    import subprocess
+
+    server, api_url = start_mock_upstream(latency=args.latency)
+    levels = [int(level) for level in args.concurrency.split(',')]
+    rows = []
+    for mode in args.modes.split(','):
+        for level in levels:
+            env = dict(
+                os.environ,
+                SOCKETIO_ASYNC_MODE=mode,
+                API_URL=api_url,
+                UPSTREAM_POOL_MAXSIZE=str(level)
+            )
+            proc = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), 'capacity-worker',
+                 '--level', str(level), '--timeout', str(args.timeout)],
+                env=env, capture_output=True, text=True
+            )
+            lines = [line for line in proc.stdout.splitlines() if line.startswith(RESULT_PREFIX)]
+            if not lines:
+                print(f"❌ {mode} @ {level}: worker failed\n{proc.stderr[-2000:]}")
+                continue
+            rows.append(json.loads(lines[-1][len(RESULT_PREFIX):]))
+            row = rows[-1]
+            print(f"{row['mode']:>10} | {row['concurrency']:>6} in flight | "
+                  f"{row['completed']:>6} ok {row['failed']:>5} failed | "
+                  f"wall {row['wall_time']:>7}s | {row['throughput']:>8} req/s | "
+                  f"effective concurrency {row['effective_concurrency']:>7} | "
+                  f"peak RSS {row['peak_rss_mb']:>7} MB", flush=True)
+    server.shutdown()
+    if args.json:
+        print(json.dumps(rows, indent=2))
+
+
+# ===== Restart recovery benchmark =====
+def run_recovery(args):
+    """Measure restart-to-ready time of the conversation log"""
+    import logging
+    import shutil
+    import tempfile
+    import chat
+    logging.disable(logging.CRITICAL)
+
+    directory = tempfile.mkdtemp(prefix='grok-conversation-log-')
+    per_conversation = args.messages_per_conversation
+    conversations = -(-args.messages // per_conversation)
+
+    def create_manager():
+        return chat.SessionManager(
+            max_conversations=conversations,
+            max_messages_per_conversation=per_conversation,
+            store=chat.MemoryConversationStore(),
+            # Snapshots are taken explicitly below
+            log=chat.ConversationLog(directory, snapshot_every=float('inf'))
+        )
+
+    try:
+        manager = create_manager()
+        manager.recover()
+        content = 'x' * args.content_size
+        snapshot_at = int(args.messages * (1 - args.tail_fraction))
+        started = time.perf_counter()
+        for i in range(args.messages):
+            manager.add_message_to_conversation(f"conv-{i % conversations}", {
+                'role': 'user' if i % 2 == 0 else 'assistant',
+                'content': f"{i} {content}"
+            })
+            if i + 1 == snapshot_at:
+                manager.snapshot()
+        write_time = time.perf_counter() - started
+        manager.log.close()
+
+        sizes = {name: os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)}
+
+        # Simulated restart: a fresh manager rebuilds everything from disk
+        started = time.perf_counter()
+        restarted = create_manager()
+        stats = restarted.recover()
+        recovery_time = time.perf_counter() - started
+        restarted.log.close()
+
+        recovered_messages = sum(
+            len(restarted.get_conversation_messages(conv['id'])) for conv in restarted.list_conversations()
+        )
+        print(f"messages written      : {args.messages} in {conversations} conversations ({write_time:.2f}s, "
+              f"{args.messages / write_time:.0f} msg/s with WAL)")
+        print("on-disk files         : " + ', '.join(f"{name}={size / 1024 / 1024:.1f}MB" for name, size in sorted(sizes.items())))
+        print(f"snapshot conversations: {stats['restored_conversations']}, WAL tail events: {stats['replayed_events']}")
+        print(f"recovered messages    : {recovered_messages}")
+        print(f"restart-to-ready      : {recovery_time:.3f}s "
+              f"({'PASS' if recovery_time < 1.0 and recovered_messages == args.messages else 'FAIL'}, target < 1s)")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+# ===== Eviction benchmark =====
+class SortedCleanupStore:
+    """The previous dict store: sort-based eviction and strptime-based expiry"""
+
+    def __init__(self):
+        self.conversations = {}
+
+    def append_message(self, conversation_id, message, max_messages):
+        conv = self.conversations.setdefault(conversation_id, {'messages': [], 'timestamp': message['timestamp']})
+        conv['messages'].append(message)
+        conv['timestamp'] = message['timestamp']
+        return len(conv['messages']) == 1
+
+    def trim_conversations(self, max_conversations, max_bytes=None):
+        sorted_convs = sorted(self.conversations.items(), key=lambda x: x[1]['timestamp'])
+        removed = [cid for cid, _ in sorted_convs[:-max_conversations]]
+        self.conversations = dict(sorted_convs[-max_conversations:])
+        return removed
+
+    def delete_expired(self, max_age_seconds):
+        from datetime import datetime
+        now = datetime.now()
+        expired = [
+            cid for cid, conv in self.conversations.items()
+            if (now - datetime.strptime(conv['timestamp'], '%Y-%m-%d %H:%M:%S')).total_seconds() > max_age_seconds
+        ]
+        for cid in expired:
+            del self.conversations[cid]
+        return expired
+
+
+def run_eviction(args):
+    """Compare per-message eviction and hourly expiry cost of both stores"""
+    import logging
+    from datetime import datetime
+    import chat
+    logging.disable(logging.CRITICAL)
+
+    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    for size in [int(size) for size in args.conversations.split(',')]:
+        for name, store_class in (('sort-based', SortedCleanupStore), ('LRU', chat.MemoryConversationStore)):
+            store = store_class()
+            for i in range(size):
+                store.append_message(f"conv-{i}", {'role': 'user', 'content': 'x', 'timestamp': timestamp}, 30)
+
+            # Steady state at the limit: every new conversation evicts one
+            started = time.perf_counter()
+            for i in range(args.inserts):
+                store.append_message(f"new-{i}", {'role': 'user', 'content': 'x', 'timestamp': timestamp}, 30)
+                store.trim_conversations(size)
+            evict_us = (time.perf_counter() - started) / args.inserts * 1e6
+
+            # Hourly cleanup with nothing expired yet
+            started = time.perf_counter()
+            store.delete_expired(24 * 3600)
+            expire_ms = (time.perf_counter() - started) * 1000
+
+            print(f"{name:>10} | {size:>7} conversations | insert+evict {evict_us:>10.1f} us | "
+                  f"clear_old_data {expire_ms:>8.2f} ms", flush=True)
+
+
+# ===== Message history benchmark =====
+def run_history(args):
+    """Compare the previous list-rebuild history with the ring buffer at the message limit"""
+    import logging
+    import chat
+    logging.disable(logging.CRITICAL)
+
+    max_messages = args.max_messages
+    messages = [
+        {'role': 'user' if i % 2 == 0 else 'assistant', 'content': f"message {i} " + 'x' * 200,
+         'timestamp': '2025-01-01 00:00:00'}
+        for i in range(args.messages)
+    ]
+
+    # Previous implementation: dict messages, two comprehensions per trim, list copy per read
+    history = [{'role': 'system', 'content': 'pinned', 'timestamp': '2025-01-01 00:00:00'}]
+    started = time.perf_counter()
+    for message in messages:
+        if len(history) >= max_messages:
+            system_messages = [msg for msg in history if msg.get('role') == 'system']
+            other_messages = [msg for msg in history if msg.get('role') != 'system']
+            history = system_messages + other_messages[-max(1, max_messages - len(system_messages)):]
+        history.append(dict(message))
+        list(history)
+    list_us = (time.perf_counter() - started) / len(messages) * 1e6
+
+    ring = chat.MessageHistory(max_messages)
+    ring.append(chat.Message('system', 'pinned', '2025-01-01 00:00:00'), max_messages)
+    started = time.perf_counter()
+    for message in messages:
+        ring.append(chat.Message.from_dict(message), max_messages)
+        ring.view()
+    ring_us = (time.perf_counter() - started) / len(messages) * 1e6
+
+    print(f"list rebuild : {list_us:.2f} us per append+read")
+    print(f"ring buffer  : {ring_us:.2f} us per append+read ({list_us / ring_us:.1f}x)")
+
+
+# ===== History compression benchmark =====
+COMPRESSION_CORPUS_FILES = ('README.md', 'USAGE.md', 'FIXES.md', 'RENDER_DEPLOY.md')
+
+
+def run_compression_worker(args):
+    """Fill a memory store in this process and print its memory use and read costs
+
+    Must run in a fresh process so resident memory reflects one configuration.
+    Message content is cut from the repository's Markdown documents, a mix of
+    Chinese and English prose and code close to real chat replies.
+    """
+    import gc
+    import logging
+    import random
+    import chat
+    logging.disable(logging.CRITICAL)
+
+    base = os.path.dirname(os.path.abspath(__file__))
+    corpus = ''
+    for name in COMPRESSION_CORPUS_FILES:
+        try:
+            with open(os.path.join(base, name), encoding='utf-8') as f:
+                corpus += f.read() + '\n'
+        except OSError:
+            continue
+    corpus = corpus * (1 + (args.content_size * 4) // max(1, len(corpus)))
+    rng = random.Random(42)
+
+    gc.collect()
+    rss_before, _ = process_memory_mb(os.getpid())
+    store = chat.MemoryConversationStore(hot_messages=args.hot if args.hot >= 0 else None)
+    max_messages = args.messages_per_conversation
+    started = time.perf_counter()
+    for i in range(args.conversations):
+        for j in range(args.messages_per_conversation):
+            offset = rng.randrange(len(corpus) - args.content_size)
+            store.append_message(f"conv-{i}", {
+                'role': 'user' if j % 2 == 0 else 'assistant',
+                'content': corpus[offset:offset + args.content_size],
+                'timestamp': '2025-01-01 00:00:00'
+            }, max_messages)
+    fill_us = (time.perf_counter() - started) / (args.conversations * args.messages_per_conversation) * 1e6
+    gc.collect()
+    rss_after, _ = process_memory_mb(os.getpid())
+
+    samples = [f"conv-{rng.randrange(args.conversations)}" for _ in range(200)]
+
+    def timed_ms(func):
+        started = time.perf_counter()
+        for conversation_id in samples:
+            func(conversation_id)
+        return (time.perf_counter() - started) / len(samples) * 1000
+
+    def read_page(conversation_id, before):
+        return [msg.content for msg in store.get_message_page(conversation_id, before, 10)[0]]
+
+    builder = chat.ContextBuilder(default_budget=args.context_budget)
+    stats = store.get_stats()
+    print(RESULT_PREFIX + json.dumps({
+        'hot_messages': store.hot_messages,
+        'messages': args.conversations * args.messages_per_conversation,
+        'content_mb': round(stats['bytes'] / (1024 * 1024), 1),
+        'rss_mb': round(rss_after - rss_before, 1) if rss_after is not None else None,
+        'compressed_messages': stats['compressed_messages'],
+        'append_us': round(fill_us, 2),
+        'newest_page_ms': round(timed_ms(lambda cid: read_page(cid, None)), 4),
+        'oldest_page_ms': round(timed_ms(lambda cid: read_page(cid, 10)), 4),
+        'context_build_ms': round(timed_ms(
+            lambda cid: builder.build(store.get_messages(cid), {'role': 'user', 'content': 'next'}, 'grok-4-latest')
+        ), 4)
+    }), flush=True)
+
+
+def run_compression(args):
+    """Compare resident memory and read cost with and without history compression"""
+    import subprocess
+
+    print(f"{args.conversations} conversations x {args.messages_per_conversation} messages x "
+          f"{args.content_size} characters", flush=True)
+    for hot in ['off'] + args.hot_messages.split(','):
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), 'compression-worker',
+             '--conversations', str(args.conversations),
+             '--messages-per-conversation', str(args.messages_per_conversation),
+             '--content-size', str(args.content_size),
+             '--context-budget', str(args.context_budget),
+             '--hot', '-1' if hot == 'off' else hot],
+            capture_output=True, text=True
+        )
+        lines = [line for line in proc.stdout.splitlines() if line.startswith(RESULT_PREFIX)]
+        if not lines:
+            print(f"❌ hot={hot}: worker failed\n{proc.stderr[-2000:]}")
+            continue
+        row = json.loads(lines[-1][len(RESULT_PREFIX):])
+        label = 'uncompressed' if row['hot_messages'] is None else f"hot={row['hot_messages']}"
+        print(f"{label:>12} | content {row['content_mb']:>8} MB | RSS {row['rss_mb']:>8} MB | "
+              f"append {row['append_us']:>6} us | newest page {row['newest_page_ms']:>7} ms | "
+              f"oldest page {row['oldest_page_ms']:>7} ms | context {row['context_build_ms']:>7} ms", flush=True)
+
+
+# ===== End-to-end load test =====
+def process_memory_mb(pid):
+    """Current and peak resident memory of a process in MB (Linux only, else None)"""
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            fields = dict(line.split(':', 1) for line in status if ':' in line)
+        return (round(int(fields['VmRSS'].split()[0]) / 1024, 1),
+                round(int(fields['VmHWM'].split()[0]) / 1024, 1))
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def run_load_client(index, url, args, results):
+    """One simulated browser: connect, send messages one after another, time each reply"""
+    import threading
+    import socketio
+
+    client = socketio.Client(reconnection=False)
+    state = {'done': threading.Event(), 'first_chunk': None, 'outcome': None}
+
+    @client.on('response_chunk')
+    def on_chunk(data):
+        if state['first_chunk'] is None:
+            state['first_chunk'] = time.perf_counter()
+
+    @client.on('response')
+    def on_response(data):
+        state['outcome'] = 'ok'
+        state['done'].set()
+
+    @client.on('error')
+    def on_error(data):
+        state['outcome'] = 'error'
+        state['done'].set()
+
+    @client.on('busy')
+    def on_busy(data):
+        state['outcome'] = 'busy'
+        state['done'].set()
+
+    transports = args.transports.split(',') if args.transports else None
+    if transports is None:
+        # websocket-client is needed for the websocket transport
+        if importlib.util.find_spec('websocket') is None:
+            transports = ['polling']
+    try:
+        client.connect(url, transports=transports, wait_timeout=30)
+    except Exception as e:
+        results.append({'outcome': 'connect_failed', 'error': str(e)})
+        return
+    try:
+        for number in range(args.messages):
+            state['done'].clear()
+            state['first_chunk'] = None
+            state['outcome'] = None
+            started = time.perf_counter()
+            client.emit('send_message', {
+                'message': f"load test message {number} from client {index}",
+                'api_key': f"xai-load-{index}",
+                'stream': args.stream,
+                'live_search_enabled': random_share(index, number) < args.live_search_share
+            })
+            if not state['done'].wait(args.message_timeout):
+                results.append({'outcome': 'timeout'})
+                continue
+            finished = time.perf_counter()
+            # Without streaming the whole reply is the first token
+            first = state['first_chunk'] if state['first_chunk'] is not None else finished
+            results.append({'outcome': state['outcome'], 'ttft': first - started, 'e2e': finished - started})
+            if args.think_time:
+                time.sleep(args.think_time)
+    finally:
+        client.disconnect()
+
+
+def random_share(index, number):
+    """Deterministic pseudo-random value in [0, 1) per client message, so runs are comparable"""
+    return ((index * 7919 + number * 104729) % 1000) / 1000
+
+
+def run_load(args):
+    """Drive a real chat.py server behind the mock xAI API with concurrent Socket.IO clients"""
+    import subprocess
+    import threading
+    import urllib.request
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    mock_port = free_port()
+    mock = subprocess.Popen([
+        sys.executable, os.path.join(here, 'mock_xai_server.py'), '--port', str(mock_port),
+        '--latency', str(args.latency), '--jitter', str(args.jitter), '--tokens', str(args.tokens),
+        '--token-delay', str(args.token_delay), '--rate-limit-rate', str(args.rate_limit_rate),
+        '--error-rate', str(args.error_rate), '--live-search-latency', str(args.live_search_latency)
+    ], stdout=subprocess.DEVNULL)
+
+    port = free_port()
+    env = dict(os.environ, PORT=str(port), HOST='127.0.0.1',
+               API_URL=f"http://127.0.0.1:{mock_port}/v1/chat/completions",
+               SOCKETIO_ASYNC_MODE=args.async_mode)
+    # Measure the app, not the protective limits, unless they are set explicitly
+    for name, value in (('LOG_LEVEL', 'WARNING'), ('RATE_LIMIT_KEY_RPS', '0'), ('RATE_LIMIT_GLOBAL_RPS', '0')):
+        env.setdefault(name, value)
+    server = subprocess.Popen([sys.executable, os.path.join(here, 'chat.py')], env=env, cwd=here,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.time() + 30
+        while True:
+            try:
+                urllib.request.urlopen(url + '/health', timeout=1).read()
+                break
+            except OSError:
+                if server.poll() is not None or time.time() > deadline:
+                    print(f"❌ chat.py did not start\n{server.stderr.read()[-2000:] if server.poll() is not None else ''}")
+                    return
+                time.sleep(0.2)
+        idle_rss, _ = process_memory_mb(server.pid)
+
+        results = []
+        started = time.perf_counter()
+        threads = [threading.Thread(target=run_load_client, args=(index, url, args, results), daemon=True)
+                   for index in range(args.clients)]
+        for thread in threads:
+            thread.start()
+            if args.ramp_up:
+                time.sleep(args.ramp_up / args.clients)
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - started
+        rss, peak_rss = process_memory_mb(server.pid)
+        upstream = json.loads(urllib.request.urlopen(
+            f"http://127.0.0.1:{mock_port}/stats", timeout=5).read())
+    finally:
+        server.terminate()
+        mock.terminate()
+        server.wait()
+        mock.wait()
+
+    ok = [result for result in results if result['outcome'] == 'ok']
+    outcomes = {}
+    for result in results:
+        outcomes[result['outcome']] = outcomes.get(result['outcome'], 0) + 1
+    ttft = [result['ttft'] for result in ok]
+    e2e = [result['e2e'] for result in ok]
+    summary = {
+        'clients': args.clients,
+        'messages': len(results),
+        'outcomes': outcomes,
+        'wall_time': round(wall, 2),
+        'throughput': round(len(ok) / wall, 2) if wall else 0,
+        'ttft': {name: round(percentile(ttft, fraction), 4)
+                 for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99))},
+        'e2e': {name: round(percentile(e2e, fraction), 4)
+                for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99))},
+        'server_rss_mb': {'idle': idle_rss, 'end': rss, 'peak': peak_rss},
+        'upstream': upstream
+    }
+
+    print(f"{args.clients} clients x {args.messages} messages ({args.async_mode}, "
+          f"{'stream' if args.stream else 'no stream'}) in {summary['wall_time']}s")
+    print(f"  outcomes   : {outcomes}")
+    print(f"  throughput : {summary['throughput']} replies/s")
+    print(f"  TTFT       : p50 {summary['ttft']['p50']}s  p90 {summary['ttft']['p90']}s  p99 {summary['ttft']['p99']}s")
+    print(f"  end-to-end : p50 {summary['e2e']['p50']}s  p90 {summary['e2e']['p90']}s  p99 {summary['e2e']['p99']}s")
+    print(f"  server RSS : idle {idle_rss} MB, end {rss} MB, peak {peak_rss} MB")
+    print(f"  upstream   : {upstream}")
+
+    if args.record:
+        try:
+            commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=here,
+                                    capture_output=True, text=True).stdout.strip() or None
+        except OSError:
+            commit = None
+        config = {name: value for name, value in vars(args).items() if name not in ('command', 'record')}
+        with open(args.record, 'a', encoding='utf-8') as record:
+            record.write(json.dumps({
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'commit': commit,
+                'config': config,
+                'results': summary
+            }) + '\n')
+        print(f"  recorded to {args.record}")
+
+
+# ===== Logging overhead benchmark =====
+# (level, template, args) of the records one chat message produces on its request path
+MESSAGE_LOG_RECORDS = [
+    ('info', 'Processing message request [ID:%s]', ('{id}',)),
+    ('debug', '[ID:%s] Conversation ID: %s', ('{id}', '20250101000000')),
+    ('debug', '[ID:%s] API URL: %s', ('{id}', 'https://api.x.ai/v1/chat/completions')),
+    ('debug', '[ID:%s] Message length: %s characters', ('{id}', 120)),
+    ('debug', '[ID:%s] Attempting to get conversation messages', ('{id}',)),
+    ('debug', '[ID:%s] Current conversation message count: %s', ('{id}', 12)),
+    ('debug', '[ID:%s] Attempting to add user message to conversation', ('{id}',)),
+    ('debug', 'Message added to conversation %s', ('20250101000000',)),
+    ('debug', '[ID:%s] User message added to conversation', ('{id}',)),
+    ('debug', '[ID:%s] Using model: %s', ('{id}', 'grok-4-latest')),
+    ('debug', '[ID:%s] Ready to send API request, total messages: %s, prompt tokens: %s/%s, dropped history: %s',
+     ('{id}', 14, 2150, 32000, 0)),
+    ('debug', '[ID:%s] Starting API call, stream: %s', ('{id}', True)),
+    ('debug', 'API request[%s] initializing: message count=%s', ('{id}', 14)),
+    ('debug', 'API request[%s] URL: %s', ('{id}', 'https://api.x.ai/v1/chat/completions')),
+    ('debug', 'DNS check passed for %s', ('api.x.ai',)),
+    ('debug', 'API request[%s] model: %s, temperature: %s', ('{id}', 'grok-4-latest', 0.0)),
+    ('debug', 'API request[%s] attempt %s/%s, timeout: %ss', ('{id}', 1, 3, 15.0)),
+    ('debug', 'API request[%s] response status: %s, time: %ss', ('{id}', 200, 0.8421)),
+    ('info', 'API request[%s] successful on attempt %s, total time: %ss', ('{id}', 1, 1.2093)),
+    ('debug', '[ID:%s] API call completed, checking response', ('{id}',)),
+    ('debug', '[ID:%s] Successfully extracted assistant reply, length: %s characters', ('{id}', 1834)),
+    ('debug', '[ID:%s] Attempting to add assistant reply to conversation', ('{id}',)),
+    ('debug', 'Message added to conversation %s', ('20250101000000',)),
+    ('debug', '[ID:%s] Assistant reply added to conversation', ('{id}',)),
+    ('debug', '[ID:%s] Sending response to client', ('{id}',)),
+    ('debug', '[ID:%s] Updating conversation list', ('{id}',)),
+    ('info', '[ID:%s] Message processing completed', ('{id}',)),
+]
+
+
+def run_logging(args):
+    """Time the logging work done on the request thread per message for each logging setup"""
+    import logging
+    os.environ['LOG_LEVEL'] = 'WARNING'  # Keep chat's own startup quiet
+    import chat
+
+    log = logging.getLogger('chat')
+    setups = [
+        # (name, eager f-string formatting, configure_logging keyword arguments)
+        ('before: sync DEBUG, f-strings', True, {'level': 'DEBUG', 'async_writer': False}),
+        ('sync DEBUG, lazy args', False, {'level': 'DEBUG', 'async_writer': False}),
+        ('async DEBUG text', False, {'level': 'DEBUG'}),
+        ('async DEBUG json', False, {'level': 'DEBUG', 'log_format': 'json'}),
+        ('async DEBUG json, 10% sampled', False, {'level': 'DEBUG', 'log_format': 'json', 'debug_sample_rate': 0.1}),
+        ('after: async INFO (default)', False, {'level': 'INFO'}),
+    ]
+    import tempfile
+
+    class BlockingStream:
+        """File stream whose writes block like stdout piped to a busy log collector"""
+
+        def __init__(self, stream, delay):
+            self.stream = stream
+            self.delay = delay
+
+        def write(self, text):
+            if self.delay:
+                time.sleep(self.delay)
+            return self.stream.write(text)
+
+        def flush(self):
+            self.stream.flush()
+
+    with tempfile.TemporaryFile('w') as file:
+        output = BlockingStream(file, args.write_delay_us / 1e6)
+        for name, eager, options in setups:
+            options.setdefault('queue_size', args.messages * len(MESSAGE_LOG_RECORDS))
+            request_filter, queue_handler, listener = chat.configure_logging(stream=output, **options)
+            request_filter.tracer = chat.tracer
+            methods = [(getattr(log, level), template, args) for level, template, args in MESSAGE_LOG_RECORDS]
+
+            started = time.perf_counter()
+            for _ in range(args.messages):
+                trace = chat.tracer.start_trace('benchmark')
+                request_id = trace.trace_id
+                with chat.tracer.activate(trace):
+                    for method, template, record_args in methods:
+                        values = tuple(request_id if value == '{id}' else value for value in record_args)
+                        if eager:
+                            method(template % values)
+                        else:
+                            method(template, *values)
+            request_us = (time.perf_counter() - started) / args.messages * 1e6
+
+            # Time for the writer thread to drain what the request threads queued
+            started = time.perf_counter()
+            if listener:
+                listener.stop()
+            drain_ms = (time.perf_counter() - started) * 1000
+            print(f"{name:<34} | request thread {request_us:>8.1f} us/message | writer drain {drain_ms:>8.1f} ms",
+                  flush=True)
+    logging.disable(logging.CRITICAL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Grok Chat benchmarks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    capacity = subparsers.add_parser('capacity', help='concurrent-conversation capacity per async mode')
+    capacity.add_argument('--concurrency', default='100,500,1000', help='comma separated in-flight levels')
+    capacity.add_argument('--latency', type=float, default=1.0, help='mock upstream latency in seconds')
+    capacity.add_argument('--modes', default='threading,eventlet', help='comma separated SOCKETIO_ASYNC_MODE values')
+    capacity.add_argument('--timeout', type=float, default=120, help='per-run timeout in seconds')
+    capacity.add_argument('--json', action='store_true', help='also print raw results as JSON')
+
+    worker = subparsers.add_parser('capacity-worker', help=argparse.SUPPRESS)
+    worker.add_argument('--level', type=int, required=True)
+    worker.add_argument('--timeout', type=float, default=120)
+
+    recovery = subparsers.add_parser('recovery', help='restart recovery time of the conversation log')
+    recovery.add_argument('--messages', type=int, default=100000, help='total stored messages')
+    recovery.add_argument('--messages-per-conversation', type=int, default=20)
+    recovery.add_argument('--content-size', type=int, default=200, help='characters per message')
+    recovery.add_argument('--tail-fraction', type=float, default=0.1, help='share of messages left in the WAL tail')
+
+    eviction = subparsers.add_parser('eviction', help='conversation eviction cost, sort-based vs LRU')
+    eviction.add_argument('--conversations', default='10000,100000', help='comma separated store sizes')
+    eviction.add_argument('--inserts', type=int, default=200, help='new conversations inserted at the limit')
+
+    history = subparsers.add_parser('history', help='per-conversation message history, list vs ring buffer')
+    history.add_argument('--max-messages', type=int, default=30)
+    history.add_argument('--messages', type=int, default=100000, help='messages appended past the limit')
+
+    load = subparsers.add_parser('load', help='end-to-end load test with Socket.IO clients and a mock xAI API')
+    load.add_argument('--clients', type=int, default=50, help='concurrent Socket.IO clients')
+    load.add_argument('--messages', type=int, default=20, help='messages sent by each client, one at a time')
+    load.add_argument('--think-time', type=float, default=0, help='seconds a client waits between messages')
+    load.add_argument('--ramp-up', type=float, default=2, help='seconds over which clients connect')
+    load.add_argument('--message-timeout', type=float, default=120)
+    load.add_argument('--no-stream', dest='stream', action='store_false', help='request non-streaming replies')
+    load.add_argument('--live-search-share', type=float, default=0, help='share of messages with Live Search on')
+    load.add_argument('--async-mode', default='threading', help='SOCKETIO_ASYNC_MODE of the server')
+    load.add_argument('--transports', default='', help='client transports, e.g. polling or websocket')
+    load.add_argument('--latency', type=float, default=0.5, help='mock upstream seconds before headers')
+    load.add_argument('--jitter', type=float, default=0.1)
+    load.add_argument('--tokens', type=int, default=50, help='words per mock reply')
+    load.add_argument('--token-delay', type=float, default=0.01, help='mock seconds between streamed chunks')
+    load.add_argument('--rate-limit-rate', type=float, default=0, help='share of upstream 429 responses')
+    load.add_argument('--error-rate', type=float, default=0, help='share of upstream 5xx responses')
+    load.add_argument('--live-search-latency', type=float, default=1.0)
+    load.add_argument('--record', help='append the results as one JSON line to this file')
+
+    logging_parser = subparsers.add_parser('logging', help='per-message logging overhead on the request thread')
+    logging_parser.add_argument('--messages', type=int, default=5000)
+    logging_parser.add_argument('--write-delay-us', type=float, default=0,
+                                help='simulated blocking time of each write to the log sink')
+
+    compression = subparsers.add_parser('compression', help='resident memory with compressed message history')
+    compression.add_argument('--conversations', type=int, default=50000)
+    compression.add_argument('--messages-per-conversation', type=int, default=20)
+    compression.add_argument('--content-size', type=int, default=1000, help='characters per message')
+    compression.add_argument('--hot-messages', default='0,4,8', help='comma separated HISTORY_HOT_MESSAGES values')
+    compression.add_argument('--context-budget', type=int, default=32000, help='prompt token budget')
+
+    compression_worker = subparsers.add_parser('compression-worker', help=argparse.SUPPRESS)
+    compression_worker.add_argument('--conversations', type=int, required=True)
+    compression_worker.add_argument('--messages-per-conversation', type=int, required=True)
+    compression_worker.add_argument('--content-size', type=int, required=True)
+    compression_worker.add_argument('--context-budget', type=int, required=True)
+    compression_worker.add_argument('--hot', type=int, required=True, help='-1 disables compression')
+
+    args = parser.parse_args()
+    if args.command == 'capacity':
+        run_capacity(args)
+    elif args.command == 'capacity-worker':
+        run_capacity_worker(args.level, args.timeout)
+    elif args.command == 'recovery':
+        run_recovery(args)
+    elif args.command == 'eviction':
+        run_eviction(args)
+    elif args.command == 'history':
+        run_history(args)
+    elif args.command == 'logging':
+        run_logging(args)
+    elif args.command == 'load':
+        run_load(args)
+    elif args.command == 'compression':
+        run_compression(args)
+    elif args.command == 'compression-worker':
+        run_compression_worker(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,32 +1,178 @@
 #!/usr/bin/env python3
-from flask import Flask, render_template, session, request
-from flask_socketio import SocketIO
+import os
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Cooperative async modes must patch the standard library before anything
+# else opens sockets or creates locks (gunicorn's eventlet worker also does this)
+SOCKETIO_ASYNC_MODE = os.getenv('SOCKETIO_ASYNC_MODE', 'threading').lower()
+if SOCKETIO_ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+elif SOCKETIO_ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+from flask import Flask, Response, render_template, request
+from flask_socketio import SocketIO, join_room, leave_room, rooms
 from flask_cors import CORS  # 导入CORS支持
 import requests
 import json
-import os
 import logging
+import logging.handlers
+import atexit
+import re
+import functools
+import itertools
+import contextlib
+import hashlib
+import random
+import queue
+import email.utils
 import sys
 import time
 import ssl
 from datetime import datetime
-from dotenv import load_dotenv
 import urllib.request
 import urllib.error
 import http.client
 import socket
 import threading
-from collections import defaultdict, deque
+import sqlite3
+import mmap
+import math
+import zlib
+from collections import defaultdict, deque, OrderedDict
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 
-# Load environment variables from .env file
-load_dotenv()
+# Optional exact tokenizer; without it an offline BPE approximation is used
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
 
 # ===== Network Monitoring System =====
+class LatencyHistogram:
+    """Log-bucketed latency histogram with constant-time recording
+
+    Bucket bounds grow by 2**(1/16) (about 4.4%), so any reported
+    percentile is within that relative error of the true value across
+    the whole range from 0.1 ms to 1000 s, using a few hundred counters.
+    """
+
+    MIN_VALUE = 1e-4
+    MAX_VALUE = 1000.0
+    GROWTH = 2 ** (1 / 16)
+    _LOG_GROWTH = math.log(GROWTH)
+    BUCKETS = int(math.ceil(math.log(MAX_VALUE / MIN_VALUE) / _LOG_GROWTH)) + 1
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        if seconds <= self.MIN_VALUE:
+            index = 0
+        else:
+            index = min(self.BUCKETS - 1, int(math.log(seconds / self.MIN_VALUE) / self._LOG_GROWTH) + 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        return self
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of samples"""
+        if not self.count:
+            return 0
+        target = max(1, math.ceil(fraction * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self.max, self.MIN_VALUE * self.GROWTH ** index)
+        return self.max
+
+    def cumulative_counts(self, bounds):
+        """Samples at or below each bound, as Prometheus histogram buckets
+
+        A bucket counts towards a bound once its upper edge is within it, so
+        bounds are exact to the bucket width.
+        """
+        cumulative = []
+        seen = 0
+        index = 0
+        for bound in bounds:
+            last = min(self.BUCKETS - 1, int(math.log(bound / self.MIN_VALUE) / self._LOG_GROWTH + 1e-9))
+            while index <= last:
+                seen += self.counts[index]
+                index += 1
+            cumulative.append(seen)
+        return cumulative
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': round(self.total / self.count, 4) if self.count else 0,
+            'p50': round(self.percentile(0.5), 4),
+            'p90': round(self.percentile(0.9), 4),
+            'p99': round(self.percentile(0.99), 4),
+            'p999': round(self.percentile(0.999), 4),
+            'max': round(self.max, 4)
+        }
+
+
 class NetworkMonitor:
     """网络请求监控和统计系统"""
     
-    def __init__(self):
-        self.request_stats = {
+    # Latency metrics kept as histograms: total request time, time to first byte (response
+    # headers), time to first token (streaming), DNS lookup, TCP+TLS connect, and upstream
+    # processing (time to first byte minus connect time)
+    LATENCY_METRICS = ('total', 'ttfb', 'ttft', 'dns', 'connect', 'upstream')
+    # Weight of the newest sample in the moving averages (about a 100-sample window)
+    AVERAGE_WEIGHT = 2 / 101
+    # Label of models outside the allowlist or past the label limit
+    OTHER_MODEL = 'other'
+    MAX_MODEL_LENGTH = 64
+    
+    def __init__(self, models=None, max_models=20):
+        """
+        Args:
+            models: Model names kept as their own histogram labels; None admits
+                the first max_models distinct names instead
+            max_models: Distinct model labels admitted when models is None
+        """
+        self.request_stats = self._initial_stats()
+        self.histograms = defaultdict(LatencyHistogram)  # Maps (metric, model, live_search) to histograms
+        # Model names come from clients, so labels are bounded to keep histograms and /metrics series finite
+        self.allowed_models = frozenset(models) if models else None
+        self.max_models = max_models
+        self.model_labels = set()
+        self.error_history = deque(maxlen=50)    # 保存最近50次错误
+        self.connect_times = threading.local()   # Connect time of the current thread's request
+        self.active_sockets = 0                  # Connected Socket.IO clients, not cleared by reset_stats
+        self.lock = threading.Lock()
+    
+    @staticmethod
+    def _initial_stats():
+        """初始统计数据"""
+        return {
             'total_requests': 0,
             'successful_requests': 0,
             'failed_requests': 0,
@@ -35,12 +181,13 @@ class NetworkMonitor:
             'ssl_errors': 0,
             'other_errors': 0,
             'average_response_time': 0,
+            'average_ttft': 0,
+            'pool_hits': 0,
+            'pool_misses': 0,
+            'coalesced_requests': 0,
             'last_error': None,
             'last_success': None
         }
-        self.response_times = deque(maxlen=100)  # 保存最近100次请求的响应时间
-        self.error_history = deque(maxlen=50)    # 保存最近50次错误
-        self.lock = threading.Lock()
     
     def record_request_start(self):
         """记录请求开始"""
@@ -48,17 +195,82 @@ class NetworkMonitor:
             self.request_stats['total_requests'] += 1
         return time.time()
     
-    def record_request_success(self, start_time, response_size=0):
+    def _model_label(self, model):
+        # Called with the lock held
+        if model is None or model in self.model_labels:
+            return model
+        if self.allowed_models is not None:
+            return model if model in self.allowed_models else self.OTHER_MODEL
+        if (not isinstance(model, str) or len(model) > self.MAX_MODEL_LENGTH
+                or len(self.model_labels) >= self.max_models):
+            return self.OTHER_MODEL
+        self.model_labels.add(model)
+        return model
+    
+    def _moving_average(self, name, value):
+        # Called with the lock held; the first sample seeds the average
+        previous = self.request_stats[name]
+        self.request_stats[name] = value if not previous else previous + (value - previous) * self.AVERAGE_WEIGHT
+    
+    def record_latency(self, metric, seconds, model=None, live_search=None):
+        """记录一次延迟样本（常数时间）
+
+        Args:
+            metric: One of LATENCY_METRICS
+            seconds: Measured latency
+            model: Model name of the request, None for connection-level metrics
+            live_search: Whether Live Search was on, None for connection-level metrics
+        """
+        with self.lock:
+            self.histograms[(metric, self._model_label(model), live_search)].record(seconds)
+    
+    def record_request_success(self, start_time, response_size=0, model=None, live_search=None):
         """记录成功请求"""
         response_time = time.time() - start_time
         with self.lock:
             self.request_stats['successful_requests'] += 1
             self.request_stats['last_success'] = datetime.now().isoformat()
-            self.response_times.append(response_time)
+            self.histograms[('total', self._model_label(model), live_search)].record(response_time)
             
             # 更新平均响应时间
-            if self.response_times:
-                self.request_stats['average_response_time'] = sum(self.response_times) / len(self.response_times)
+            self._moving_average('average_response_time', response_time)
+    
+    def record_first_token(self, start_time, model=None, live_search=None):
+        """记录流式请求的首token时间 (time-to-first-token)"""
+        ttft = time.time() - start_time
+        with self.lock:
+            self.histograms[('ttft', self._model_label(model), live_search)].record(ttft)
+            self._moving_average('average_ttft', ttft)
+        return ttft
+    
+    def record_connect(self, seconds):
+        """记录新建上游连接（TCP+TLS握手）耗时"""
+        self.connect_times.last = getattr(self.connect_times, 'last', 0) + seconds
+        self.record_latency('connect', seconds)
+    
+    def take_connect_time(self):
+        """Get and reset the connect time spent by the current thread since the last call"""
+        seconds = getattr(self.connect_times, 'last', 0)
+        self.connect_times.last = 0
+        return seconds
+    
+    def record_pool_usage(self, reused):
+        """记录上游连接池命中（复用已有连接）或未命中（新建TCP/TLS连接）"""
+        with self.lock:
+            if reused:
+                self.request_stats['pool_hits'] += 1
+            else:
+                self.request_stats['pool_misses'] += 1
+    
+    def record_coalesced_request(self):
+        """记录合并到进行中相同请求的调用（未单独访问上游）"""
+        with self.lock:
+            self.request_stats['coalesced_requests'] += 1
+    
+    def record_socket(self, connected):
+        """记录Socket.IO客户端连接或断开"""
+        with self.lock:
+            self.active_sockets += 1 if connected else -1
     
     def record_request_failure(self, start_time, error_type, error_message):
         """记录失败请求"""
@@ -98,27 +310,74 @@ class NetworkMonitor:
                 (stats['successful_requests'] / max(stats['total_requests'], 1)) * 100
                 if stats['total_requests'] > 0 else 0
             )
+            pool_total = stats['pool_hits'] + stats['pool_misses']
+            stats['pool_hit_rate'] = (stats['pool_hits'] / pool_total) * 100 if pool_total > 0 else 0
             stats['recent_errors'] = list(self.error_history)[-10:]  # 最近10个错误
             return stats
     
     def reset_stats(self):
         """重置统计信息"""
         with self.lock:
-            self.request_stats = {
-                'total_requests': 0,
-                'successful_requests': 0,
-                'failed_requests': 0,
-                'timeout_errors': 0,
-                'connection_errors': 0,
-                'ssl_errors': 0,
-                'other_errors': 0,
-                'average_response_time': 0,
-                'last_error': None,
-                'last_success': None
-            }
-            self.response_times.clear()
+            self.request_stats = self._initial_stats()
+            self.histograms.clear()
+            self.model_labels.clear()
             self.error_history.clear()
     
+    def get_metrics_snapshot(self):
+        """Copy counters and raw histogram buckets for the /metrics endpoint
+
+        Only plain counters and bucket lists are copied under the lock, so
+        scraping stays cheap and never touches the error history.
+        """
+        with self.lock:
+            counters = {name: value for name, value in self.request_stats.items() if isinstance(value, (int, float))}
+            counters['active_sockets'] = self.active_sockets
+            histograms = [(key, histogram.counts[:], histogram.count, histogram.total)
+                          for key, histogram in self.histograms.items()]
+        snapshot = []
+        for key, counts, count, total in histograms:
+            histogram = LatencyHistogram()
+            histogram.counts, histogram.count, histogram.total = counts, count, total
+            snapshot.append((key, histogram))
+        return counters, snapshot
+    
+    def get_latency_stats(self):
+        """获取各延迟指标的百分位数（p50/p90/p99/p999），按模型与 Live Search 开关细分"""
+        with self.lock:
+            snapshot = [(key, LatencyHistogram().merge(histogram)) for key, histogram in self.histograms.items()]
+        latency = {}
+        for metric in self.LATENCY_METRICS:
+            overall = LatencyHistogram()
+            by_model = defaultdict(LatencyHistogram)
+            by_live_search = defaultdict(LatencyHistogram)
+            for (name, model, live_search), histogram in snapshot:
+                if name != metric:
+                    continue
+                overall.merge(histogram)
+                if model is not None:
+                    by_model[model].merge(histogram)
+                if live_search is not None:
+                    by_live_search['on' if live_search else 'off'].merge(histogram)
+            latency[metric] = overall.summary()
+            if by_model:
+                latency[metric]['by_model'] = {model: h.summary() for model, h in by_model.items()}
+            if by_live_search:
+                latency[metric]['by_live_search'] = {key: h.summary() for key, h in by_live_search.items()}
+        return latency
+    
+    def get_health_status(self):
+        """获取网络健康状态摘要"""
+        stats = self.get_stats()
+        return {
+            'healthy': self.is_healthy(),
+            'success_rate': stats['success_rate'],
+            'average_response_time': stats['average_response_time'],
+            'average_ttft': stats['average_ttft'],
+            'total_requests': stats['total_requests'],
+            'last_error': stats['last_error'],
+            'last_success': stats['last_success']
+        }
+    
     def is_healthy(self):
         """检查网络健康状态"""
         with self.lock:
@@ -140,17 +399,158 @@ class NetworkMonitor:
             return True
 
 # 创建全局网络监控实例
-network_monitor = NetworkMonitor()
-
-# Configure detailed logging system first
-logging.basicConfig(
-    level=logging.DEBUG,  # Set DEBUG level to get more detailed information
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout)
-    ]
+network_monitor = NetworkMonitor(
+    models=[name.strip() for name in os.getenv('METRICS_MODELS', '').split(',') if name.strip()],
+    max_models=int(os.getenv('METRICS_MAX_MODELS', '20'))
+)
+
+# ===== Logging =====
+LOG_TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class JSONLogFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message, request ID and any extra fields"""
+
+    # Attributes every LogRecord has; anything else was passed through extra=
+    STANDARD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for name, value in vars(record).items():
+            if name not in self.STANDARD_ATTRIBUTES and value is not None:
+                entry[name] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RequestLogFilter(logging.Filter):
+    """Tag records with the current request ID and sample DEBUG records
+
+    Sampling is decided per request from its ID, so the debug lines of a
+    request are either all kept or all dropped. Runs on the logging thread
+    before the record is queued, so it must stay cheap.
+    """
+
+    def __init__(self, debug_sample_rate=1.0):
+        super().__init__()
+        self.debug_sample_rate = debug_sample_rate
+        self.tracer = None  # Set once the tracer exists
+
+    def filter(self, record):
+        trace = self.tracer.current() if self.tracer else None
+        record.request_id = trace.trace_id if trace is not None else None
+        if record.levelno > logging.DEBUG or self.debug_sample_rate >= 1:
+            return True
+        if trace is not None:
+            # Multiplicative hash spreads consecutive IDs evenly over the sample
+            return (int(trace.trace_id[-8:], 16) * 2654435761) % 2 ** 32 < self.debug_sample_rate * 2 ** 32
+        return random.random() < self.debug_sample_rate
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves all formatting to the writer thread
+
+    The standard handler formats the message before queueing it; here the
+    record is queued as is, so a request thread only pays for creating the
+    record. Arguments are formatted later and should not be mutated after
+    logging. The lock-free SimpleQueue is bounded by checking its size;
+    when it is full, records are dropped and counted rather than blocking
+    the request.
+    """
+
+    def __init__(self, max_size=10000):
+        super().__init__(queue.SimpleQueue())
+        self.max_size = max_size
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        if self.queue.qsize() >= self.max_size:
+            self.dropped += 1
+            return
+        self.queue.put_nowait(record)
+
+
+class LogWriter(logging.handlers.QueueListener):
+    """Background thread writing queued log records; stop() may be called more than once"""
+
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+
+def parse_log_levels(value):
+    """Parse 'logger=LEVEL,logger=LEVEL' into a dictionary"""
+    levels = {}
+    for item in (value or '').split(','):
+        name, _, level = item.partition('=')
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure_logging(level='INFO', log_format='text', module_levels=None, async_writer=True,
+                      queue_size=10000, debug_sample_rate=1.0, stream=None):
+    """Replace the root handlers with the configured logging pipeline
+
+    Args:
+        level: Root log level
+        log_format: 'text' or 'json' (one object per line)
+        module_levels: Dictionary of logger name to level overriding the root level
+        async_writer: Write records from a background thread through a bounded queue
+        queue_size: Maximum records waiting for the writer thread
+        debug_sample_rate: Share of requests whose DEBUG records are kept
+        stream: Output stream (defaults to stdout)
+
+    Returns:
+        Tuple of (request filter, queue handler or None, queue listener or None)
+    """
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        if isinstance(handler, DeferredQueueHandler) and getattr(handler, 'listener', None):
+            handler.listener.stop()
+    root.setLevel(level.upper())
+    for name, module_level in (module_levels or {}).items():
+        logging.getLogger(name).setLevel(module_level)
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JSONLogFormatter() if log_format == 'json' else logging.Formatter(LOG_TEXT_FORMAT))
+    request_filter = RequestLogFilter(debug_sample_rate)
+    if not async_writer:
+        output.addFilter(request_filter)
+        root.addHandler(output)
+        return request_filter, None, None
+
+    queue_handler = DeferredQueueHandler(queue_size)
+    queue_handler.addFilter(request_filter)
+    listener = LogWriter(queue_handler.queue, output, respect_handler_level=True)
+    queue_handler.listener = listener
+    listener.start()
+    root.addHandler(queue_handler)
+    return request_filter, queue_handler, listener
+
+
+request_log_filter, log_queue_handler, log_listener = configure_logging(
+    level=os.getenv('LOG_LEVEL', 'INFO'),
+    log_format=os.getenv('LOG_FORMAT', 'text').lower(),
+    module_levels=parse_log_levels(os.getenv('LOG_LEVELS', 'engineio=WARNING,socketio=WARNING,urllib3=INFO')),
+    async_writer=os.getenv('LOG_ASYNC', 'True').lower() == 'true',
+    queue_size=int(os.getenv('LOG_QUEUE_SIZE', '10000')),
+    debug_sample_rate=float(os.getenv('LOG_DEBUG_SAMPLE_RATE', '1'))
 )
-logger = logging.getLogger(__name__)
+if log_listener:
+    # Flush queued records on shutdown
+    atexit.register(log_listener.stop)
+logger = logging.getLogger('chat')
 
 # ===== Fix SSL Recursion Error =====
 logger.info("Applying SSL fix to avoid recursion errors...")
@@ -225,9 +625,9 @@ socketio = SocketIO(
     cors_allowed_origins="*",        # Allow cross-origin requests
     ping_timeout=20,                 # Reduce timeout for better responsiveness
     ping_interval=25,                # Ping interval for connection health
-    async_mode='threading',          # Use threading for better compatibility
-    logger=True,                     # Enable SocketIO logging for troubleshooting
-    engineio_logger=True,            # Enable Engine.IO logging for troubleshooting
+    async_mode=SOCKETIO_ASYNC_MODE,  # threading, or eventlet/gevent for cooperative I/O
+    logger=os.getenv('SOCKETIO_LOGGER', 'False').lower() == 'true',    # Per-packet Socket.IO logging for troubleshooting
+    engineio_logger=os.getenv('SOCKETIO_LOGGER', 'False').lower() == 'true',
     manage_session=False,            # Don't let SocketIO manage Flask sessions
     always_connect=True,             # Always attempt to connect
     cors_credentials=True,           # Allow credentials for CORS
@@ -237,261 +637,3654 @@ socketio = SocketIO(
     cors_headers=["Content-Type", "Authorization"],  # Specify allowed CORS headers
     max_http_buffer_size=1000000,    # Increase buffer size for large messages
     http_compression=True,           # Enable HTTP compression
-    json=json                        # Use standard JSON library
+    json=json,                       # Use standard JSON library
+    # Share emits across workers/nodes (e.g. redis://host:6379/0); unset uses the in-process manager
+    message_queue=os.getenv('SOCKETIO_MESSAGE_QUEUE') or None
 )
 
 # API endpoint for Grok API
 API_URL = os.getenv('API_URL', 'https://api.x.ai/v1/chat/completions')
 
-# Session management for chats, API keys and settings
-# Efficient memory management using class-based approach
-class SessionManager:
-    def __init__(self, max_conversations=50, max_messages_per_conversation=30):
-        """Initialize the session manager with memory limits
-        
+# Stream completions to clients token-by-token unless the client opts out
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', 'True').lower() == 'true'
+
+# ===== Conversation Storage Backends =====
+class Message:
+    """Immutable chat message record
+
+    Records are shared between a conversation's history and every view handed
+    out by get_messages, so they must never be modified after creation (apart
+    from the cached token count, which is derived from the content).
+
+    The content is held either as a str or, for records made by compress(),
+    as zlib-compressed UTF-8 that is decompressed on every read.
+    """
+    __slots__ = ('role', '_content', 'timestamp', 'size', 'tokens')
+    FIELDS = ('role', 'content', 'timestamp', 'size', 'tokens')
+
+    def __init__(self, role, content, timestamp):
+        self.role = role
+        self._content = content
+        self.timestamp = timestamp
+        self.size = len(content.encode('utf-8'))  # Bytes of content held, compressed if compressed
+        self.tokens = None  # Prompt token count, filled in lazily by count_message_tokens
+
+    @property
+    def content(self):
+        content = self._content
+        if content.__class__ is bytes:
+            return zlib.decompress(content).decode('utf-8')
+        return content
+
+    @property
+    def compressed(self):
+        return self._content.__class__ is bytes
+
+    def compress(self, level=6):
+        """Return a compressed copy of this record, or the record itself if compression doesn't shrink it"""
+        if self.compressed:
+            return self
+        packed = zlib.compress(self._content.encode('utf-8'), level)
+        if len(packed) >= self.size:
+            return self
+        record = Message.__new__(Message)
+        record.role = self.role
+        record._content = packed
+        record.timestamp = self.timestamp
+        record.size = len(packed)
+        record.tokens = self.tokens
+        return record
+
+    @classmethod
+    def from_dict(cls, message):
+        return cls(message['role'], message['content'], message['timestamp'])
+
+    def to_dict(self):
+        return {'role': self.role, 'content': self.content, 'timestamp': self.timestamp}
+
+    def __getitem__(self, key):
+        # Read-only dict-style access for code written against message dicts
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __repr__(self):
+        return f"Message({self.role!r}, {self.content[:30]!r})"
+
+
+class MessageHistory:
+    """Bounded message history of one conversation
+
+    System messages are pinned in a separate prefix; user and assistant
+    messages live in a deque whose maxlen leaves room for them, so appending
+    past the limit drops the oldest message in O(1) instead of rebuilding
+    the list.
+
+    Non-system messages are numbered in append order; the number of the
+    oldest one shown on a page is the cursor for the page before it.
+
+    With hot_messages set, a message is compressed as soon as that many newer
+    messages follow it, so only the tail that prompts and the first page
+    usually read stays as plain strings.
+    """
+    __slots__ = ('system', 'recent', 'bytes', 'appended')
+
+    COMPRESS_MIN_BYTES = 256  # Shorter messages barely shrink and are not worth the CPU
+
+    def __init__(self, max_messages):
+        self.system = []
+        self.recent = deque(maxlen=max(1, max_messages))
+        self.bytes = 0     # UTF-8 bytes of message content held
+        self.appended = 0  # Non-system messages ever appended, including dropped ones
+
+    @classmethod
+    def from_messages(cls, messages, hot_messages=None, compression_level=6):
+        """Build a history holding exactly the given Message records"""
+        history = cls(1)
+        history.system = [msg for msg in messages if msg.role == 'system']
+        others = [msg for msg in messages if msg.role != 'system']
+        if hot_messages is not None:
+            cold = max(0, len(others) - hot_messages)
+            others[:cold] = [cls._compress(msg, compression_level) for msg in others[:cold]]
+        history.recent = deque(others, maxlen=max(1, len(others)))
+        history.bytes = sum(msg.size for msg in history.system) + sum(msg.size for msg in others)
+        history.appended = len(others)
+        return history
+
+    @classmethod
+    def _compress(cls, message, level):
+        if message.size < cls.COMPRESS_MIN_BYTES:
+            return message
+        return message.compress(level)
+
+    def _resize(self, max_messages):
+        maxlen = max(1, max_messages - len(self.system))
+        if maxlen != self.recent.maxlen:
+            self.recent = deque(self.recent, maxlen=maxlen)
+            self.bytes = sum(msg.size for msg in self.system) + sum(msg.size for msg in self.recent)
+
+    def append(self, message, max_messages, hot_messages=None, compression_level=6):
+        """Append a Message, dropping the oldest non-system message beyond max_messages
+
         Args:
-            max_conversations: Maximum number of conversations to keep in memory
-            max_messages_per_conversation: Maximum messages per conversation
+            hot_messages: Newest messages kept uncompressed, None disables compression
+            compression_level: zlib level used for messages leaving the hot tail
+
+        Returns:
+            Bytes saved by compressing the message that left the hot tail
+        """
+        if message.role == 'system':
+            self.system.append(message)
+            self.bytes += message.size
+            self._resize(max_messages)
+            return 0
+        self._resize(max_messages)
+        if len(self.recent) == self.recent.maxlen:
+            self.bytes -= self.recent[0].size
+        self.recent.append(message)
+        self.bytes += message.size
+        self.appended += 1
+
+        index = len(self.recent) - 1 - (hot_messages if hot_messages is not None else len(self.recent))
+        if index < 0:
+            return 0
+        cold = self.recent[index]
+        packed = self._compress(cold, compression_level)
+        if packed is cold:
+            return 0
+        # Readers holding views keep the uncompressed record
+        self.recent[index] = packed
+        self.bytes -= cold.size - packed.size
+        return cold.size - packed.size
+
+    def page(self, before=None, limit=50):
+        """Up to limit messages older than the before cursor, oldest first
+
+        Only the requested slice is read, walking from whichever end of the
+        deque is closer. The system prefix comes with the oldest page.
+
+        Returns:
+            (tuple of Message records, cursor of the next older page or None)
+        """
+        recent = self.recent
+        first_seq = self.appended - len(recent)
+        end = len(recent) if before is None else max(0, min(len(recent), before - first_seq))
+        start = max(0, end - limit)
+        if end > len(recent) // 2:
+            page = tuple(itertools.islice(reversed(recent), len(recent) - end, len(recent) - start))[::-1]
+        else:
+            page = tuple(itertools.islice(recent, start, end))
+        if start == 0:
+            return tuple(self.system) + page, None
+        return page, first_seq + start
+
+    def view(self):
+        """Read-only snapshot of the history, system prefix first
+
+        Only references are copied: the tuple shares the Message records
+        and stays valid while writers keep appending.
+        """
+        return tuple(self.system) + tuple(self.recent)
+
+    def __len__(self):
+        return len(self.system) + len(self.recent)
+
+
+class MemoryConversationStore:
+    """Process-local conversation store (default, single worker)
+
+    Conversations are kept in an OrderedDict in least-recently-used order,
+    so touching a conversation and evicting the oldest one are both O(1).
+    Ages use time.monotonic() and the store keeps a running total of message
+    content bytes, so count, byte and TTL limits never scan or sort the store.
+    A second index keeps each owner's conversations in the same order, so
+    listing one owner's conversations never visits anyone else's.
+    """
+
+    def __init__(self, hot_messages=None, compression_level=6):
         """
-        self.conversation_history = {}  # Stores all conversation data
-        self.user_api_keys = {}         # Maps session IDs to API keys
-        self.user_live_search_settings = {}  # Maps session IDs to Live Search settings
-        self.max_conversations = max_conversations
-        self.max_messages_per_conversation = max_messages_per_conversation
-    
-    def sanitize_message(self, message):
-        """Clean and validate message data to ensure proper format and remove invalid data
-        
         Args:
-            message: The message object to sanitize
-            
+            hot_messages: Newest messages per conversation kept uncompressed; older
+                ones are zlib-compressed. None keeps every message uncompressed.
+            compression_level: zlib compression level (1-9)
+        """
+        self.hot_messages = hot_messages
+        self.compression_level = compression_level
+        self.conversations = OrderedDict()  # Maps conversation IDs to conversation data, oldest first
+        self.owner_index = {}               # Maps owners to OrderedDicts of their conversations, oldest first
+        self.session_settings = {}          # Maps socket session IDs to per-client settings
+        self.list_versions = {}             # Maps owners to the version of their conversation list
+        self.total_bytes = 0                # Bytes of message content across all conversations
+        self.stats = {
+            'evicted_conversations': 0,
+            'evicted_bytes': 0,
+            'expired_conversations': 0,
+            'compressed_messages': 0,
+            'compression_saved_bytes': 0
+        }
+
+    @staticmethod
+    def _monotonic(updated_at):
+        """Convert a wall-clock epoch time to the monotonic clock"""
+        if updated_at is None:
+            return time.monotonic()
+        return time.monotonic() - (time.time() - updated_at)
+
+    def has_conversation(self, conversation_id):
+        return conversation_id in self.conversations
+
+    def get_conversation(self, conversation_id):
+        """Get conversation metadata (title, timestamp) or None"""
+        conv = self.conversations.get(conversation_id)
+        if conv is None:
+            return None
+        return {'id': conversation_id, 'title': conv['title'], 'timestamp': conv['timestamp']}
+
+    def get_owner(self, conversation_id):
+        conv = self.conversations.get(conversation_id)
+        return conv['owner'] if conv else None
+
+    def get_messages(self, conversation_id):
+        """Get a read-only tuple of Message records"""
+        conv = self.conversations.get(conversation_id)
+        return conv['history'].view() if conv else ()
+
+    def get_message_page(self, conversation_id, before=None, limit=50):
+        """Get (messages, next cursor) for the page of messages older than before"""
+        conv = self.conversations.get(conversation_id)
+        return conv['history'].page(before, limit) if conv else ((), None)
+
+    def _index(self, conversation_id, conv):
+        """Add a conversation to, or move it to the end of, its owner's index"""
+        if conv['owner'] is not None:
+            owned = self.owner_index.setdefault(conv['owner'], OrderedDict())
+            owned[conversation_id] = conv
+            owned.move_to_end(conversation_id)
+
+    def _unindex(self, conversation_id, conv):
+        owned = self.owner_index.get(conv['owner'])
+        if owned is not None:
+            owned.pop(conversation_id, None)
+            if not owned:
+                del self.owner_index[conv['owner']]
+
+    def touch(self, conversation_id, updated_at=None):
+        """Mark a conversation as recently used"""
+        conv = self.conversations.get(conversation_id)
+        if conv is not None:
+            conv['updated_at'] = self._monotonic(updated_at)
+            self.conversations.move_to_end(conversation_id)
+            self._index(conversation_id, conv)
+
+    def append_message(self, conversation_id, message, max_messages, updated_at=None, owner=None):
+        """Append a message, trimming old non-system messages beyond max_messages
+
+        Args:
+            updated_at: Wall-clock epoch time of the update (log replay), defaults to now
+            owner: Owner of a conversation created by this message
+
         Returns:
-            A cleaned message object or None if invalid
+            True if the message created a new conversation
         """
-        try:
-            if not isinstance(message, dict):
-                logger.warning(f"Invalid message format: {type(message)}")
-                return None
-            
-            # Ensure required fields exist
-            if 'role' not in message or 'content' not in message:
-                logger.warning("Message missing required fields")
-                return None
-            
-            # Clean and validate role field
-            role = str(message.get('role', '')).strip().lower()
-            if role not in ['system', 'user', 'assistant']:
-                logger.warning(f"Invalid message role: {role}")
-                role = 'user'  # Default to user message
-            
-            # Clean content field
-            content = str(message.get('content', '')).strip()
-            if not content:
-                logger.warning("Empty message content")
-                return None
-            
-            # Limit content length
-            if len(content) > 10000:
-                logger.warning(f"Message content too long ({len(content)} chars), truncating")
-                content = content[:10000] + "..."
-            
-            # Create clean message object
-            clean_message = {
-                'role': role,
-                'content': content,
-                'timestamp': message.get('timestamp', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        created = conversation_id not in self.conversations
+        if created:
+            content = message['content']
+            self.conversations[conversation_id] = {
+                'history': MessageHistory(max_messages),
+                'timestamp': message['timestamp'],
+                'title': content[:30] + '...' if len(content) > 30 else content,
+                'owner': owner
             }
-            
-            return clean_message
-        except Exception as e:
-            logger.error(f"Error cleaning message: {str(e)}")
-            return None
-    
-    def cleanup_old_conversations(self):
-        """Remove oldest conversations when limit is reached to save memory"""
-        try:
-            if len(self.conversation_history) > self.max_conversations:
-                # Sort by timestamp and keep only the newest conversations
-                sorted_convs = sorted(
-                    self.conversation_history.items(),
-                    key=lambda x: x[1].get('timestamp', ''),
-                    reverse=True
-                )[:self.max_conversations]
-                # Create new dictionary directly instead of modifying existing one
-                self.conversation_history = {cid: conv for cid, conv in sorted_convs}
-                logger.info(f"Cleaned up old conversations, current count: {len(self.conversation_history)}")
-        except Exception as e:
-            logger.error(f"Error cleaning up old conversations: {str(e)}")
-    
-    def add_message_to_conversation(self, conversation_id, message):
-        """Add a message to conversation, cleaning up old messages if needed
-        
+
+        conv = self.conversations[conversation_id]
+        history = conv['history']
+        size_before = history.bytes
+        saved = history.append(Message.from_dict(message), max_messages, self.hot_messages, self.compression_level)
+        if saved:
+            self.stats['compressed_messages'] += 1
+            self.stats['compression_saved_bytes'] += saved
+        self.total_bytes += history.bytes - size_before
+        # Taken from the message so replaying the conversation log reproduces it
+        conv['timestamp'] = message['timestamp']
+        conv['updated_at'] = self._monotonic(updated_at)
+        self.conversations.move_to_end(conversation_id)
+        self._index(conversation_id, conv)
+        return created
+
+    def _pop(self, conversation_id):
+        conv = self.conversations.pop(conversation_id, None)
+        if conv is not None:
+            self.total_bytes -= conv['history'].bytes
+            self._unindex(conversation_id, conv)
+        return conv
+
+    def delete_conversation(self, conversation_id):
+        return self._pop(conversation_id) is not None
+
+    def list_conversations(self, owner=None):
+        """List conversations oldest first, only those of owner if given"""
+        conversations = self.conversations if owner is None else self.owner_index.get(owner, {})
+        return [
+            {'id': cid, 'title': conv['title'], 'timestamp': conv['timestamp']}
+            for cid, conv in list(conversations.items())
+        ]
+
+    def list_conversation_page(self, owner, cursor=None, limit=50):
+        """List an owner's conversations used before cursor, most recent first
+
+        Walks the owner's index from its newest end without copying it and
+        stops after limit + 1 matches. The caller must hold the lock that
+        serializes writes (SessionManager.write_lock), as the index is
+        iterated in place.
+
         Args:
-            conversation_id: ID of the conversation
-            message: Message object to add
-            
-        Raises:
-            RuntimeError: If message can't be added
+            cursor: [updated_at, id] of the last conversation of the previous page
+
+        Returns:
+            (list of conversations, cursor of the next page or None)
+        """
+        page = []
+        owned = self.owner_index.get(owner)
+        if not owned:
+            return page, None
+        after = tuple(cursor) if cursor is not None else None
+        for cid in reversed(owned):
+            conv = owned[cid]
+            if after is not None and (conv['updated_at'], cid) >= after:
+                continue
+            if len(page) == limit:
+                last_id, last = page[-1]
+                return [self._summary(cid, conv) for cid, conv in page], [last['updated_at'], last_id]
+            page.append((cid, conv))
+        return [self._summary(cid, conv) for cid, conv in page], None
+
+    @staticmethod
+    def _summary(conversation_id, conv):
+        return {'id': conversation_id, 'title': conv['title'], 'timestamp': conv['timestamp']}
+
+    def get_list_version(self, owner):
+        return self.list_versions.get(owner, 0)
+
+    def bump_list_version(self, owner):
+        """Increment and return the version of an owner's conversation list"""
+        version = self.list_versions.get(owner, 0) + 1
+        self.list_versions[owner] = version
+        return version
+
+    def count(self):
+        return len(self.conversations)
+
+    def over_limit(self, max_conversations, max_bytes=None):
+        """Check whether the store exceeds its count or byte limit"""
+        return len(self.conversations) > max_conversations or bool(max_bytes and self.total_bytes > max_bytes)
+
+    def trim_conversations(self, max_conversations, max_bytes=None):
+        """Evict least recently used conversations until both limits hold
+
+        The most recently used conversation is never evicted, even if it alone
+        exceeds max_bytes.
+
+        Returns:
+            List of (conversation ID, owner) pairs of removed conversations
+        """
+        removed = []
+        while len(self.conversations) > 1 and self.over_limit(max_conversations, max_bytes):
+            cid, conv = self.conversations.popitem(last=False)
+            self.total_bytes -= conv['history'].bytes
+            self._unindex(cid, conv)
+            self.stats['evicted_conversations'] += 1
+            self.stats['evicted_bytes'] += conv['history'].bytes
+            removed.append((cid, conv['owner']))
+        return removed
+
+    def delete_expired(self, max_age_seconds):
+        """Delete conversations not updated within max_age_seconds
+
+        Only the expired prefix of the LRU order is visited.
+
+        Returns:
+            List of (conversation ID, owner) pairs of removed conversations
+        """
+        cutoff = time.monotonic() - max_age_seconds
+        removed = []
+        while self.conversations:
+            cid, conv = next(iter(self.conversations.items()))
+            if conv['updated_at'] > cutoff:
+                break
+            self._pop(cid)
+            self.stats['expired_conversations'] += 1
+            removed.append((cid, conv['owner']))
+        return removed
+
+    def export_conversations(self):
+        """Capture every conversation in LRU order for a snapshot
+
+        Messages are exported as views of Message records, which the snapshot
+        writer serializes outside the write lock.
+        """
+        now_wall = time.time()
+        now_monotonic = time.monotonic()
+        return [
+            {
+                'id': cid,
+                'title': conv['title'],
+                'timestamp': conv['timestamp'],
+                'owner': conv['owner'],
+                'updated_at': now_wall - (now_monotonic - conv['updated_at']),
+                'messages': conv['history'].view()
+            }
+            for cid, conv in list(self.conversations.items())
+        ]
+
+    def restore_conversation(self, conversation):
+        """Load one conversation exported by export_conversations"""
+        history = MessageHistory.from_messages(
+            [Message.from_dict(msg) for msg in conversation['messages']], self.hot_messages, self.compression_level
+        )
+        self._pop(conversation['id'])
+        conv = self.conversations[conversation['id']] = {
+            'history': history,
+            'timestamp': conversation['timestamp'],
+            'title': conversation['title'],
+            'owner': conversation.get('owner'),
+            'updated_at': self._monotonic(conversation.get('updated_at'))
+        }
+        self._index(conversation['id'], conv)
+        self.total_bytes += history.bytes
+
+    def get_stats(self):
+        stats = self.stats.copy()
+        stats['conversations'] = len(self.conversations)
+        stats['owners'] = len(self.owner_index)
+        stats['bytes'] = self.total_bytes
+        stats['hot_messages'] = self.hot_messages
+        return stats
+
+    def get_setting(self, sid, name, default=None):
+        return self.session_settings.get(sid, {}).get(name, default)
+
+    def set_setting(self, sid, name, value):
+        self.session_settings.setdefault(sid, {})[name] = value
+
+    def delete_settings(self, sid):
+        self.session_settings.pop(sid, None)
+
+
+class SQLiteConversationStore:
+    """SQLite conversation store shared by every worker process on a node
+
+    Each worker opens its own connection; WAL journaling lets readers and the
+    single writer proceed concurrently. Every per-message operation touches a
+    bounded number of rows (one conversation, at most max_messages messages),
+    so its cost does not grow with the number of stored conversations.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS conversations (
+            id TEXT PRIMARY KEY,
+            title TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            next_seq INTEGER NOT NULL DEFAULT 0,
+            owner TEXT
+        );
+        CREATE INDEX IF NOT EXISTS conversations_updated_at ON conversations (updated_at);
+        CREATE TABLE IF NOT EXISTS messages (
+            conversation_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            PRIMARY KEY (conversation_id, seq)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS session_settings (
+            sid TEXT NOT NULL,
+            name TEXT NOT NULL,
+            value TEXT,
+            PRIMARY KEY (sid, name)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS list_versions (
+            owner TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS store_totals (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path):
+        """Open (or create) the SQLite database
+
+        Args:
+            path: Database file path shared by all workers
+        """
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(self.SCHEMA)
+        # Databases created before conversations had owners
+        if 'owner' not in [row[1] for row in self.conn.execute('PRAGMA table_info(conversations)')]:
+            self.conn.execute('ALTER TABLE conversations ADD COLUMN owner TEXT')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS conversations_owner ON conversations (owner, updated_at)')
+        # API keys are only held in process memory; drop any written by older versions
+        self.conn.execute("DELETE FROM session_settings WHERE name = 'api_key'")
+        # Message bytes are kept as a running total; databases created before it are counted once
+        if not self.conn.execute("SELECT 1 FROM store_totals WHERE name = 'bytes'").fetchall():
+            self.conn.execute(
+                "INSERT OR IGNORE INTO store_totals (name, value) "
+                "SELECT 'bytes', COALESCE(SUM(LENGTH(CAST(content AS BLOB))), 0) FROM messages"
+            )
+        self.lock = threading.Lock()
+        # Counters for this worker only
+        self.stats = {'evicted_conversations': 0, 'expired_conversations': 0}
+
+    def _query(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    @staticmethod
+    def _delete_messages(cur, sql, params):
+        """Run a DELETE on messages inside the caller's transaction, keeping the byte total current"""
+        return sum(row[0] for row in cur.execute(sql + ' RETURNING LENGTH(CAST(content AS BLOB))', params))
+
+    @staticmethod
+    def _add_bytes(cur, delta):
+        if delta:
+            cur.execute("UPDATE store_totals SET value = value + ? WHERE name = 'bytes'", (delta,))
+
+    def has_conversation(self, conversation_id):
+        return bool(self._query('SELECT 1 FROM conversations WHERE id = ?', (conversation_id,)))
+
+    def get_conversation(self, conversation_id):
+        rows = self._query('SELECT title, timestamp FROM conversations WHERE id = ?', (conversation_id,))
+        if not rows:
+            return None
+        return {'id': conversation_id, 'title': rows[0][0], 'timestamp': rows[0][1]}
+
+    def get_owner(self, conversation_id):
+        rows = self._query('SELECT owner FROM conversations WHERE id = ?', (conversation_id,))
+        return rows[0][0] if rows else None
+
+    def get_messages(self, conversation_id):
+        rows = self._query(
+            'SELECT role, content, timestamp FROM messages WHERE conversation_id = ? ORDER BY seq',
+            (conversation_id,)
+        )
+        return tuple(Message(role, content, timestamp) for role, content, timestamp in rows)
+
+    def get_message_page(self, conversation_id, before=None, limit=50):
+        """Get (messages, next cursor) for the page of messages older than before"""
+        rows = self._query(
+            'SELECT seq, role, content, timestamp FROM messages WHERE conversation_id = ? AND seq < ? '
+            'ORDER BY seq DESC LIMIT ?',
+            (conversation_id, before if before is not None else 2 ** 62, limit + 1)
+        )
+        next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+        return tuple(Message(role, content, timestamp) for _, role, content, timestamp in reversed(rows[:limit])), next_cursor
+
+    def touch(self, conversation_id, updated_at=None):
+        """Mark a conversation as recently used"""
+        self._query(
+            'UPDATE conversations SET updated_at = ? WHERE id = ?',
+            (time.time() if updated_at is None else updated_at, conversation_id)
+        )
+
+    def append_message(self, conversation_id, message, max_messages, updated_at=None, owner=None):
+        """Append a message, trimming old non-system messages beyond max_messages
+
+        Args:
+            updated_at: Wall-clock epoch time of the update, defaults to now
+            owner: Owner of a conversation created by this message
+
+        Returns:
+            True if the message created a new conversation
+        """
+        content = message['content']
+        title = content[:30] + '...' if len(content) > 30 else content
+        updated_at = time.time() if updated_at is None else updated_at
+        with self.lock:
+            cur = self.conn.cursor()
+            cur.execute('BEGIN IMMEDIATE')
+            try:
+                cur.execute(
+                    'INSERT OR IGNORE INTO conversations (id, title, timestamp, updated_at, owner) VALUES (?, ?, ?, ?, ?)',
+                    (conversation_id, title, message['timestamp'], updated_at, owner)
+                )
+                created = cur.rowcount == 1
+                seq = cur.execute(
+                    'UPDATE conversations SET next_seq = next_seq + 1, timestamp = ?, updated_at = ? '
+                    'WHERE id = ? RETURNING next_seq',
+                    (message['timestamp'], updated_at, conversation_id)
+                ).fetchone()[0]
+                cur.execute(
+                    'INSERT INTO messages (conversation_id, seq, role, content, timestamp) VALUES (?, ?, ?, ?, ?)',
+                    (conversation_id, seq, message['role'], content, message['timestamp'])
+                )
+                # Keep system messages and the newest user/assistant messages
+                system_count = cur.execute(
+                    "SELECT COUNT(*) FROM messages WHERE conversation_id = ? AND role = 'system'",
+                    (conversation_id,)
+                ).fetchone()[0]
+                keep_count = max(1, max_messages - system_count)
+                freed = self._delete_messages(
+                    cur,
+                    "DELETE FROM messages WHERE conversation_id = ? AND role != 'system' AND seq <= ("
+                    "  SELECT seq FROM messages WHERE conversation_id = ? AND role != 'system' "
+                    "  ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+                    (conversation_id, conversation_id, keep_count)
+                )
+                self._add_bytes(cur, len(content.encode('utf-8')) - freed)
+                cur.execute('COMMIT')
+            except Exception:
+                cur.execute('ROLLBACK')
+                raise
+        return created
+
+    def delete_conversation(self, conversation_id):
+        with self.lock:
+            cur = self.conn.cursor()
+            cur.execute('BEGIN IMMEDIATE')
+            freed = self._delete_messages(cur, 'DELETE FROM messages WHERE conversation_id = ?', (conversation_id,))
+            self._add_bytes(cur, -freed)
+            deleted = cur.execute('DELETE FROM conversations WHERE id = ?', (conversation_id,)).rowcount
+            cur.execute('COMMIT')
+        return deleted > 0
+
+    def list_conversations(self, owner=None):
+        if owner is None:
+            rows = self._query('SELECT id, title, timestamp FROM conversations ORDER BY updated_at')
+        else:
+            rows = self._query(
+                'SELECT id, title, timestamp FROM conversations WHERE owner = ? ORDER BY updated_at', (owner,)
+            )
+        return [{'id': cid, 'title': title, 'timestamp': timestamp} for cid, title, timestamp in rows]
+
+    def list_conversation_page(self, owner, cursor=None, limit=50):
+        """List an owner's conversations used before cursor ([updated_at, id]), most recent first"""
+        if cursor is None:
+            rows = self._query(
+                'SELECT id, title, timestamp, updated_at FROM conversations WHERE owner = ? '
+                'ORDER BY updated_at DESC, id DESC LIMIT ?',
+                (owner, limit + 1)
+            )
+        else:
+            rows = self._query(
+                'SELECT id, title, timestamp, updated_at FROM conversations WHERE owner = ? '
+                'AND (updated_at < ? OR (updated_at = ? AND id < ?)) ORDER BY updated_at DESC, id DESC LIMIT ?',
+                (owner, cursor[0], cursor[0], cursor[1], limit + 1)
+            )
+        next_cursor = [rows[limit - 1][3], rows[limit - 1][0]] if len(rows) > limit else None
+        return [{'id': cid, 'title': title, 'timestamp': timestamp} for cid, title, timestamp, _ in rows[:limit]], next_cursor
+
+    def get_list_version(self, owner):
+        rows = self._query('SELECT version FROM list_versions WHERE owner = ?', (owner,))
+        return rows[0][0] if rows else 0
+
+    def bump_list_version(self, owner):
+        """Increment and return the version of an owner's conversation list (shared by workers)"""
+        return self._query(
+            'INSERT INTO list_versions (owner, version) VALUES (?, 1) '
+            'ON CONFLICT (owner) DO UPDATE SET version = version + 1 RETURNING version',
+            (owner,)
+        )[0][0]
+
+    def count(self):
+        return self._query('SELECT COUNT(*) FROM conversations')[0][0]
+
+    def _delete_where(self, condition, params):
+        """Delete the conversations selected by a WHERE condition and their messages
+
+        Returns:
+            List of (conversation ID, owner) pairs of removed conversations
+        """
+        with self.lock:
+            cur = self.conn.cursor()
+            cur.execute('BEGIN IMMEDIATE')
+            removed = cur.execute(f'SELECT id, owner FROM conversations WHERE {condition}', params).fetchall()
+            freed = 0
+            for cid, _ in removed:
+                freed += self._delete_messages(cur, 'DELETE FROM messages WHERE conversation_id = ?', (cid,))
+                cur.execute('DELETE FROM conversations WHERE id = ?', (cid,))
+            self._add_bytes(cur, -freed)
+            cur.execute('COMMIT')
+        return removed
+
+    def over_limit(self, max_conversations, max_bytes=None):
+        """Check the count limit (max_bytes is ignored: messages live on disk)"""
+        return self.count() > max_conversations
+
+    def trim_conversations(self, max_conversations, max_bytes=None):
+        removed = self._delete_where(
+            'id IN (SELECT id FROM conversations ORDER BY updated_at DESC LIMIT -1 OFFSET ?)',
+            (max_conversations,)
+        )
+        self.stats['evicted_conversations'] += len(removed)
+        return removed
+
+    def delete_expired(self, max_age_seconds):
+        removed = self._delete_where('updated_at < ?', (time.time() - max_age_seconds,))
+        self.stats['expired_conversations'] += len(removed)
+        return removed
+
+    def get_stats(self):
+        stats = self.stats.copy()
+        stats['conversations'] = self.count()
+        # No 'owners' count: it would scan every conversation row on each /metrics scrape
+        stats['bytes'] = self._query("SELECT value FROM store_totals WHERE name = 'bytes'")[0][0]
+        return stats
+
+    def get_setting(self, sid, name, default=None):
+        rows = self._query('SELECT value FROM session_settings WHERE sid = ? AND name = ?', (sid, name))
+        return json.loads(rows[0][0]) if rows else default
+
+    def set_setting(self, sid, name, value):
+        self._query(
+            'INSERT OR REPLACE INTO session_settings (sid, name, value) VALUES (?, ?, ?)',
+            (sid, name, json.dumps(value))
+        )
+
+    def delete_settings(self, sid):
+        self._query('DELETE FROM session_settings WHERE sid = ?', (sid,))
+
+
+class ConversationLog:
+    """Write-ahead, append-only on-disk log of conversation events
+
+    Every event is one JSON line appended to ``wal.<generation>.log``.
+    A snapshot rotates to a new generation, writes the compacted state to
+    ``snapshot.jsonl`` (one conversation per line) and drops older WAL files.
+    Recovery mmap-reads the snapshot and replays the WAL tail.
+    """
+
+    SNAPSHOT_FILE = 'snapshot.jsonl'
+
+    def __init__(self, directory, snapshot_every=10000, fsync=False):
+        """Open the log directory
+
+        Args:
+            directory: Directory holding the snapshot and WAL files
+            snapshot_every: Number of logged events that triggers a new snapshot
+            fsync: fsync after every event (survives power loss, not only crashes)
+        """
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.fsync = fsync
+        self.generation = 0
+        self.file = None
+        self.events_since_snapshot = 0
+        self.snapshot_running = False
+        self.last_snapshot = None
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _wal_path(self, generation):
+        return os.path.join(self.directory, f"wal.{generation:08d}.log")
+
+    def _wal_generations(self):
+        generations = []
+        for name in os.listdir(self.directory):
+            if name.startswith('wal.') and name.endswith('.log'):
+                try:
+                    generations.append(int(name[4:-4]))
+                except ValueError:
+                    continue
+        return sorted(generations)
+
+    @staticmethod
+    def _read_lines(path):
+        """Yield (end_offset, line) for every line of a file through mmap"""
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                while True:
+                    line = m.readline()
+                    if not line:
+                        break
+                    yield m.tell(), line
+
+    def recover(self, restore_conversation, apply_event):
+        """Rebuild state from the latest snapshot and the WAL tail
+
+        Args:
+            restore_conversation: Callback receiving each snapshot conversation
+            apply_event: Callback receiving each WAL event after the snapshot
+
+        Returns:
+            Dictionary with the number of restored conversations and replayed events
+        """
+        restored = 0
+        replayed = 0
+        snapshot_generation = 0
+
+        snapshot_path = os.path.join(self.directory, self.SNAPSHOT_FILE)
+        if os.path.exists(snapshot_path):
+            lines = self._read_lines(snapshot_path)
+            for _, line in lines:
+                header = json.loads(line)
+                snapshot_generation = header['wal_generation']
+                break
+            for _, line in lines:
+                restore_conversation(json.loads(line))
+                restored += 1
+
+        generations = [g for g in self._wal_generations() if g >= snapshot_generation]
+        for generation in generations:
+            path = self._wal_path(generation)
+            good_offset = 0
+            for offset, line in self._read_lines(path):
+                if not line.endswith(b'\n'):
+                    # Torn write from a crash mid-append
+                    logger.warning(f"Ignoring incomplete record at end of {path}")
+                    break
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    logger.warning(f"Ignoring corrupt record at end of {path}")
+                    break
+                apply_event(event)
+                replayed += 1
+                good_offset = offset
+            if good_offset != os.path.getsize(path):
+                # Drop the torn tail so new appends start on a clean line
+                with open(path, 'r+b') as f:
+                    f.truncate(good_offset)
+
+        self.generation = max(generations[-1] if generations else 0, snapshot_generation)
+        self.file = open(self._wal_path(self.generation), 'ab')
+        self.events_since_snapshot = replayed
+        return {'restored_conversations': restored, 'replayed_events': replayed}
+
+    def append(self, event):
+        """Append one event to the current WAL file"""
+        line = json.dumps(event, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+            self.events_since_snapshot += 1
+
+    def should_snapshot(self):
+        return self.events_since_snapshot >= self.snapshot_every and not self.snapshot_running
+
+    def rotate(self):
+        """Start a new WAL generation, returning its number
+
+        Must be called while writers are paused so the snapshot taken right
+        after covers exactly the events of older generations.
+        """
+        with self.lock:
+            self.file.close()
+            self.generation += 1
+            self.file = open(self._wal_path(self.generation), 'ab')
+            self.events_since_snapshot = 0
+            return self.generation
+
+    def write_snapshot(self, generation, conversations):
+        """Write a compacted snapshot and remove the WAL files it covers"""
+        path = os.path.join(self.directory, self.SNAPSHOT_FILE)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(json.dumps({'wal_generation': generation, 'conversations': len(conversations)}).encode('utf-8') + b'\n')
+            for conversation in conversations:
+                f.write(json.dumps(
+                    conversation, ensure_ascii=False, separators=(',', ':'), default=Message.to_dict
+                ).encode('utf-8') + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        for old_generation in self._wal_generations():
+            if old_generation < generation:
+                os.remove(self._wal_path(old_generation))
+        self.last_snapshot = datetime.now().isoformat()
+
+    def get_stats(self):
+        return {
+            'directory': self.directory,
+            'generation': self.generation,
+            'events_since_snapshot': self.events_since_snapshot,
+            'snapshot_every': self.snapshot_every,
+            'last_snapshot': self.last_snapshot
+        }
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+
+def create_conversation_store():
+    """Create the conversation store selected by CONVERSATION_STORE (memory or sqlite)"""
+    backend = os.getenv('CONVERSATION_STORE', 'memory').lower()
+    if backend == 'sqlite':
+        path = os.getenv('CONVERSATION_DB_PATH', 'conversations.db')
+        logger.info(f"Using SQLite conversation store: {path}")
+        return SQLiteConversationStore(path)
+    if backend != 'memory':
+        logger.warning(f"Unknown CONVERSATION_STORE '{backend}', falling back to memory")
+    if os.getenv('HISTORY_COMPRESSION', 'False').lower() == 'true':
+        return MemoryConversationStore(
+            hot_messages=int(os.getenv('HISTORY_HOT_MESSAGES', '8')),
+            compression_level=int(os.getenv('HISTORY_COMPRESSION_LEVEL', '6'))
+        )
+    return MemoryConversationStore()
+
+
+# Session management for chats, API keys and settings
+# Storage is delegated to a pluggable backend so several workers can share it
+class SessionManager:
+    def __init__(self, max_conversations=50, max_messages_per_conversation=30, store=None, log=None,
+                 max_history_bytes=None, conversation_ttl=24 * 3600, history_page_size=50, message_page_size=50):
+        """Initialize the session manager with memory limits
+        
+        Args:
+            max_conversations: Maximum number of conversations to keep in memory
+            max_messages_per_conversation: Maximum messages per conversation
+            store: Conversation storage backend (defaults to process-local memory)
+            log: Optional ConversationLog persisting the memory store across restarts
+            max_history_bytes: Optional limit on message content bytes across all conversations
+            conversation_ttl: Seconds after its last use before a conversation expires
+            history_page_size: Maximum conversations per page of the conversation list
+            message_page_size: Maximum messages per page of a conversation
+        """
+        self.store = store or MemoryConversationStore()
+        self.max_conversations = max_conversations
+        self.max_messages_per_conversation = max_messages_per_conversation
+        self.max_history_bytes = max_history_bytes or None
+        self.conversation_ttl = conversation_ttl
+        self.history_page_size = history_page_size
+        self.message_page_size = message_page_size
+        if log is not None and not hasattr(self.store, 'export_conversations'):
+            logger.warning(f"{type(self.store).__name__} is already persistent, conversation log disabled")
+            log = None
+        self.log = log
+        # Serializes log writes with store updates so snapshots line up with WAL generations
+        self.write_lock = threading.RLock()
+        # Called as publish_history(owner, version, changes) after an owner's conversation list changes
+        self.publish_history = None
+        # Called as forget_conversation(conversation_id) for every deleted, evicted or expired conversation
+        self.forget_conversation = None
+        # Maps socket session IDs to API keys; never written to the store, so keys don't reach disk
+        self.api_keys = {}
+
+    @staticmethod
+    def owner_for_key(api_key):
+        """Owner of the conversations created with an API key (only a digest of the key is kept)"""
+        return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16] if api_key else None
+
+    def _publish(self, owner, changes):
+        """Bump an owner's list version and hand the changes to publish_history"""
+        if owner is None:
+            return
+        version = self.store.bump_list_version(owner)
+        if self.publish_history:
+            try:
+                self.publish_history(owner, version, changes)
+            except Exception as e:
+                log_exception(e, "Error publishing conversation list changes")
+
+    def _publish_deletes(self, removed):
+        """Publish delete changes for (conversation ID, owner) pairs, grouped by owner
+
+        Also drops state kept for the conversations outside the store (see forget_conversation).
+        """
+        by_owner = defaultdict(list)
+        for conversation_id, owner in removed:
+            by_owner[owner].append({'op': 'delete', 'id': conversation_id})
+            if self.forget_conversation:
+                self.forget_conversation(conversation_id)
+        for owner, changes in by_owner.items():
+            self._publish(owner, changes)
+    
+    def sanitize_message(self, message):
+        """Clean and validate message data to ensure proper format and remove invalid data
+        
+        Args:
+            message: The message object to sanitize
+            
+        Returns:
+            A cleaned message object or None if invalid
+        """
+        try:
+            if not isinstance(message, dict):
+                logger.warning(f"Invalid message format: {type(message)}")
+                return None
+            
+            # Ensure required fields exist
+            if 'role' not in message or 'content' not in message:
+                logger.warning("Message missing required fields")
+                return None
+            
+            # Clean and validate role field
+            role = str(message.get('role', '')).strip().lower()
+            if role not in ['system', 'user', 'assistant']:
+                logger.warning(f"Invalid message role: {role}")
+                role = 'user'  # Default to user message
+            
+            # Clean content field
+            content = str(message.get('content', '')).strip()
+            if not content:
+                logger.warning("Empty message content")
+                return None
+            
+            # Limit content length
+            if len(content) > 10000:
+                logger.warning(f"Message content too long ({len(content)} chars), truncating")
+                content = content[:10000] + "..."
+            
+            # Create clean message object
+            clean_message = {
+                'role': role,
+                'content': content,
+                'timestamp': message.get('timestamp', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            }
+            
+            return clean_message
+        except Exception as e:
+            logger.error(f"Error cleaning message: {str(e)}")
+            return None
+    
+    def _log_deletes(self, conversation_ids):
+        if self.log and conversation_ids:
+            self.log.append({'op': 'delete', 'ids': list(conversation_ids)})
+    
+    def cleanup_old_conversations(self):
+        """Evict least recently used conversations when a limit is reached to save memory"""
+        try:
+            with self.write_lock:
+                removed = self.store.trim_conversations(self.max_conversations, self.max_history_bytes)
+                self._log_deletes([cid for cid, _ in removed])
+            if removed:
+                self._publish_deletes(removed)
+                logger.info(f"Evicted {len(removed)} conversations, current count: {self.get_conversation_count()}")
+        except Exception as e:
+            logger.error(f"Error cleaning up old conversations: {str(e)}")
+    
+    def add_message_to_conversation(self, conversation_id, message, owner=None):
+        """Add a message to conversation, cleaning up old messages if needed
+        
+        Args:
+            conversation_id: ID of the conversation
+            message: Message object to add
+            owner: Owner of the conversation if the message creates it
+            
+        Raises:
+            RuntimeError: If message can't be added
+        """
+        try:
+            # Clean the message data
+            clean_message = self.sanitize_message(message)
+            if not clean_message:
+                logger.warning(f"Skipping invalid message for conversation: {conversation_id}")
+                return
+            
+            with self.write_lock:
+                # Write-ahead: the event is on disk before the store changes
+                if self.log:
+                    self.log.append({
+                        'op': 'append', 'id': conversation_id, 'message': clean_message, 'at': time.time(),
+                        'owner': owner
+                    })
+                created = self.store.append_message(
+                    conversation_id, clean_message, self.max_messages_per_conversation, owner=owner
+                )
+                logger.debug(f"Message added to conversation {conversation_id}")
+                
+                # Only a new conversation can exceed the count limit, any message the byte limit
+                if (created or self.max_history_bytes) and self.store.over_limit(
+                        self.max_conversations, self.max_history_bytes):
+                    self.cleanup_old_conversations()
+            
+            # Only this conversation's entry changed: send it instead of the whole list
+            conversation = self.store.get_conversation(conversation_id)
+            if conversation is not None:
+                self._publish(self.store.get_owner(conversation_id), [
+                    {'op': 'add' if created else 'update', 'conversation': conversation}
+                ])
+            
+            if self.log and self.log.should_snapshot():
+                self.log.snapshot_running = True
+                socketio.start_background_task(self.snapshot)
+                
+        except Exception as e:
+            error_trace = log_exception(e, f"Error adding message to conversation {conversation_id}")
+            raise RuntimeError(f"Failed to add message to conversation: {str(e)}")
+    
+    def get_conversation_messages(self, conversation_id):
+        """Get messages for a specific conversation
+        
+        Args:
+            conversation_id: ID of the conversation
+            
+        Returns:
+            Read-only tuple of Message records, empty if conversation doesn't exist
+        """
+        try:
+            return self.store.get_messages(conversation_id)
+        except Exception as e:
+            logger.error(f"Error getting conversation messages: {str(e)}")
+            return ()
+    
+    def has_conversation(self, conversation_id, owner=None):
+        """Check whether a conversation exists (and belongs to owner, if given)"""
+        if owner is not None:
+            return self.store.get_owner(conversation_id) == owner
+        return self.store.has_conversation(conversation_id)
+    
+    def touch_conversation(self, conversation_id):
+        """Mark a conversation as recently used so it is evicted last"""
+        with self.write_lock:
+            if self.log:
+                self.log.append({'op': 'touch', 'id': conversation_id, 'at': time.time()})
+            self.store.touch(conversation_id)
+    
+    def delete_conversation(self, conversation_id, owner=None):
+        """Delete a conversation (only if it belongs to owner, if given), returning True if it existed"""
+        with self.write_lock:
+            conversation_owner = self.store.get_owner(conversation_id)
+            if owner is not None and conversation_owner != owner:
+                return False
+            deleted = self.store.delete_conversation(conversation_id)
+            if deleted:
+                self._log_deletes([conversation_id])
+        if deleted:
+            self._publish_deletes([(conversation_id, conversation_owner)])
+        return deleted
+    
+    def list_conversations(self, owner=None):
+        """Get id, title and timestamp of every stored conversation, or only those of owner"""
+        return self.store.list_conversations(owner)
+    
+    def _page_limit(self, limit, maximum):
+        try:
+            return max(1, min(int(limit), maximum)) if limit is not None else maximum
+        except (TypeError, ValueError):
+            return maximum
+    
+    def get_history(self, owner, cursor=None, limit=None):
+        """Get one page of an owner's conversation list, most recently used first
+        
+        The first page (no cursor) carries the list version and starts a full
+        resync; later pages only extend the list towards older conversations.
+        """
+        # Read the version first: a change racing with the listing is at worst re-applied
+        version = self.store.get_list_version(owner)
+        with self.write_lock:
+            conversations, next_cursor = self.store.list_conversation_page(
+                owner, cursor, self._page_limit(limit, self.history_page_size)
+            )
+        return {'conversations': conversations, 'version': version, 'cursor': cursor, 'next_cursor': next_cursor}
+    
+    def get_message_page(self, conversation_id, before=None, limit=None):
+        """Get one page of a conversation's messages, oldest first, and the cursor of the page before it"""
+        try:
+            return self.store.get_message_page(
+                conversation_id, before, self._page_limit(limit, self.message_page_size)
+            )
+        except Exception as e:
+            logger.error(f"Error getting conversation messages: {str(e)}")
+            return (), None
+            
+    def get_conversation_count(self):
+        """Get the current number of conversations"""
+        return self.store.count()
+    
+    def get_stats(self):
+        """Get store size, limits and eviction counters"""
+        stats = self.store.get_stats()
+        stats.update({
+            'max_conversations': self.max_conversations,
+            'max_history_bytes': self.max_history_bytes,
+            'conversation_ttl': self.conversation_ttl
+        })
+        return stats
+    
+    def get_api_key(self, sid):
+        """Get the API key registered by a socket session"""
+        return self.api_keys.get(sid)
+    
+    def set_api_key(self, sid, api_key):
+        """Register the API key for a socket session (process memory only)"""
+        self.api_keys[sid] = api_key
+    
+    def get_current_conversation(self, sid):
+        """Get the ID of the conversation a socket session is writing to"""
+        return self.store.get_setting(sid, 'conversation_id')
+    
+    def set_current_conversation(self, sid, conversation_id):
+        """Switch a socket session to another conversation"""
+        self.store.set_setting(sid, 'conversation_id', conversation_id)
+    
+    def get_live_search_enabled(self, sid):
+        """Get the Live Search setting of a socket session"""
+        return bool(self.store.get_setting(sid, 'live_search_enabled', False))
+    
+    def set_live_search_enabled(self, sid, enabled):
+        """Set the Live Search setting of a socket session"""
+        self.store.set_setting(sid, 'live_search_enabled', bool(enabled))
+    
+    def clear_client(self, sid):
+        """Forget all settings of a disconnected socket session"""
+        self.api_keys.pop(sid, None)
+        self.store.delete_settings(sid)
+        
+    def clear_old_data(self):
+        """Periodically clean up expired data (conversations unused for conversation_ttl seconds)"""
+        try:
+            with self.write_lock:
+                removed = self.store.delete_expired(self.conversation_ttl)
+                self._log_deletes([cid for cid, _ in removed])
+            if removed:
+                self._publish_deletes(removed)
+                logger.info(f"Cleared {len(removed)} expired conversations")
+        except Exception as e:
+            logger.error(f"Error clearing expired data: {str(e)}")
+    
+    def _replay_event(self, event):
+        """Apply one conversation log event to the store during recovery"""
+        if event['op'] == 'append':
+            self.store.append_message(
+                event['id'], event['message'], self.max_messages_per_conversation, updated_at=event.get('at'),
+                owner=event.get('owner')
+            )
+        elif event['op'] == 'touch':
+            self.store.touch(event['id'], updated_at=event.get('at'))
+        elif event['op'] == 'delete':
+            for conversation_id in event['ids']:
+                self.store.delete_conversation(conversation_id)
+    
+    def recover(self):
+        """Rebuild conversations from the on-disk log after a restart"""
+        if not self.log:
+            return None
+        started = time.perf_counter()
+        with self.write_lock:
+            stats = self.log.recover(self.store.restore_conversation, self._replay_event)
+        stats['seconds'] = round(time.perf_counter() - started, 3)
+        logger.info(
+            f"Recovered {stats['restored_conversations']} conversations from snapshot and "
+            f"replayed {stats['replayed_events']} log events in {stats['seconds']}s"
+        )
+        return stats
+    
+    def snapshot(self):
+        """Write a compacted snapshot of the store and truncate the log"""
+        if not self.log:
+            return
+        try:
+            self.log.snapshot_running = True
+            with self.write_lock:
+                generation = self.log.rotate()
+                conversations = self.store.export_conversations()
+            # Serialization happens outside the lock, writers keep going
+            self.log.write_snapshot(generation, conversations)
+            logger.info(f"Conversation snapshot written: {len(conversations)} conversations, generation {generation}")
+        except Exception as e:
+            log_exception(e, "Error writing conversation snapshot")
+        finally:
+            self.log.snapshot_running = False
+
+# Initialize session manager with smaller defaults for cloud environment
+session_manager = SessionManager(
+    max_conversations=int(os.getenv('MAX_CONVERSATIONS', '50')),
+    max_messages_per_conversation=int(os.getenv('MAX_MESSAGES_PER_CONVERSATION', '30')),
+    max_history_bytes=int(os.getenv('MAX_HISTORY_BYTES', '0')),
+    conversation_ttl=int(os.getenv('CONVERSATION_TTL', str(24 * 3600))),
+    history_page_size=int(os.getenv('HISTORY_PAGE_SIZE', '50')),
+    message_page_size=int(os.getenv('MESSAGE_PAGE_SIZE', '50')),
+    store=create_conversation_store(),
+    log=ConversationLog(
+        os.getenv('CONVERSATION_LOG_DIR'),
+        snapshot_every=int(os.getenv('CONVERSATION_SNAPSHOT_EVERY', '10000')),
+        fsync=os.getenv('CONVERSATION_LOG_FSYNC', 'False').lower() == 'true'
+    ) if os.getenv('CONVERSATION_LOG_DIR') else None
+)
+session_manager.recover()
+
+# Background task to clean up old data
+def cleanup_task():
+    """Background task to clean up old data"""
+    while True:
+        try:
+            session_manager.clear_old_data()
+            batch_runner.delete_expired()
+            socketio.sleep(3600)  # Run every hour
+        except Exception as e:
+            logger.error(f"Error in cleanup task: {str(e)}")
+            socketio.sleep(60)  # Wait 1 minute before retrying if error occurs
+
+cleanup_started = False
+cleanup_lock = threading.Lock()
+
+@app.before_request
+def start_cleanup_task():
+    """Start cleanup_task once per process
+
+    Runs on the first HTTP request or Socket.IO connection: under gunicorn
+    (Procfile, render.yaml) the module is imported and the __main__ block
+    that used to start the task never runs.
+    """
+    global cleanup_started
+    if cleanup_started:
+        return
+    with cleanup_lock:
+        if cleanup_started:
+            return
+        cleanup_started = True
+    socketio.start_background_task(cleanup_task)
+
+CROCKFORD_BASE32 = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+
+def new_conversation_id():
+    """Create a collision-free conversation ID that sorts by creation time
+
+    Uses the ULID layout: 48 bits of Unix milliseconds followed by 80 random
+    bits, written as 26 Crockford base32 characters.
+    """
+    value = (int(time.time() * 1000) << 80) | int.from_bytes(os.urandom(10), 'big')
+    return ''.join(CROCKFORD_BASE32[(value >> shift) & 31] for shift in range(125, -1, -5))
+
+def get_conversation_id(owner):
+    """Get the calling socket's current conversation ID, starting a new conversation if it has none
+
+    Kept with the socket's settings: with manage_session=False, changes to the
+    Flask session inside Socket.IO handlers are not kept between events.
+    A stored conversation that belongs to another owner (the socket switched
+    API keys) is not continued; a new one is started instead.
+    """
+    conversation_id = session_manager.get_current_conversation(request.sid)
+    if conversation_id is not None and session_manager.has_conversation(conversation_id) \
+            and not session_manager.has_conversation(conversation_id, owner):
+        conversation_id = None
+    if conversation_id is None:
+        conversation_id = new_conversation_id()
+        session_manager.set_current_conversation(request.sid, conversation_id)
+    return conversation_id
+
+# ===== Request Tracing =====
+class Span:
+    """One timed step of a traced request"""
+    __slots__ = ('span_id', 'parent_id', 'name', 'start', 'end', 'attributes')
+
+    def __init__(self, span_id, parent_id, name, start, end, attributes):
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.start = start
+        self.end = end
+        self.attributes = attributes
+
+    def to_dict(self, trace_start):
+        return {
+            'name': self.name,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'offset_ms': round((self.start - trace_start) * 1000, 3),
+            'duration_ms': round((self.end - self.start) * 1000, 3),
+            'attributes': self.attributes
+        }
+
+
+class Trace:
+    """Spans of one request, rooted at the span covering the whole request
+
+    A trace is only ever active in one thread at a time (the Socket.IO
+    handler, then the message worker), so spans are appended without a lock.
+    """
+    __slots__ = ('tracer', 'trace_id', 'root', 'spans', 'stack')
+
+    def __init__(self, tracer, trace_id, root_id, name, attributes, recording):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.root = Span(root_id, None, name, time.time(), None, attributes)
+        self.spans = [] if recording else None  # None when tracing is disabled
+        self.stack = [root_id]                  # Open span IDs, innermost last
+
+    def add_span(self, name, start, end=None, **attributes):
+        """Record a span that was timed by the caller (end defaults to now)"""
+        if self.spans is None:
+            return
+        self.spans.append(Span(self.tracer.new_span_id(), self.stack[-1], name, start,
+                               time.time() if end is None else end, attributes))
+
+    def to_dict(self):
+        start = self.root.start
+        end = self.root.end or time.time()
+        return {
+            'trace_id': self.trace_id,
+            'name': self.root.name,
+            'start': datetime.fromtimestamp(start).isoformat(),
+            'duration_ms': round((end - start) * 1000, 3),
+            'attributes': self.root.attributes,
+            'spans': [span.to_dict(start) for span in sorted(self.spans or (), key=lambda span: span.start)]
+        }
+
+
+class OTLPExporter:
+    """Batch finished traces to an OTLP/HTTP collector using the JSON encoding
+
+    Export runs on a background task; when the collector is slow or down the
+    oldest unsent traces are dropped instead of blocking requests.
+    """
+
+    def __init__(self, endpoint, service_name='grok-chat', interval=5, max_pending=1000):
+        """
+        Args:
+            endpoint: Collector traces URL, e.g. http://localhost:4318/v1/traces
+            service_name: service.name resource attribute
+            interval: Seconds between export batches
+            max_pending: Maximum finished traces waiting for export
+        """
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.interval = interval
+        self.pending = deque(maxlen=max_pending)
+        self.started = False
+        self.stats = {'exported': 0, 'failed': 0}
+        self.lock = threading.Lock()
+
+    def submit(self, trace):
+        with self.lock:
+            self.pending.append(trace)
+            if self.started:
+                return
+            self.started = True
+        # Started lazily so the task uses the async mode's own primitives
+        socketio.start_background_task(self._export_loop)
+
+    @staticmethod
+    def _attributes(attributes):
+        encoded = []
+        for key, value in attributes.items():
+            if isinstance(value, bool):
+                encoded.append({'key': key, 'value': {'boolValue': value}})
+            elif isinstance(value, int):
+                encoded.append({'key': key, 'value': {'intValue': str(value)}})
+            elif isinstance(value, float):
+                encoded.append({'key': key, 'value': {'doubleValue': value}})
+            else:
+                encoded.append({'key': key, 'value': {'stringValue': str(value)}})
+        return encoded
+
+    def _encode_span(self, trace_id, span):
+        encoded = {
+            'traceId': trace_id,
+            'spanId': span.span_id,
+            'name': span.name,
+            'kind': 1,  # SPAN_KIND_INTERNAL
+            'startTimeUnixNano': str(int(span.start * 1e9)),
+            'endTimeUnixNano': str(int(span.end * 1e9)),
+            'attributes': self._attributes(span.attributes),
+            'status': {'code': 2 if 'error' in span.attributes else 1}
+        }
+        if span.parent_id:
+            encoded['parentSpanId'] = span.parent_id
+        return encoded
+
+    def encode(self, traces):
+        """Build an OTLP ExportTraceServiceRequest body"""
+        spans = [
+            self._encode_span(trace.trace_id, span)
+            for trace in traces for span in [trace.root] + (trace.spans or [])
+        ]
+        return {'resourceSpans': [{
+            'resource': {'attributes': self._attributes({'service.name': self.service_name})},
+            'scopeSpans': [{'scope': {'name': 'chat'}, 'spans': spans}]
+        }]}
+
+    def _export_loop(self):
+        while True:
+            socketio.sleep(self.interval)
+            with self.lock:
+                traces = list(self.pending)
+                self.pending.clear()
+            if not traces:
+                continue
+            try:
+                response = requests.post(self.endpoint, json=self.encode(traces), timeout=5)
+                response.raise_for_status()
+                self.stats['exported'] += len(traces)
+            except Exception as e:
+                self.stats['failed'] += len(traces)
+                logger.warning(f"Trace export to {self.endpoint} failed: {str(e)}")
+
+    def get_stats(self):
+        with self.lock:
+            stats = self.stats.copy()
+            stats['pending'] = len(self.pending)
+        stats['endpoint'] = self.endpoint
+        return stats
+
+
+class Tracer:
+    """Lightweight per-request tracing with a ring buffer of recent traces
+
+    Trace IDs are a random per-process prefix plus a counter, so they are
+    unique across workers, cheap to generate and usable as W3C/OTLP IDs.
+    """
+
+    def __init__(self, enabled=True, buffer_size=200, exporter=None):
+        """
+        Args:
+            enabled: Record spans; when disabled traces still provide request IDs
+            buffer_size: Number of finished traces kept for /api/traces
+            exporter: Optional OTLPExporter receiving finished traces
+        """
+        self.enabled = enabled
+        self.exporter = exporter
+        self.recent = deque(maxlen=buffer_size)
+        self.process_id = random.getrandbits(64) | 1
+        self.trace_ids = itertools.count(1)
+        self.span_ids = itertools.count(1)
+        self.local = threading.local()
+
+    def new_span_id(self):
+        return f'{next(self.span_ids):016x}'
+
+    def start_trace(self, name, **attributes):
+        return Trace(self, f'{self.process_id:016x}{next(self.trace_ids):016x}', self.new_span_id(),
+                     name, attributes, self.enabled)
+
+    @contextlib.contextmanager
+    def activate(self, trace):
+        """Make trace the current trace of this thread"""
+        previous = getattr(self.local, 'trace', None)
+        self.local.trace = trace
+        try:
+            yield trace
+        finally:
+            self.local.trace = previous
+
+    def current(self):
+        return getattr(self.local, 'trace', None)
+
+    def current_id(self):
+        """ID of the current trace, or a fresh ID outside a traced request"""
+        trace = self.current()
+        return trace.trace_id if trace is not None else f'{self.process_id:016x}{next(self.trace_ids):016x}'
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        """Time a block as a span of the current trace
+
+        Yields the span's attribute dictionary so the block can add results.
+        Outside a traced request this only yields a throwaway dictionary.
+        """
+        trace = self.current()
+        if trace is None or trace.spans is None:
+            yield attributes
+            return
+        span_id = self.new_span_id()
+        span = Span(span_id, trace.stack[-1], name, time.time(), None, attributes)
+        trace.stack.append(span_id)
+        try:
+            yield attributes
+        except BaseException as e:
+            attributes['error'] = type(e).__name__
+            raise
+        finally:
+            trace.stack.pop()
+            span.end = time.time()
+            trace.spans.append(span)
+
+    def finish(self, trace, **attributes):
+        """End the root span and keep the trace for /api/traces and export"""
+        if trace.spans is None or trace.root.end is not None:
+            return
+        trace.root.end = time.time()
+        trace.root.attributes.update(attributes)
+        self.recent.append(trace)
+        if self.exporter:
+            self.exporter.submit(trace)
+
+    def get_traces(self, limit=50):
+        """Most recent finished traces, newest first"""
+        return [trace.to_dict() for trace in list(self.recent)[:-limit - 1:-1]]
+
+    def get_trace(self, trace_id):
+        for trace in list(self.recent):
+            if trace.trace_id == trace_id:
+                return trace.to_dict()
+        return None
+
+    def get_stats(self):
+        return {
+            'enabled': self.enabled,
+            'buffered': len(self.recent),
+            'buffer_size': self.recent.maxlen,
+            'exporter': self.exporter.get_stats() if self.exporter else None
+        }
+
+
+tracer = Tracer(
+    enabled=os.getenv('TRACING', 'True').lower() == 'true',
+    buffer_size=int(os.getenv('TRACE_BUFFER_SIZE', '200')),
+    exporter=OTLPExporter(
+        os.getenv('OTLP_ENDPOINT'),
+        service_name=os.getenv('OTEL_SERVICE_NAME', 'grok-chat')
+    ) if os.getenv('OTLP_ENDPOINT') else None
+)
+request_log_filter.tracer = tracer
+
+# ===== Message Job Queue =====
+class MessageJob:
+    """One queued send_message request"""
+    __slots__ = ('sid', 'request_id', 'func', 'args', 'submitted', 'cancelled')
+
+    def __init__(self, sid, request_id, func, args):
+        self.sid = sid
+        self.request_id = request_id
+        self.func = func
+        self.args = args
+        self.submitted = time.monotonic()
+        self.cancelled = False
+
+
+class MessageJobQueue:
+    """Bounded queue of send_message jobs served by a fixed worker pool
+
+    Socket.IO handlers only validate and enqueue, so a spike of messages
+    cannot pile up an unbounded number of blocked handler threads. When the
+    queue is full the client is told immediately instead of stalling, queued
+    clients are told their position as the queue advances, and jobs of a
+    disconnected client are dropped.
+    """
+
+    def __init__(self, workers=16, max_queue=100):
+        """
+        Args:
+            workers: Number of jobs processed concurrently
+            max_queue: Maximum jobs waiting for a worker
+        """
+        self.workers = workers
+        self.max_queue = max_queue
+        self.pending = deque()
+        self.running = set()
+        self.started = False
+        self.wait_times = LatencyHistogram()  # Seconds from submit to start of each job
+        self.stats = {'submitted': 0, 'rejected': 0, 'cancelled': 0, 'completed': 0, 'failed': 0}
+        self.cond = threading.Condition()
+
+    def _start_workers(self):
+        # Started lazily so workers use the async mode's own primitives
+        self.started = True
+        for _ in range(self.workers):
+            socketio.start_background_task(self._worker)
+
+    def submit(self, sid, request_id, func, *args):
+        """Queue func(job, *args) for a worker
+
+        Returns:
+            Number of jobs ahead of this one (0 if a worker picks it up right away), or None if the queue is full
+        """
+        with self.cond:
+            if not self.started:
+                self._start_workers()
+            # Jobs an idle worker is about to pick up do not count against max_queue
+            idle = self.workers - len(self.running)
+            if len(self.pending) >= self.max_queue + idle:
+                self.stats['rejected'] += 1
+                return None
+            self.pending.append(MessageJob(sid, request_id, func, args))
+            self.stats['submitted'] += 1
+            position = max(0, len(self.pending) - idle)
+            self.cond.notify()
+        return position
+
+    def cancel(self, sid):
+        """Drop queued jobs of a socket session and flag its running jobs
+
+        Every submitted job gets exactly one outcome: dropped jobs count as
+        cancelled here, flagged running jobs when their worker finishes.
+        """
+        with self.cond:
+            for job in [job for job in self.pending if job.sid == sid]:
+                self.pending.remove(job)
+                job.cancelled = True
+                self.stats['cancelled'] += 1
+            for job in self.running:
+                if job.sid == sid:
+                    job.cancelled = True
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                job = self.pending.popleft()
+                self.running.add(job)
+                self.wait_times.record(time.monotonic() - job.submitted)
+                idle = self.workers - len(self.running)
+                waiting = [(queued.sid, queued.request_id) for queued in self.pending]
+
+            # Tell the clients still waiting that the queue moved
+            for position, (sid, request_id) in enumerate(waiting, 1):
+                if position > idle:
+                    socketio.emit('queue_position', {'request_id': request_id, 'position': position - idle}, room=sid)
+
+            try:
+                job.func(job, *job.args)
+                outcome = 'completed'
+            except Exception as e:
+                log_exception(e, f"[ID:{job.request_id}] Message job failed")
+                outcome = 'failed'
+            with self.cond:
+                self.running.discard(job)
+                self.stats['cancelled' if job.cancelled else outcome] += 1
+
+    def get_stats(self):
+        with self.cond:
+            stats = self.stats.copy()
+            stats.update({
+                'workers': self.workers,
+                'busy_workers': len(self.running),
+                'queue_depth': len(self.pending),
+                'max_queue': self.max_queue
+            })
+            stats['queue_wait'] = self.wait_times.summary()
+        return stats
+
+    def get_wait_histogram(self):
+        """Copy of the queue wait histogram"""
+        with self.cond:
+            return LatencyHistogram().merge(self.wait_times)
+
+
+message_jobs = MessageJobQueue(
+    workers=int(os.getenv('MESSAGE_WORKERS', '16')),
+    max_queue=int(os.getenv('MESSAGE_QUEUE_SIZE', '100'))
+)
+
+# ===== Upstream HTTP Client =====
+def _monitored_pool_class(base_class, monitor):
+    """Build a urllib3 connection pool class that reports connection reuse and connect time
+
+    Args:
+        base_class: HTTPConnectionPool or HTTPSConnectionPool
+        monitor: NetworkMonitor receiving pool hit/miss events and connect latencies
+
+    Returns:
+        Connection pool subclass
+    """
+    class TimedConnection(base_class.ConnectionCls):
+        def connect(self):
+            started = time.perf_counter()
+            super().connect()
+            monitor.record_connect(time.perf_counter() - started)
+
+    class MonitoredConnectionPool(base_class):
+        ConnectionCls = TimedConnection
+
+        def _get_conn(self, timeout=None):
+            conn = super()._get_conn(timeout=timeout)
+            # A connection without a socket needs a new TCP+TLS handshake
+            monitor.record_pool_usage(getattr(conn, 'sock', None) is not None)
+            return conn
+
+    MonitoredConnectionPool.__name__ = f"Monitored{base_class.__name__}"
+    return MonitoredConnectionPool
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter with TCP keep-alive and pool hit/miss reporting"""
+
+    def __init__(self, monitor, socket_options=None, **kwargs):
+        # Must be set before HTTPAdapter.__init__ calls init_poolmanager
+        self.monitor = monitor
+        self.socket_options = socket_options
+        self.pool_classes = {
+            'http': _monitored_pool_class(HTTPConnectionPool, monitor),
+            'https': _monitored_pool_class(HTTPSConnectionPool, monitor)
+        }
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.socket_options:
+            kwargs['socket_options'] = self.socket_options
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = dict(self.pool_classes)
+
+
+class DNSCache:
+    """Hostname resolution cache with TTL, negative caching and warm refresh
+
+    Positive entries live for ``ttl`` seconds, failed lookups for
+    ``negative_ttl`` seconds. Watched hostnames (the API host) are refreshed
+    in the background before they expire, so request threads never block on
+    ``socket.getaddrinfo``. A failed refresh keeps serving the last good
+    addresses rather than turning a resolver hiccup into failed requests.
+    """
+
+    def __init__(self, ttl=300, negative_ttl=10, refresh_interval=60, retry_delay=0.5):
+        """Initialize the resolver cache
+
+        Args:
+            ttl: Seconds a successful resolution stays valid
+            negative_ttl: Seconds a failed resolution is remembered
+            refresh_interval: Seconds between background refreshes of watched hosts
+            retry_delay: Delay between resolution retries
+        """
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.refresh_interval = refresh_interval
+        self.retry_delay = retry_delay
+        self.entries = {}   # Maps hostname to (addresses or None, expires_at)
+        self.watched = set()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'negative_hits': 0,
+            'refreshes': 0,
+            'refresh_failures': 0,
+            'last_refresh': None
+        }
+        self.refresher = None
+        self.lock = threading.Lock()
+
+    def _resolve_uncached(self, hostname, max_retries):
+        """Resolve a hostname with retries, returning a sorted address list or None"""
+        for attempt in range(max_retries):
+            try:
+                infos = socket.getaddrinfo(hostname, None, proto=socket.IPPROTO_TCP)
+                addresses = sorted({info[4][0] for info in infos})
+                if attempt > 0:
+                    logger.info(f"DNS resolution successful for {hostname} on attempt {attempt + 1}: {addresses}")
+                else:
+                    logger.debug(f"DNS resolution successful for {hostname}: {addresses}")
+                return addresses
+            except socket.gaierror as e:
+                logger.warning(f"DNS resolution failed for {hostname} on attempt {attempt + 1}: {e}")
+            except Exception as e:
+                logger.error(f"Unexpected error during DNS resolution for {hostname} on attempt {attempt + 1}: {e}")
+            if attempt < max_retries - 1:
+                socketio.sleep(self.retry_delay)  # 短暂延迟后重试
+        logger.error(f"DNS resolution failed for {hostname} after {max_retries} attempts")
+        return None
+
+    def _store(self, hostname, addresses):
+        ttl = self.ttl if addresses else self.negative_ttl
+        self.entries[hostname] = (addresses, time.monotonic() + ttl)
+
+    def resolve(self, hostname, max_retries=3):
+        """Get the addresses for a hostname, resolving only on a cold or expired entry
+
+        Returns:
+            List of addresses, or None if the hostname does not resolve
+        """
+        with self.lock:
+            entry = self.entries.get(hostname)
+            if entry is not None and entry[1] > time.monotonic():
+                if entry[0] is None:
+                    self.stats['negative_hits'] += 1
+                else:
+                    self.stats['hits'] += 1
+                return entry[0]
+            self.stats['misses'] += 1
+
+        addresses = self._resolve_uncached(hostname, max_retries)
+        with self.lock:
+            self._store(hostname, addresses)
+        return addresses
+
+    def refresh(self, hostname):
+        """Re-resolve a hostname, keeping the last good addresses on failure"""
+        addresses = self._resolve_uncached(hostname, max_retries=1)
+        with self.lock:
+            self.stats['refreshes'] += 1
+            self.stats['last_refresh'] = datetime.now().isoformat()
+            previous = self.entries.get(hostname)
+            if addresses is None and previous is not None and previous[0] is not None:
+                self.stats['refresh_failures'] += 1
+                self._store(hostname, previous[0])
+            else:
+                self._store(hostname, addresses)
+
+    def watch(self, hostname):
+        """Keep a hostname warm with the background refresher"""
+        with self.lock:
+            if hostname in self.watched:
+                return
+            self.watched.add(hostname)
+            if self.refresher is None:
+                self.refresher = socketio.start_background_task(self._refresh_loop)
+
+    def _refresh_loop(self):
+        """Background task refreshing watched hostnames"""
+        while True:
+            socketio.sleep(self.refresh_interval)
+            with self.lock:
+                hostnames = list(self.watched)
+            for hostname in hostnames:
+                try:
+                    self.refresh(hostname)
+                except Exception as e:
+                    logger.error(f"Error refreshing DNS entry for {hostname}: {str(e)}")
+
+    def get_stats(self):
+        """Get cache counters and the state of every cached entry"""
+        now = time.monotonic()
+        with self.lock:
+            stats = self.stats.copy()
+            entries = {
+                hostname: {
+                    'addresses': addresses,
+                    'resolved': addresses is not None,
+                    'expires_in': round(expires_at - now, 1)
+                } for hostname, (addresses, expires_at) in self.entries.items()
+            }
+            watched = sorted(self.watched)
+        lookups = stats['hits'] + stats['negative_hits'] + stats['misses']
+        stats['hit_rate'] = ((stats['hits'] + stats['negative_hits']) / lookups) * 100 if lookups > 0 else 0
+        stats['entries'] = entries
+        stats['watched'] = watched
+        stats['refresher_running'] = self.refresher is not None
+        stats['healthy'] = all(entries.get(h, {}).get('resolved', True) for h in watched)
+        return stats
+
+
+class UpstreamClient:
+    """Shared keep-alive HTTP client for the upstream xAI API
+
+    Holds one requests.Session per API base URL (scheme://host:port), each
+    backed by a bounded urllib3 connection pool, so chat turns reuse warm
+    TCP+TLS connections instead of handshaking on every call.
+    """
+
+    def __init__(self, monitor, pool_maxsize=20, pool_block=False, tcp_keepalive=True, keepalive_idle=60, dns_cache=None):
+        """Initialize the upstream client
+
+        Args:
+            monitor: NetworkMonitor receiving pool hit/miss events
+            pool_maxsize: Maximum connections kept alive per base URL
+            pool_block: Wait for a free connection instead of opening extra ones
+            tcp_keepalive: Enable TCP keep-alive probes on pooled sockets
+            keepalive_idle: Seconds of idle time before the first keep-alive probe
+            dns_cache: DNSCache used for the per-request DNS precheck
+        """
+        self.monitor = monitor
+        self.dns_cache = dns_cache or DNSCache()
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.tcp_keepalive = tcp_keepalive
+        self.keepalive_idle = keepalive_idle
+        self.sessions = {}  # Maps base URLs to requests sessions
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def base_url(url):
+        """Get the scheme://host:port part of a URL used as pool key"""
+        parsed = urlparse(url)
+        return f"{parsed.scheme}://{parsed.netloc}"
+
+    def _socket_options(self):
+        """Socket options applied to every new upstream connection"""
+        if not self.tcp_keepalive:
+            return None
+        options = list(HTTPConnection.default_socket_options)
+        options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+        # Platform specific keep-alive tuning (Linux names, not available everywhere)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, self.keepalive_idle))
+        if hasattr(socket, 'TCP_KEEPINTVL'):
+            options.append((socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10))
+        return options
+
+    def _create_session(self):
+        adapter = PooledHTTPAdapter(
+            self.monitor,
+            socket_options=self._socket_options(),
+            pool_connections=1,
+            pool_maxsize=self.pool_maxsize,
+            pool_block=self.pool_block
+        )
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers['Connection'] = 'keep-alive'
+        return session
+
+    def get_session(self, url):
+        """Get (or lazily create) the pooled session for a URL's base URL"""
+        base = self.base_url(url)
+        with self.lock:
+            session = self.sessions.get(base)
+            if session is None:
+                session = self._create_session()
+                self.sessions[base] = session
+                logger.info(f"Created upstream connection pool for {base} (maxsize={self.pool_maxsize})")
+        return session
+
+    def post(self, url, **kwargs):
+        """POST through the pooled session for the URL's base URL"""
+        return self.get_session(url).post(url, **kwargs)
+
+    def get_stats(self):
+        """Get pool configuration and the base URLs with an open pool"""
+        with self.lock:
+            pools = list(self.sessions)
+        return {
+            'pools': pools,
+            'pool_maxsize': self.pool_maxsize,
+            'pool_block': self.pool_block,
+            'tcp_keepalive': self.tcp_keepalive,
+            'keepalive_idle': self.keepalive_idle
+        }
+
+    def close(self):
+        """Close all pooled connections"""
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+        for session in sessions:
+            session.close()
+
+
+# 创建全局上游客户端实例
+upstream_client = UpstreamClient(
+    network_monitor,
+    pool_maxsize=int(os.getenv('UPSTREAM_POOL_MAXSIZE', '20')),
+    pool_block=os.getenv('UPSTREAM_POOL_BLOCK', 'False').lower() == 'true',
+    tcp_keepalive=os.getenv('UPSTREAM_TCP_KEEPALIVE', 'True').lower() == 'true',
+    keepalive_idle=int(os.getenv('UPSTREAM_KEEPALIVE_IDLE', '60')),
+    dns_cache=DNSCache(
+        ttl=int(os.getenv('DNS_CACHE_TTL', '300')),
+        negative_ttl=int(os.getenv('DNS_NEGATIVE_TTL', '10')),
+        refresh_interval=int(os.getenv('DNS_REFRESH_INTERVAL', '60'))
+    )
+)
+
+# ===== Response Cache =====
+# Live Search parameters sent upstream when a client enables it
+LIVE_SEARCH_PARAMETERS = {
+    'mode': 'auto',
+    'max_search_results': 5,
+    'time_range': '24h'
+}
+
+
+class ResponseCache:
+    """LRU + TTL cache of upstream completions for identical prompts
+
+    Keys hash the normalized request (model, role/content of every message,
+    temperature, search parameters) and the owner digest of the API key, so
+    only fully deterministic requests made with the same key can share an
+    entry: nothing is cached unless the temperature is 0, and a key never
+    receives a completion paid for by another.
+    Live Search answers depend on current results and expire sooner.
+    """
+
+    def __init__(self, enabled=False, max_entries=1000, ttl=3600, live_search_ttl=300):
+        """
+        Args:
+            enabled: Whether responses are cached at all (opt-in)
+            max_entries: Maximum cached responses before LRU eviction
+            ttl: Seconds a response stays valid
+            live_search_ttl: Seconds a Live Search response stays valid
+        """
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.live_search_ttl = live_search_ttl
+        self.entries = OrderedDict()  # Maps keys to (expires_at, response_json, size), oldest first
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'bytes_saved': 0
+        }
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(text):
+        return ' '.join(text.split())
+
+    def make_key(self, messages, model, temperature, search_parameters=None, owner=None):
+        """Build the key of a deterministic request, or None if temperature is not 0
+
+        Args:
+            owner: API key digest (SessionManager.owner_for_key) the request is made with
+        """
+        if temperature != 0:
+            return None
+        normalized = {
+            'owner': owner,
+            'model': model,
+            'messages': [[msg['role'], self._normalize(msg['content'])] for msg in messages],
+            'temperature': temperature,
+            'search_parameters': search_parameters
+        }
+        encoded = json.dumps(normalized, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Get a cached response, or None on a miss"""
+        if not self.enabled:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self.entries[key]
+                self.stats['expirations'] += 1
+                entry = None
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            self.stats['bytes_saved'] += entry[2]
+            return entry[1]
+
+    def put(self, key, response_json, live_search=False):
+        """Cache a successful response"""
+        if not self.enabled:
+            return
+        size = len(json.dumps(response_json, ensure_ascii=False).encode('utf-8'))
+        expires_at = time.monotonic() + (self.live_search_ttl if live_search else self.ttl)
+        with self.lock:
+            self.entries[key] = (expires_at, response_json, size)
+            self.entries.move_to_end(key)
+            self.stats['stores'] += 1
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def get_stats(self):
+        with self.lock:
+            stats = self.stats.copy()
+            stats['entries'] = len(self.entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['enabled'] = self.enabled
+        stats['hit_rate'] = round(stats['hits'] / lookups * 100, 2) if lookups else 0
+        return stats
+
+
+response_cache = ResponseCache(
+    enabled=os.getenv('RESPONSE_CACHE', 'False').lower() == 'true',
+    max_entries=int(os.getenv('RESPONSE_CACHE_SIZE', '1000')),
+    ttl=int(os.getenv('RESPONSE_CACHE_TTL', '3600')),
+    live_search_ttl=int(os.getenv('RESPONSE_CACHE_LIVE_SEARCH_TTL', '300'))
+)
+
+# ===== Request Coalescing =====
+class _Flight:
+    """One in-flight upstream request shared by every identical caller"""
+    __slots__ = ('cond', 'chunks', 'streamed', 'done', 'result')
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.chunks = []       # Content deltas published so far
+        self.streamed = False  # Whether the leader is streaming
+        self.done = False
+        self.result = None
+
+
+class RequestCoalescer:
+    """Single-flight layer in front of the upstream client
+
+    The first caller for a request key becomes the leader and makes the
+    upstream call; callers arriving while it is in flight wait on the same
+    flight instead of sending their own. Streamed deltas are replayed to
+    late joiners and then forwarded live, so every waiting room sees the
+    full answer.
+    """
+
+    def __init__(self, monitor, enabled=True):
+        self.monitor = monitor
+        self.enabled = enabled
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def run(self, key, fetch, stream=False, on_chunk=None):
+        """Run fetch for key, or wait for the identical request already in flight
+
+        Args:
+            key: Request key (see ResponseCache.make_key)
+            fetch: Callable taking an on_chunk callback and returning a send_message result
+            stream: Whether this caller wants content deltas
+            on_chunk: This caller's delta callback
+
+        Returns:
+            Dictionary containing response or error information
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+
+        if leader:
+            result = None
+            try:
+                result = fetch(lambda delta: self._publish(flight, delta, on_chunk))
+                return result
+            finally:
+                with self.lock:
+                    self.flights.pop(key, None)
+                with flight.cond:
+                    flight.result = result or {'error': 'Unknown error occurred, please try again later'}
+                    flight.done = True
+                    flight.cond.notify_all()
+
+        self.monitor.record_coalesced_request()
+        return self._follow(flight, fetch, stream, on_chunk)
+
+    @staticmethod
+    def _publish(flight, delta, on_chunk):
+        with flight.cond:
+            flight.chunks.append(delta)
+            flight.streamed = True
+            flight.cond.notify_all()
+        if on_chunk:
+            on_chunk(delta)
+
+    @staticmethod
+    def _follow(flight, fetch, stream, on_chunk):
+        started = time.time()
+        ttft = None
+        delivered = 0
+        while True:
+            with flight.cond:
+                while delivered == len(flight.chunks) and not flight.done:
+                    flight.cond.wait(1)
+                chunks = flight.chunks[delivered:]
+                done = flight.done
+            delivered += len(chunks)
+            if stream and on_chunk:
+                for delta in chunks:
+                    if ttft is None:
+                        ttft = time.time() - started
+                    on_chunk(delta)
+            if done and delivered == len(flight.chunks):
+                break
+
+        result = flight.result
+        if 'error' in result:
+            # Nothing reached this caller yet: the leader's failure (e.g. its API key) need not be ours
+            if delivered == 0:
+                return fetch(on_chunk)
+            return result
+        if stream and on_chunk and not flight.streamed:
+            ttft = time.time() - started
+            on_chunk(result['response']['choices'][0]['message']['content'])
+        return dict(result, coalesced=True, response_time=time.time() - started, ttft=ttft if stream else None)
+
+    def get_stats(self):
+        with self.lock:
+            return {'enabled': self.enabled, 'in_flight': len(self.flights)}
+
+
+request_coalescer = RequestCoalescer(
+    network_monitor,
+    enabled=os.getenv('REQUEST_COALESCING', 'True').lower() == 'true'
+)
+
+# ===== Retry Policy and Circuit Breaker =====
+class CircuitBreaker:
+    """Fail fast while the upstream API is unhealthy
+
+    Closed: requests flow and outcomes are recorded in a sliding window.
+    Open: after too many consecutive failures or a failure rate above the
+    threshold in the window, requests are rejected without touching the
+    network for reset_timeout seconds. Half-open: one probe request is let
+    through; its outcome closes or re-opens the breaker.
+
+    Only upstream health failures (timeouts, connection errors, 5xx) count;
+    per-key errors such as 401 or 429 do not.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, failure_rate=50, window=20, min_requests=5, reset_timeout=30):
+        """
+        Args:
+            failure_threshold: Consecutive failures that open the breaker
+            failure_rate: Failure percentage in the window that opens the breaker
+            window: Number of recent outcomes considered
+            min_requests: Outcomes required before the failure rate applies
+            reset_timeout: Seconds to stay open before probing again
+        """
+        self.failure_threshold = failure_threshold
+        self.failure_rate = failure_rate
+        self.min_requests = min_requests
+        self.reset_timeout = reset_timeout
+        self.outcomes = deque(maxlen=window)
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0
+        self.probe_started = None  # When the half-open probe was let through
+        self.stats = {'opened': 0, 'rejected': 0}
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Check whether a request may be sent now"""
+        with self.lock:
+            now = time.monotonic()
+            if self.state == self.OPEN and now - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.probe_started = None
+            if self.state == self.CLOSED:
+                return True
+            # A probe that never reported back is replaced after reset_timeout
+            if self.state == self.HALF_OPEN and (
+                    self.probe_started is None or now - self.probe_started >= self.reset_timeout):
+                self.probe_started = now
+                return True
+            self.stats['rejected'] += 1
+            return False
+
+    def is_open(self):
+        with self.lock:
+            return self.state == self.OPEN
+
+    def record_success(self):
+        with self.lock:
+            self.outcomes.append(True)
+            self.consecutive_failures = 0
+            if self.state == self.HALF_OPEN:
+                self.state = self.CLOSED
+                self.outcomes.clear()
+                logger.info("Circuit breaker closed, upstream recovered")
+
+    def record_failure(self):
+        with self.lock:
+            self.outcomes.append(False)
+            self.consecutive_failures += 1
+            failures = self.outcomes.count(False)
+            tripped = (
+                self.state == self.HALF_OPEN
+                or self.consecutive_failures >= self.failure_threshold
+                or (len(self.outcomes) >= self.min_requests
+                    and failures * 100 >= self.failure_rate * len(self.outcomes))
+            )
+            if tripped and self.state != self.OPEN:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.stats['opened'] += 1
+                logger.warning(f"Circuit breaker opened: {failures}/{len(self.outcomes)} recent upstream failures")
+
+    def get_stats(self):
+        with self.lock:
+            stats = self.stats.copy()
+            stats.update({
+                'state': self.state,
+                'consecutive_failures': self.consecutive_failures,
+                'recent_failures': self.outcomes.count(False),
+                'recent_requests': len(self.outcomes),
+                'retry_in': round(max(0, self.reset_timeout - (time.monotonic() - self.opened_at)), 1)
+                if self.state == self.OPEN else 0
+            })
+        return stats
+
+
+class RetryPolicy:
+    """Attempt count, per-attempt timeouts, backoff and hedging for upstream calls
+
+    Backoff uses decorrelated jitter (each delay is drawn between the base
+    delay and three times the previous one, capped), so clients that failed
+    together do not retry in lockstep. A Retry-After header overrides the
+    drawn delay; one asking for longer than max_retry_after fails the
+    request instead of holding a worker.
+    """
+
+    def __init__(self, max_attempts=3, timeout=15, timeout_step=10, base_delay=1, max_delay=20,
+                 max_retry_after=30, hedge_delay=0):
+        """
+        Args:
+            max_attempts: Attempts per request including the first
+            timeout: Timeout in seconds of the first attempt
+            timeout_step: Seconds added to the timeout of each further attempt
+            base_delay: Minimum backoff delay in seconds
+            max_delay: Maximum backoff delay in seconds
+            max_retry_after: Longest Retry-After in seconds worth waiting for
+            hedge_delay: Seconds without a response before a duplicate request is sent (0 disables hedging)
+        """
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self.timeout_step = timeout_step
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.hedge_delay = hedge_delay
+        self.stats = {'retries': 0, 'retry_after_waits': 0, 'hedged_requests': 0, 'hedge_wins': 0}
+        self.lock = threading.Lock()
+
+    def attempt_timeout(self, attempt):
+        return self.timeout + attempt * self.timeout_step
+
+    def next_delay(self, previous_delay=None, retry_after=None):
+        """Delay before the next attempt
+
+        Args:
+            previous_delay: Delay before the previous retry, None for the first retry
+            retry_after: Seconds requested by the server's Retry-After header
+
+        Returns:
+            Delay in seconds, or None if the server asked for more than max_retry_after
+        """
+        with self.lock:
+            self.stats['retries'] += 1
+            if retry_after is not None:
+                if retry_after > self.max_retry_after:
+                    return None
+                self.stats['retry_after_waits'] += 1
+                return retry_after
+        previous_delay = previous_delay or self.base_delay
+        return min(self.max_delay, random.uniform(self.base_delay, previous_delay * 3))
+
+    @staticmethod
+    def parse_retry_after(response):
+        """Read a Retry-After header (delta seconds or HTTP date) in seconds, or None"""
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def hedge(self, call):
+        """Run call, sending a duplicate if it has not returned within hedge_delay
+
+        The first successful (2xx) result wins; the other response is closed
+        when it arrives so its connection is released. If the first result is
+        an error or a non-2xx response, the other request is waited for and
+        the better of the two is returned.
+        """
+        if not self.hedge_delay:
+            return call()
+
+        results = queue.Queue()
+
+        def run(index):
+            try:
+                results.put((index, call(), None))
+            except Exception as e:
+                results.put((index, None, e))
+
+        socketio.start_background_task(run, 0)
+        try:
+            index, response, error = results.get(timeout=self.hedge_delay)
+            outstanding = 0
+        except queue.Empty:
+            with self.lock:
+                self.stats['hedged_requests'] += 1
+            socketio.start_background_task(run, 1)
+            index, response, error = results.get()
+            outstanding = 1
+            if not self._succeeded(response):
+                # Fall back to the other request before giving up on this one
+                other = results.get()
+                outstanding = 0
+                if response is None or self._succeeded(other[1]):
+                    if response is not None:
+                        response.close()
+                    index, response, error = other
+                elif other[1] is not None:
+                    other[1].close()
+
+        if outstanding:
+            def discard():
+                _, late_response, _ = results.get()
+                if late_response is not None:
+                    late_response.close()
+            socketio.start_background_task(discard)
+        if error is not None:
+            raise error
+        if index == 1 and self._succeeded(response):
+            with self.lock:
+                self.stats['hedge_wins'] += 1
+        return response
+
+    @staticmethod
+    def _succeeded(response):
+        return response is not None and 200 <= response.status_code < 300
+
+    def get_stats(self):
+        with self.lock:
+            stats = self.stats.copy()
+        stats.update({
+            'max_attempts': self.max_attempts,
+            'timeout': self.timeout,
+            'timeout_step': self.timeout_step,
+            'base_delay': self.base_delay,
+            'max_delay': self.max_delay,
+            'max_retry_after': self.max_retry_after,
+            'hedge_delay': self.hedge_delay
+        })
+        return stats
+
+
+retry_policy = RetryPolicy(
+    max_attempts=int(os.getenv('UPSTREAM_MAX_ATTEMPTS', '3')),
+    timeout=float(os.getenv('UPSTREAM_TIMEOUT', '15')),
+    timeout_step=float(os.getenv('UPSTREAM_TIMEOUT_STEP', '10')),
+    base_delay=float(os.getenv('RETRY_BASE_DELAY', '1')),
+    max_delay=float(os.getenv('RETRY_MAX_DELAY', '20')),
+    max_retry_after=float(os.getenv('RETRY_AFTER_MAX', '30')),
+    hedge_delay=float(os.getenv('HEDGE_DELAY', '0'))
+)
+
+circuit_breaker = CircuitBreaker(
+    failure_threshold=int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5')),
+    failure_rate=float(os.getenv('CIRCUIT_FAILURE_RATE', '50')),
+    window=int(os.getenv('CIRCUIT_WINDOW', '20')),
+    reset_timeout=float(os.getenv('CIRCUIT_RESET_TIMEOUT', '30'))
+)
+
+# ===== Rate Limiting and Fair Scheduling =====
+class TokenBucket:
+    """Token bucket refilled continuously at rate tokens per second up to burst"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.max_rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0  # Set from Retry-After: no tokens are granted before this time
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until one token is available (0 if available now)"""
+        blocked = max(0, self.blocked_until - now)
+        if not self.rate:
+            return blocked
+        self.refill(now)
+        missing = max(0, 1 - self.tokens) / self.rate
+        return max(blocked, missing)
+
+    def take(self):
+        if self.rate:
+            self.tokens -= 1
+
+
+class _KeyQueue:
+    """Waiting requests and the rate limit bucket of one API key"""
+    __slots__ = ('bucket', 'waiters')
+
+    def __init__(self, rate, burst):
+        self.bucket = TokenBucket(rate, burst)
+        self.waiters = deque()
+
+
+class _Waiter:
+    __slots__ = ('admitted',)
+
+    def __init__(self):
+        self.admitted = False
+
+
+class AdmissionScheduler:
+    """Proactive admission of upstream calls per API key and globally
+
+    Every upstream attempt first waits here for a token from its API key's
+    bucket and from the global bucket. Keys with waiting requests are served
+    round-robin, so one user's burst queues behind its own bucket instead of
+    delaying everyone else. A 429 halves the key's rate and blocks it for
+    Retry-After; successes restore the rate additively (AIMD), so admission
+    follows each key's observed limit instead of retrying into it.
+    """
+
+    def __init__(self, global_rate=50, global_burst=100, key_rate=2, key_burst=10, max_wait=30,
+                 min_key_rate=0.1):
+        """
+        Args:
+            global_rate: Requests per second across all keys (0 disables)
+            global_burst: Global bucket size
+            key_rate: Requests per second per API key (0 disables)
+            key_burst: Per-key bucket size
+            max_wait: Longest admission wait in seconds before a request is rejected
+            min_key_rate: Floor of a key's rate after repeated 429s
+        """
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.key_rate = key_rate
+        self.key_burst = key_burst
+        self.max_wait = max_wait
+        self.min_key_rate = min(min_key_rate, key_rate) if key_rate else 0
+        self.keys = {}           # Maps API key digests (SessionManager.owner_for_key) to _KeyQueue
+        self.active = deque()    # Key digests with waiting requests, in round-robin order
+        self.cond = threading.Condition()
+        self.stats = {
+            'admitted': 0,
+            'rejected': 0,
+            'throttled': 0,
+            'total_wait': 0.0,
+            'max_wait': 0.0
+        }
+
+    def _key_queue(self, digest):
+        key_queue = self.keys.get(digest)
+        if key_queue is None:
+            if len(self.keys) >= 1024:
+                self._prune(time.monotonic())
+            key_queue = self.keys[digest] = _KeyQueue(self.key_rate, self.key_burst)
+        return key_queue
+
+    def _prune(self, now):
+        """Forget idle keys whose bucket has refilled and is not throttled"""
+        for digest, key_queue in list(self.keys.items()):
+            bucket = key_queue.bucket
+            if (not key_queue.waiters and bucket.wait_time(now) == 0 and bucket.tokens >= bucket.burst
+                    and bucket.rate == bucket.max_rate):
+                del self.keys[digest]
+
+    def _dispatch(self, now):
+        """Admit waiters round-robin while tokens are available
+
+        Returns:
+            Seconds until the next token could admit someone, or None if nobody waits
+        """
+        next_wake = None
+        checked = 0
+        while self.active and checked < len(self.active):
+            global_wait = self.global_bucket.wait_time(now)
+            if global_wait:
+                return global_wait
+            digest = self.active[0]
+            key_queue = self.keys[digest]
+            key_wait = key_queue.bucket.wait_time(now)
+            self.active.rotate(-1)
+            if key_wait:
+                next_wake = key_wait if next_wake is None else min(next_wake, key_wait)
+                checked += 1
+                continue
+            waiter = key_queue.waiters.popleft()
+            waiter.admitted = True
+            key_queue.bucket.take()
+            self.global_bucket.take()
+            if not key_queue.waiters:
+                self.active.remove(digest)
+            checked = 0
+            self.cond.notify_all()
+        return next_wake
+
+    def acquire(self, api_key):
+        """Wait until a request with this API key may be sent
+
+        Returns:
+            Seconds waited, or None if admission would take longer than max_wait
+        """
+        digest = SessionManager.owner_for_key(api_key)
+        waiter = _Waiter()
+        started = time.monotonic()
+        with self.cond:
+            key_queue = self._key_queue(digest)
+            # Rejected up front when the key is blocked by Retry-After beyond max_wait
+            if key_queue.bucket.blocked_until - started > self.max_wait:
+                self.stats['rejected'] += 1
+                return None
+            if not key_queue.waiters:
+                self.active.append(digest)
+            key_queue.waiters.append(waiter)
+            while True:
+                now = time.monotonic()
+                next_wake = self._dispatch(now)
+                if waiter.admitted:
+                    break
+                remaining = self.max_wait - (now - started)
+                if remaining <= 0:
+                    key_queue.waiters.remove(waiter)
+                    if not key_queue.waiters and digest in self.active:
+                        self.active.remove(digest)
+                    self.stats['rejected'] += 1
+                    return None
+                self.cond.wait(min(remaining, next_wake or remaining))
+            waited = time.monotonic() - started
+            self.stats['admitted'] += 1
+            self.stats['total_wait'] += waited
+            self.stats['max_wait'] = max(self.stats['max_wait'], waited)
+        return waited
+
+    def record_rate_limited(self, api_key, retry_after=None):
+        """Slow a key down after the upstream answered 429
+
+        Returns:
+            True if the key's next admission is delayed, False when neither a
+            per-key rate nor Retry-After spaces the retry out
+        """
+        with self.cond:
+            bucket = self._key_queue(SessionManager.owner_for_key(api_key)).bucket
+            self.stats['throttled'] += 1
+            if bucket.rate:
+                bucket.rate = max(self.min_key_rate, bucket.rate / 2)
+            now = time.monotonic()
+            bucket.refill(now)
+            bucket.tokens = min(bucket.tokens, 0)
+            if retry_after:
+                bucket.blocked_until = max(bucket.blocked_until, now + retry_after)
+            return bool(bucket.rate or retry_after)
+
+    def record_success(self, api_key):
+        """Recover a throttled key's rate additively"""
+        with self.cond:
+            key_queue = self.keys.get(SessionManager.owner_for_key(api_key))
+            if key_queue and key_queue.bucket.rate < key_queue.bucket.max_rate:
+                bucket = key_queue.bucket
+                bucket.refill(time.monotonic())
+                bucket.rate = min(bucket.max_rate, bucket.rate + bucket.max_rate / 10)
+
+    def get_stats(self):
+        with self.cond:
+            stats = self.stats.copy()
+            stats['queue_depth'] = sum(len(self.keys[digest].waiters) for digest in self.active)
+            stats['queued_keys'] = len(self.active)
+            stats['tracked_keys'] = len(self.keys)
+            stats['throttled_keys'] = sum(
+                1 for key_queue in self.keys.values() if key_queue.bucket.rate < key_queue.bucket.max_rate
+            )
+        stats['average_wait'] = round(stats.pop('total_wait') / stats['admitted'], 4) if stats['admitted'] else 0
+        stats['max_wait'] = round(stats['max_wait'], 4)
+        stats.update({
+            'global_rate': self.global_bucket.rate,
+            'key_rate': self.key_rate,
+            'max_queue_wait': self.max_wait
+        })
+        return stats
+
+
+admission_scheduler = AdmissionScheduler(
+    global_rate=float(os.getenv('RATE_LIMIT_GLOBAL_RPS', '50')),
+    global_burst=float(os.getenv('RATE_LIMIT_GLOBAL_BURST', '100')),
+    key_rate=float(os.getenv('RATE_LIMIT_KEY_RPS', '2')),
+    key_burst=float(os.getenv('RATE_LIMIT_KEY_BURST', '10')),
+    max_wait=float(os.getenv('RATE_LIMIT_MAX_WAIT', '30'))
+)
+
+# ===== Token Counting and Context Window =====
+# Per-message framing tokens added by chat templates (role markers, separators)
+MESSAGE_TOKEN_OVERHEAD = 4
+
+# GPT-style pre-tokenizer: contractions, letter runs, 1-3 digit groups, punctuation runs, whitespace
+_PRETOKENIZE_PATTERN = re.compile(r"'(?:[sdmt]|ll|ve|re)| ?[^\W\d_]+| ?\d{1,3}| ?[^\s\w]+|\s+(?!\S)|\s+")
+
+
+def _load_encoding():
+    """Load the tiktoken encoding named by TOKENIZER_ENCODING, or None to approximate"""
+    if tiktoken is None:
+        return None
+    name = os.getenv('TOKENIZER_ENCODING', 'o200k_base')
+    try:
+        return tiktoken.get_encoding(name)
+    except Exception as e:
+        # Encodings are downloaded on first use; offline hosts fall back to the approximation
+        logger.warning(f"Tokenizer encoding {name} unavailable ({str(e)}), using approximate token counts")
+        return None
+
+
+_encoding = _load_encoding()
+TOKENIZER_NAME = _encoding.name if _encoding else 'approx-bpe'
+
+
+def _approximate_tokens(text):
+    """Estimate the BPE token count of text without a vocabulary
+
+    Splits text the way GPT-style tokenizers pre-tokenize it, then estimates
+    merges per piece: short ASCII words are one token and longer ones split
+    every ~6 characters, digit groups and whitespace runs are one token,
+    CJK characters are about one token each and other scripts about one per
+    three characters.
+    """
+    tokens = 0
+    for piece in _PRETOKENIZE_PATTERN.findall(text):
+        word = piece.lstrip(' ')
+        if not word or word.isspace():
+            tokens += 1
+        elif word.isascii():
+            if word[0].isalpha():
+                tokens += -(-len(word) // 6)
+            elif word[0].isdigit() or word[0] == "'":
+                tokens += 1
+            else:
+                tokens += -(-len(word) // 2)
+        else:
+            wide = sum(1 for char in word if char >= '⺀')
+            tokens += wide + -(-(len(word) - wide) // 3)
+    return tokens
+
+
+@functools.lru_cache(maxsize=4096)
+def count_tokens(text):
+    """Count the tokens of a text (memoized: system prompts and repeated inputs are counted once)"""
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return _approximate_tokens(text)
+
+
+def count_message_tokens(message):
+    """Count the tokens a message contributes to a prompt
+
+    Message records cache their count, so history is tokenized once per
+    message rather than once per request.
+    """
+    if isinstance(message, Message):
+        if message.tokens is None:
+            message.tokens = count_tokens(message.content) + MESSAGE_TOKEN_OVERHEAD
+        return message.tokens
+    return count_tokens(message['content']) + MESSAGE_TOKEN_OVERHEAD
+
+
+def calculate_tokens(messages):
+    """Count the prompt tokens of a message list"""
+    return sum(count_message_tokens(msg) for msg in messages)
+
+
+class ContextBuilder:
+    """Pack conversation history into a per-model prompt token budget
+
+    The system prompt, pinned system messages and the new user message are
+    always sent; the remaining budget is filled with the newest history
+    messages, so long conversations neither overflow the model context nor
+    resend history that no longer fits.
+    """
+
+    def __init__(self, default_budget=32000, model_budgets=None):
+        """
+        Args:
+            default_budget: Prompt token budget for models without an override
+            model_budgets: Dictionary mapping model names to token budgets
+        """
+        self.default_budget = default_budget
+        self.model_budgets = model_budgets or {}
+        self.stats = {
+            'builds': 0,
+            'dropped_messages': 0,
+            'prompt_tokens': 0
+        }
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def parse_budgets(value):
+        """Parse 'model=tokens,model=tokens' into a dictionary"""
+        budgets = {}
+        for item in (value or '').split(','):
+            if '=' in item:
+                model, tokens = item.split('=', 1)
+                budgets[model.strip()] = int(tokens)
+        return budgets
+
+    def budget_for(self, model):
+        return self.model_budgets.get(model, self.default_budget)
+
+    def build(self, history, user_message, model, system_prompt='You are a helpful assistant.'):
+        """Build the API message list for one request
+
+        Args:
+            history: Message records of the conversation, oldest first
+            user_message: The new user message dictionary
+            model: Model name selecting the token budget
+            system_prompt: Leading system message content
+
+        Returns:
+            Tuple of (messages, info) where messages are API dictionaries and
+            info holds tokens, budget, included and dropped message counts
+        """
+        budget = self.budget_for(model)
+        head = [{'role': 'system', 'content': system_prompt}]
+        pinned = [msg for msg in history if msg.role == 'system']
+        recent = [msg for msg in history if msg.role != 'system']
+        used = calculate_tokens(head) + calculate_tokens(pinned) + count_message_tokens(user_message)
+
+        # Walk back from the newest message until the budget is spent
+        start = len(recent)
+        while start > 0:
+            tokens = count_message_tokens(recent[start - 1])
+            if used + tokens > budget:
+                break
+            used += tokens
+            start -= 1
+
+        messages = head + [msg.to_dict() for msg in pinned] + [msg.to_dict() for msg in recent[start:]]
+        messages.append(user_message)
+
+        with self.lock:
+            self.stats['builds'] += 1
+            self.stats['dropped_messages'] += start
+            self.stats['prompt_tokens'] += used
+        return messages, {
+            'tokens': used,
+            'budget': budget,
+            'included': len(recent) - start + len(pinned),
+            'dropped': start
+        }
+
+    def get_stats(self):
+        with self.lock:
+            stats = self.stats.copy()
+        stats['tokenizer'] = TOKENIZER_NAME
+        stats['default_budget'] = self.default_budget
+        stats['model_budgets'] = dict(self.model_budgets)
+        stats['average_prompt_tokens'] = round(stats['prompt_tokens'] / stats['builds'], 1) if stats['builds'] else 0
+        return stats
+
+
+context_builder = ContextBuilder(
+    default_budget=int(os.getenv('CONTEXT_TOKEN_BUDGET', '32000')),
+    model_budgets=ContextBuilder.parse_budgets(os.getenv('CONTEXT_TOKEN_BUDGETS'))
+)
+
+# ===== Conversation Summaries =====
+SUMMARY_PREFIX = 'Summary of the earlier conversation:\n'
+
+SUMMARY_INSTRUCTIONS = (
+    'Summarize the conversation below so it can replace the original messages as context for later turns. '
+    'Keep facts, decisions, names, numbers, code identifiers, open questions and the user\'s stated preferences; '
+    'drop greetings and repetition. Write in the language of the conversation and reply with the summary only.'
+)
+
+
+class ConversationSummarizer:
+    """Fold the older turns of long conversations into a cached summary
+
+    Once the turns not yet covered by a conversation's summary pass the
+    token threshold, all but the newest keep_recent of them are summarized
+    in a background task through send_message, merging the previous summary
+    if there is one. Prompts are then built from the summary, as a pinned
+    system message, plus the turns after the last one it covers; history
+    itself is never rewritten, so pages and exports still show every
+    message.
+
+    A summary records the last message it covers by role, timestamp and
+    content checksum. If that message has already been trimmed from the
+    retained history, every retained message is newer and none is covered.
+    """
+
+    def __init__(self, threshold=4000, keep_recent=6, max_summaries=1000, model=None):
+        """
+        Args:
+            threshold: Uncovered history tokens that trigger a summary
+            keep_recent: Newest messages always sent verbatim
+            max_summaries: Summaries kept, least recently used first out
+            model: Model writing the summaries, or None for the conversation's model
+        """
+        self.threshold = threshold
+        self.keep_recent = keep_recent
+        self.max_summaries = max_summaries
+        self.model = model
+        self.summaries = OrderedDict()  # conversation_id -> summary entry
+        self.pending = set()
+        # conversation_id -> running estimate of uncovered turn tokens, so most turns skip the history walk
+        self.uncovered_tokens = {}
+        self.lock = threading.Lock()
+        self.stats = {
+            'summaries': 0,
+            'failed': 0,
+            'prompts': 0,
+            'summarized_messages': 0,
+            'saved_tokens': 0
+        }
+
+    @staticmethod
+    def message_key(message):
+        return (message.role, message.timestamp, zlib.crc32(message.content.encode('utf-8')))
+
+    @staticmethod
+    def _split(history, last_key):
+        """Split history into (pinned, covered, uncovered) by the last covered message's key"""
+        pinned = tuple(msg for msg in history if msg.role == 'system')
+        turns = [msg for msg in history if msg.role != 'system']
+        if last_key is not None:
+            role, timestamp, checksum = last_key
+            for index in range(len(turns) - 1, -1, -1):
+                msg = turns[index]
+                # Role and timestamp rule out nearly every message before the content is read
+                if (msg.timestamp == timestamp and msg.role == role
+                        and zlib.crc32(msg.content.encode('utf-8')) == checksum):
+                    return pinned, turns[:index + 1], turns[index + 1:]
+        return pinned, [], turns
+
+    def apply(self, conversation_id, history):
+        """Replace the turns covered by the conversation's summary with the summary
+
+        Args:
+            conversation_id: Conversation the history belongs to
+            history: Message records of the conversation, oldest first
+
+        Returns:
+            Tuple of (history, info) where history is the pinned messages, the
+            summary and the uncovered turns, and info holds the summarized
+            message count and the prompt tokens saved
+        """
+        with self.lock:
+            entry = self.summaries.get(conversation_id)
+            if entry is not None:
+                self.summaries.move_to_end(conversation_id)
+        if entry is None:
+            return history, {'summarized': 0, 'saved_tokens': 0}
+
+        pinned, covered, uncovered = self._split(history, entry['last_key'])
+        saved = 0
+        if covered:
+            saved = calculate_tokens(covered) - count_message_tokens(entry['message'])
+            if saved <= 0:
+                return history, {'summarized': 0, 'saved_tokens': 0}  # The turns are cheaper to send verbatim
+        # With nothing covered, the turns the summary stands for were trimmed and it is all that is left of them
+        with self.lock:
+            entry['prompts'] += 1
+            entry['saved_tokens'] += saved
+            self.stats['prompts'] += 1
+            self.stats['saved_tokens'] += saved
+        return pinned + (entry['message'],) + tuple(uncovered), {'summarized': len(covered), 'saved_tokens': saved}
+
+    def maybe_schedule(self, conversation_id, new_messages, get_history, api_key, model):
+        """Start a background summary if the uncovered turns pass the threshold
+
+        A running token total per conversation is kept from the messages of
+        each turn; the history is only read, split and counted (decompressing
+        cold messages) once that total passes the threshold, or the first
+        time a conversation is seen. The walk then corrects the total.
+
+        Args:
+            new_messages: Message dictionaries the turn just stored
+            get_history: Callable returning the conversation's message records
+
+        Returns:
+            True if a summary task was started
+        """
+        added = sum(count_message_tokens(msg) for msg in new_messages if msg['role'] != 'system')
+        with self.lock:
+            known = conversation_id in self.uncovered_tokens
+            total = self.uncovered_tokens.get(conversation_id, 0) + added
+            self.uncovered_tokens[conversation_id] = total
+            if conversation_id in self.pending or (known and total <= self.threshold):
+                return False
+            entry = self.summaries.get(conversation_id)
+        _, _, uncovered = self._split(get_history(), entry['last_key'] if entry else None)
+        tokens = calculate_tokens(uncovered)
+        with self.lock:
+            self.uncovered_tokens[conversation_id] = tokens
+        if len(uncovered) <= self.keep_recent or tokens <= self.threshold:
+            return False
+        fold = uncovered[:len(uncovered) - self.keep_recent]
+        with self.lock:
+            if conversation_id in self.pending:
+                return False
+            self.pending.add(conversation_id)
+        socketio.start_background_task(
+            self._summarize, conversation_id, entry['content'] if entry else None, fold, api_key, model
+        )
+        return True
+
+    def _summarize(self, conversation_id, previous, fold, api_key, model):
+        transcript = '\n\n'.join(f"{msg.role.capitalize()}: {msg.content}" for msg in fold)
+        if previous:
+            transcript = f"Previous summary:\n{previous}\n\nNew messages:\n{transcript}"
+        messages = [
+            {'role': 'system', 'content': SUMMARY_INSTRUCTIONS},
+            {'role': 'user', 'content': transcript}
+        ]
+        content = None
+        try:
+            response_data = send_message(messages, api_key, False, self.model or model)
+            if 'error' in response_data:
+                logger.warning("Conversation %s summary failed: %s", conversation_id, response_data['error'])
+            else:
+                content = response_data['response']['choices'][0]['message']['content'].strip()
+        except Exception as e:
+            log_exception(e, f"Conversation {conversation_id} summary failed")
+
+        with self.lock:
+            if conversation_id not in self.pending:
+                return  # Forgotten (removed) while the summary was being written
+            self.pending.discard(conversation_id)
+            if not content:
+                self.stats['failed'] += 1
+                return
+            if conversation_id in self.uncovered_tokens:
+                self.uncovered_tokens[conversation_id] = max(
+                    0, self.uncovered_tokens[conversation_id] - calculate_tokens(fold)
+                )
+            previous_entry = self.summaries.pop(conversation_id, None)
+            self.summaries[conversation_id] = {
+                'content': content,
+                'message': Message('system', SUMMARY_PREFIX + content, fold[-1].timestamp),
+                'last_key': self.message_key(fold[-1]),
+                'messages': (previous_entry['messages'] if previous_entry else 0) + len(fold),
+                'prompts': previous_entry['prompts'] if previous_entry else 0,
+                'saved_tokens': previous_entry['saved_tokens'] if previous_entry else 0
+            }
+            while len(self.summaries) > self.max_summaries:
+                self.summaries.popitem(last=False)
+            self.stats['summaries'] += 1
+            self.stats['summarized_messages'] += len(fold)
+        logger.info("Conversation %s: summarized %d messages", conversation_id, len(fold))
+
+    def forget(self, conversation_id):
+        """Drop the summary of a deleted, evicted or expired conversation, including one still being written"""
+        with self.lock:
+            self.summaries.pop(conversation_id, None)
+            self.uncovered_tokens.pop(conversation_id, None)
+            self.pending.discard(conversation_id)
+
+    def get_conversation_stats(self, conversation_id):
+        """Summary statistics of one conversation, or None if it has no summary"""
+        with self.lock:
+            entry = self.summaries.get(conversation_id)
+            if entry is None:
+                return None
+            return {
+                'summarized_messages': entry['messages'],
+                'summary_tokens': count_message_tokens(entry['message']),
+                'prompts': entry['prompts'],
+                'saved_tokens': entry['saved_tokens']
+            }
+
+    def get_stats(self):
+        with self.lock:
+            stats = self.stats.copy()
+            stats['conversations'] = len(self.summaries)
+            stats['pending'] = len(self.pending)
+        stats['threshold'] = self.threshold
+        stats['keep_recent'] = self.keep_recent
+        return stats
+
+
+conversation_summarizer = None
+if os.getenv('CONVERSATION_SUMMARIES', 'False').lower() == 'true':
+    conversation_summarizer = ConversationSummarizer(
+        threshold=int(os.getenv('SUMMARY_THRESHOLD_TOKENS', '4000')),
+        keep_recent=int(os.getenv('SUMMARY_KEEP_RECENT', '6')),
+        max_summaries=int(os.getenv('SUMMARY_MAX_CONVERSATIONS', os.getenv('MAX_CONVERSATIONS', '50'))),
+        model=os.getenv('SUMMARY_MODEL') or None
+    )
+    session_manager.forget_conversation = conversation_summarizer.forget
+
+# ===== Prometheus Metrics =====
+# Upper bounds in seconds of the exported latency histogram buckets
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class MetricsWriter:
+    """Render metric families in the Prometheus text exposition format (0.0.4)"""
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, prefix='grok_'):
+        self.prefix = prefix
+        self.lines = []
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ''
+        pairs = []
+        for name, value in labels.items():
+            value = str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+            pairs.append(f'{name}="{value}"')
+        return '{' + ','.join(pairs) + '}'
+
+    @staticmethod
+    def _value(value):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+    def family(self, name, kind, help_text):
+        """Start a metric family and return its full name"""
+        name = self.prefix + name
+        self.lines.append(f'# HELP {name} {help_text}')
+        self.lines.append(f'# TYPE {name} {kind}')
+        return name
+
+    def sample(self, name, value, labels=None):
+        self.lines.append(f'{name}{self._labels(labels)} {self._value(value)}')
+
+    def metric(self, name, kind, help_text, value, labels=None):
+        """Write a family with a single sample"""
+        self.sample(self.family(name, kind, help_text), value, labels)
+
+    def histogram(self, name, histogram, labels=None, bounds=METRICS_LATENCY_BUCKETS):
+        """Write the samples of a LatencyHistogram into an already started histogram family"""
+        labels = labels or {}
+        for bound, count in zip(bounds, histogram.cumulative_counts(bounds)):
+            self.sample(f'{name}_bucket', count, {**labels, 'le': bound})
+        self.sample(f'{name}_bucket', histogram.count, {**labels, 'le': '+Inf'})
+        self.sample(f'{name}_sum', round(histogram.total, 6), labels)
+        self.sample(f'{name}_count', histogram.count, labels)
+
+    def render(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+def render_metrics():
+    """Collect the monitor, session and queue counters as Prometheus text"""
+    writer = MetricsWriter()
+    counters, histograms = network_monitor.get_metrics_snapshot()
+
+    writer.metric('upstream_requests_total', 'counter', 'Upstream requests started', counters['total_requests'])
+    name = writer.family('upstream_request_results_total', 'counter', 'Finished upstream requests by result')
+    writer.sample(name, counters['successful_requests'], {'result': 'success'})
+    writer.sample(name, counters['failed_requests'], {'result': 'failure'})
+    name = writer.family('upstream_errors_total', 'counter', 'Failed upstream requests by error type')
+    for error_type in ('timeout', 'connection', 'ssl', 'other'):
+        writer.sample(name, counters[f'{error_type}_errors'], {'type': error_type})
+    name = writer.family('upstream_pool_requests_total', 'counter', 'Upstream requests by connection pool reuse')
+    writer.sample(name, counters['pool_hits'], {'result': 'hit'})
+    writer.sample(name, counters['pool_misses'], {'result': 'miss'})
+    writer.metric('coalesced_requests_total', 'counter', 'Requests served by an identical in-flight request',
+                  counters['coalesced_requests'])
+
+    name = writer.family('upstream_latency_seconds', 'histogram',
+                         'Upstream latency by phase (total, ttfb, ttft, dns, connect, upstream)')
+    for (phase, model, live_search), histogram in sorted(histograms, key=lambda item: tuple(map(str, item[0]))):
+        writer.histogram(name, histogram, {
+            'phase': phase,
+            'model': model or '',
+            'live_search': '' if live_search is None else str(bool(live_search)).lower()
+        })
+
+    writer.metric('active_sockets', 'gauge', 'Connected Socket.IO clients', counters['active_sockets'])
+    conversation_stats = session_manager.get_stats()
+    writer.metric('conversations', 'gauge', 'Conversations held by the session store', conversation_stats['conversations'])
+    writer.metric('history_bytes', 'gauge', 'Message content bytes held by the session store', conversation_stats['bytes'])
+    name = writer.family('conversations_removed_total', 'counter', 'Conversations removed by the session store')
+    writer.sample(name, conversation_stats.get('evicted_conversations', 0), {'reason': 'evicted'})
+    writer.sample(name, conversation_stats.get('expired_conversations', 0), {'reason': 'expired'})
+
+    job_stats = message_jobs.get_stats()
+    writer.metric('message_queue_depth', 'gauge', 'Messages waiting for a worker', job_stats['queue_depth'])
+    writer.metric('message_workers_busy', 'gauge', 'Workers processing a message', job_stats['busy_workers'])
+    name = writer.family('message_jobs_total', 'counter', 'Message jobs by outcome')
+    for outcome in ('submitted', 'rejected', 'cancelled', 'completed', 'failed'):
+        writer.sample(name, job_stats[outcome], {'outcome': outcome})
+    writer.histogram(writer.family('message_queue_wait_seconds', 'histogram', 'Time messages waited for a worker'),
+                     message_jobs.get_wait_histogram())
+
+    cache_stats = response_cache.get_stats()
+    name = writer.family('response_cache_lookups_total', 'counter', 'Response cache lookups by result')
+    writer.sample(name, cache_stats['hits'], {'result': 'hit'})
+    writer.sample(name, cache_stats['misses'], {'result': 'miss'})
+    writer.metric('circuit_breaker_open', 'gauge', 'Whether the upstream circuit breaker is open',
+                  int(circuit_breaker.is_open()))
+    limiter_stats = admission_scheduler.get_stats()
+    name = writer.family('rate_limiter_requests_total', 'counter', 'Rate limiter decisions')
+    for outcome in ('admitted', 'rejected', 'throttled'):
+        writer.sample(name, limiter_stats[outcome], {'outcome': outcome})
+    if conversation_summarizer:
+        summary_stats = conversation_summarizer.get_stats()
+        name = writer.family('conversation_summaries_total', 'counter', 'Conversation summaries by outcome')
+        writer.sample(name, summary_stats['summaries'], {'outcome': 'written'})
+        writer.sample(name, summary_stats['failed'], {'outcome': 'failed'})
+        writer.metric('summary_prompt_tokens_saved_total', 'counter',
+                      'Prompt tokens saved by sending conversation summaries', summary_stats['saved_tokens'])
+    return writer.render()
+
+# ===== Batch Completions =====
+class BatchRunner:
+    """Run JSONL batches of completions with bounded concurrency
+
+    Every successful item is appended to a per-batch results file before it
+    is streamed back, so re-submitting a batch with the same ID after a
+    crash or dropped connection skips the items that already finished and
+    runs the failed ones again.
+    The file starts with a header naming the owner (the API key digest)
+    that created the batch; only that owner may resume it.
+    Upstream calls go through send_message, so batches share the response
+    cache, retries and the per-key rate limits with interactive chats.
+    """
+
+    BATCH_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+    def __init__(self, directory='batches', concurrency=4, max_items=10000, ttl=7 * 24 * 3600):
         """
-        try:
-            # Clean the message data
-            clean_message = self.sanitize_message(message)
-            if not clean_message:
-                logger.warning(f"Skipping invalid message for conversation: {conversation_id}")
-                return
-            
-            # Create new conversation if it doesn't exist
-            if conversation_id not in self.conversation_history:
-                self.conversation_history[conversation_id] = {
-                    'messages': [],
-                    'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                    'title': clean_message.get('content', '')[:30] + '...' if len(clean_message.get('content', '')) > 30 else clean_message.get('content', '')
-                }
-            
-            conv = self.conversation_history[conversation_id]
-            messages = conv['messages']
-            
-            # If message count exceeds limit, remove older messages
-            if len(messages) >= self.max_messages_per_conversation:
-                # Keep system messages and most recent user/assistant messages
-                system_messages = [msg for msg in messages if msg.get('role') == 'system']
-                other_messages = [msg for msg in messages if msg.get('role') != 'system']
-                
-                # Calculate how many non-system messages to keep
-                keep_count = max(1, self.max_messages_per_conversation - len(system_messages))
-                # Keep only the newest messages
-                kept_messages = system_messages + other_messages[-keep_count:]
-                
-                # Replace message list
-                conv['messages'] = kept_messages
-                logger.debug(f"Conversation {conversation_id} messages after cleanup: {len(kept_messages)}")
-            
-            # Add new message
-            conv['messages'].append(clean_message)
-            # Update timestamp
-            conv['timestamp'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            logger.debug(f"Message added to conversation {conversation_id}, current count: {len(conv['messages'])}")
-            
-            # Periodically clean up old conversations
-            if len(self.conversation_history) > self.max_conversations:
-                self.cleanup_old_conversations()
-                
-        except Exception as e:
-            error_trace = log_exception(e, f"Error adding message to conversation {conversation_id}")
-            raise RuntimeError(f"Failed to add message to conversation: {str(e)}")
-    
-    def get_conversation_messages(self, conversation_id):
-        """Get messages for a specific conversation
-        
         Args:
-            conversation_id: ID of the conversation
-            
-        Returns:
-            List of messages or empty list if conversation doesn't exist
+            directory: Where per-batch results files are kept
+            concurrency: Maximum items of one batch in flight at once
+            max_items: Maximum items accepted in one batch
+            ttl: Seconds after its last write before a results file is deleted
+        """
+        self.directory = directory
+        self.concurrency = concurrency
+        self.max_items = max_items
+        self.ttl = ttl
+        self.running = set()  # Batch IDs currently being processed
+        self.stats = {'batches': 0, 'resumed_batches': 0, 'items': 0, 'failed_items': 0, 'skipped_items': 0}
+        self.lock = threading.Lock()
+
+    def new_batch_id(self):
+        return f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{random.getrandbits(48):012x}"
+
+    def results_path(self, batch_id):
+        return os.path.join(self.directory, f'{batch_id}.jsonl')
+
+    def parse(self, body):
+        """Parse a JSONL request body into (items, errors)
+
+        Each line is an object with an optional "id" (defaults to the line
+        number), either "messages" or a single "message" (with an optional
+        "system" prompt), and optional "model" and "live_search".
+        """
+        items = []
+        errors = []
+        seen = set()
+        for number, line in enumerate(body.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+                if not isinstance(entry, dict):
+                    raise ValueError('line is not a JSON object')
+                item_id = str(entry.get('id', number))
+                if item_id in seen:
+                    raise ValueError(f'duplicate id {item_id}')
+                messages = entry.get('messages')
+                if messages is None and isinstance(entry.get('message'), str):
+                    messages = [{'role': 'user', 'content': entry['message']}]
+                    if isinstance(entry.get('system'), str):
+                        messages.insert(0, {'role': 'system', 'content': entry['system']})
+                if not isinstance(messages, list) or not messages or not all(
+                    isinstance(msg, dict) and isinstance(msg.get('role'), str) and isinstance(msg.get('content'), str)
+                    for msg in messages
+                ):
+                    raise ValueError('"messages" must be a non-empty list of {role, content} objects')
+                if entry.get('model') is not None and not isinstance(entry['model'], str):
+                    raise ValueError('"model" must be a string')
+            except ValueError as e:
+                errors.append({'line': number, 'error': str(e)})
+                continue
+            seen.add(item_id)
+            items.append({
+                'id': item_id,
+                'messages': [{'role': msg['role'], 'content': msg['content']} for msg in messages],
+                'model': entry.get('model'),
+                'live_search': bool(entry.get('live_search', False))
+            })
+        if len(items) > self.max_items:
+            raise ValueError(f'A batch may contain at most {self.max_items} items')
+        return items, errors
+
+    def get_owner(self, batch_id):
+        """Owner recorded in a batch's results file, None if the batch doesn't exist
+
+        Files without a valid header yield '', which matches no owner.
         """
         try:
-            messages = self.conversation_history.get(conversation_id, {}).get('messages', [])
-            # Return a copy of messages list to avoid reference issues
-            return list(messages)
-        except Exception as e:
-            logger.error(f"Error getting conversation messages: {str(e)}")
-            return []
-            
-    def get_conversation_count(self):
-        """Get the current number of conversations"""
-        return len(self.conversation_history)
-        
-    def clear_old_data(self):
-        """Periodically clean up expired data (conversations older than 24 hours)"""
+            with open(self.results_path(batch_id), 'r', encoding='utf-8') as results:
+                header = json.loads(results.readline())
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            return ''
+        return header.get('owner', '') if isinstance(header, dict) else ''
+
+    def load_finished(self, batch_id):
+        """Results already written for a batch, by item ID"""
+        finished = {}
         try:
-            # Clean up conversations older than 24 hours
-            current_time = datetime.now()
-            old_conversations = []
-            
-            for cid, conv in self.conversation_history.items():
-                try:
-                    conv_time = datetime.strptime(conv['timestamp'], '%Y-%m-%d %H:%M:%S')
-                    if (current_time - conv_time).days >= 1:
-                        old_conversations.append(cid)
-                except (ValueError, KeyError):
-                    continue
-            
-            for cid in old_conversations:
-                del self.conversation_history[cid]
-                
-            if old_conversations:
-                logger.info(f"Cleared {len(old_conversations)} expired conversations")
-        except Exception as e:
-            logger.error(f"Error clearing expired data: {str(e)}")
+            with open(self.results_path(batch_id), 'r', encoding='utf-8') as results:
+                for line in results:
+                    try:
+                        result = json.loads(line)
+                    except ValueError:
+                        continue  # Line cut short by a crash; the item runs again
+                    if 'id' in result and 'error' not in result:
+                        finished[result['id']] = result
+        except FileNotFoundError:
+            pass
+        return finished
 
-# Initialize session manager with smaller defaults for cloud environment
-session_manager = SessionManager(max_conversations=50, max_messages_per_conversation=30)
-conversation_history = session_manager.conversation_history
-user_api_keys = session_manager.user_api_keys
-user_live_search_settings = session_manager.user_live_search_settings
+    def start(self, batch_id):
+        """Claim a batch ID, False if it is already running"""
+        with self.lock:
+            if batch_id in self.running:
+                return False
+            self.running.add(batch_id)
+            return True
 
-# Background task to clean up old data
-def cleanup_task():
-    """Background task to clean up old data"""
-    while True:
+    def release(self, batch_id):
+        with self.lock:
+            self.running.discard(batch_id)
+
+    def run_item(self, item, api_key):
+        started = time.time()
+        response_data = send_message(item['messages'], api_key, item['live_search'], item['model'])
+        result = {'id': item['id']}
+        if 'error' in response_data:
+            result['error'] = response_data['error']
+        else:
+            response = response_data['response']
+            choices = response.get('choices') or [{}]
+            result['content'] = (choices[0].get('message') or {}).get('content')
+            result['finish_reason'] = choices[0].get('finish_reason')
+            for field in ('usage', 'citations'):
+                if response.get(field):
+                    result[field] = response[field]
+            result['cached'] = response_data.get('cached', False)
+        result['model'] = item['model'] or os.getenv('MODEL_NAME', 'grok-4-latest')
+        result['response_time'] = round(time.time() - started, 3)
+        return result
+
+    def run(self, batch_id, items, api_key, owner, concurrency=None):
+        """Process a claimed batch, yielding a result per item as it finishes
+
+        Results of items finished in an earlier run come first, marked
+        "resumed". Closing the generator (the client went away) stops new
+        items from starting; items already in flight still finish and are
+        saved for the next run.
+        """
         try:
-            session_manager.clear_old_data()
-            time.sleep(3600)  # Run every hour
-        except Exception as e:
-            logger.error(f"Error in cleanup task: {str(e)}")
-            time.sleep(60)  # Wait 1 minute before retrying if error occurs
+            os.makedirs(self.directory, exist_ok=True)
+            finished = self.load_finished(batch_id)
+            todo = deque(item for item in items if item['id'] not in finished)
+            with self.lock:
+                self.stats['batches'] += 1
+                self.stats['skipped_items'] += len(items) - len(todo)
+                if finished:
+                    self.stats['resumed_batches'] += 1
 
-def get_conversation_id():
-    """Get current conversation ID from session or create a new one"""
-    if 'conversation_id' not in session:
-        session['conversation_id'] = datetime.now().strftime('%Y%m%d%H%M%S')
-    return session['conversation_id']
+            results = queue.Queue()
+            state = {'stopped': False}
+            workers = min(len(todo), max(1, min(concurrency or self.concurrency, self.concurrency)))
+            file_lock = threading.Lock()  # Guards todo and the results file
+            results_file = open(self.results_path(batch_id), 'a', encoding='utf-8')
+            if results_file.tell() == 0:
+                results_file.write(json.dumps({'batch_id': batch_id, 'owner': owner}) + '\n')
+                results_file.flush()
 
-def calculate_tokens(messages):
-    """Simple token calculation method, each character counts as 1 token"""
-    total_tokens = sum(len(msg['content']) for msg in messages)
-    return total_tokens
+            def worker():
+                while not state['stopped']:
+                    with file_lock:
+                        if not todo:
+                            break
+                        item = todo.popleft()
+                    try:
+                        result = self.run_item(item, api_key)
+                    except Exception as e:
+                        log_exception(e, f"Batch {batch_id} item {item['id']} failed")
+                        result = {'id': item['id'], 'error': 'Unknown error occurred'}
+                    if 'error' not in result:
+                        # Failed items are not saved, so a resumed run retries them
+                        with file_lock:
+                            results_file.write(json.dumps(result, ensure_ascii=False) + '\n')
+                            results_file.flush()
+                    with self.lock:
+                        self.stats['items'] += 1
+                        if 'error' in result:
+                            self.stats['failed_items'] += 1
+                    results.put(result)
+                results.put(None)  # This worker is done
 
-def dns_precheck(hostname, max_retries=3):
-    """DNS预检查，确保域名可以解析，带重试机制"""
-    import socket
-    import time
-    
-    for attempt in range(max_retries):
+            for _ in range(workers):
+                socketio.start_background_task(worker)
+            remaining = workers
+            try:
+                for item in items:
+                    if item['id'] in finished:
+                        yield dict(finished[item['id']], resumed=True)
+                while remaining:
+                    result = results.get()
+                    if result is None:
+                        remaining -= 1
+                    else:
+                        yield result
+            finally:
+                state['stopped'] = True
+                if remaining:
+                    # Close the file once the in-flight items have been saved
+                    def close_when_done(remaining=remaining):
+                        for _ in range(remaining):
+                            while results.get() is not None:
+                                pass
+                        results_file.close()
+                    socketio.start_background_task(close_when_done)
+                else:
+                    results_file.close()
+        finally:
+            self.release(batch_id)
+
+    def delete_expired(self):
+        """Delete results files not written to within the TTL"""
         try:
-            result = socket.gethostbyname(hostname)
-            if attempt > 0:
-                logger.info(f"DNS resolution successful for {hostname} on attempt {attempt + 1}: {result}")
-            else:
-                logger.debug(f"DNS resolution successful for {hostname}: {result}")
-            return True
-        except socket.gaierror as e:
-            logger.warning(f"DNS resolution failed for {hostname} on attempt {attempt + 1}: {e}")
-            if attempt < max_retries - 1:
-                time.sleep(0.5)  # 短暂延迟后重试
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return 0
+        cutoff = time.time() - self.ttl
+        deleted = 0
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if name.endswith('.jsonl') and name[:-6] not in self.running and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                deleted += 1
+        return deleted
+
+    def get_stats(self):
+        with self.lock:
+            stats = self.stats.copy()
+            stats['running'] = len(self.running)
+        stats['concurrency'] = self.concurrency
+        return stats
+
+
+batch_runner = BatchRunner(
+    directory=os.getenv('BATCH_DIR', 'batches'),
+    concurrency=int(os.getenv('BATCH_CONCURRENCY', '4')),
+    max_items=int(os.getenv('BATCH_MAX_ITEMS', '10000')),
+    ttl=int(os.getenv('BATCH_TTL', str(7 * 24 * 3600)))
+)
+
+def dns_precheck(hostname, max_retries=3):
+    """DNS预检查，确保域名可以解析
+
+    Served from the upstream client's resolver cache, so on the request path
+    this is a dictionary lookup; only a cold or expired entry resolves inline.
+    """
+    dns_cache = upstream_client.dns_cache
+    dns_cache.watch(hostname)
+    return dns_cache.resolve(hostname, max_retries=max_retries) is not None
+
+class StreamInterruptedError(Exception):
+    """Raised when an SSE stream breaks after content was already delivered"""
+
+
+def read_stream_response(response, on_chunk=None, monitor_start_time=None, model=None, live_search=None):
+    """Read an SSE chat completion stream and assemble the full reply
+
+    Args:
+        response: Streaming requests response with status 200
+        on_chunk: Optional callback invoked with each content delta
+        monitor_start_time: Request start time used to measure time-to-first-token
+        model: Model name the time-to-first-token is recorded under
+        live_search: Whether Live Search was on, for the time-to-first-token breakdown
+
+    Returns:
+        Tuple of (response_json, ttft) where response_json has the same shape
+        as a non-streaming completion and ttft is None if no content arrived
+    """
+    parts = []
+    ttft = None
+    done = False
+    finish_reason = None
+    last_chunk = {}
+    extra = {}
+
+    try:
+        for line in response.iter_lines(decode_unicode=True):
+            # Skip keep-alive blank lines and SSE comments
+            if not line or line.startswith(':'):
                 continue
-            else:
-                logger.error(f"DNS resolution failed for {hostname} after {max_retries} attempts: {e}")
-                return False
-        except Exception as e:
-            logger.error(f"Unexpected error during DNS resolution for {hostname} on attempt {attempt + 1}: {e}")
-            if attempt < max_retries - 1:
-                time.sleep(0.5)
+            if not line.startswith('data:'):
                 continue
-            else:
-                return False
-    
-    return False
 
-def send_message(messages, api_key=None, enable_live_search=False, model=None):
+            payload = line[5:].strip()
+            if payload == '[DONE]':
+                # Keep draining to EOF so the connection can return to the pool
+                done = True
+            if done:
+                continue
+
+            chunk = json.loads(payload)
+            last_chunk = chunk
+            # Live Search returns citations and usage on the final chunks
+            for field in ('citations', 'usage'):
+                if chunk.get(field):
+                    extra[field] = chunk[field]
+
+            choices = chunk.get('choices') or []
+            if not choices:
+                continue
+            if choices[0].get('finish_reason'):
+                finish_reason = choices[0]['finish_reason']
+
+            delta = (choices[0].get('delta') or {}).get('content')
+            if not delta:
+                continue
+
+            if ttft is None and monitor_start_time is not None:
+                ttft = network_monitor.record_first_token(monitor_start_time, model=model, live_search=live_search)
+            parts.append(delta)
+            if on_chunk:
+                on_chunk(delta)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        if parts:
+            # Content has already reached the client, a retry would duplicate it
+            raise StreamInterruptedError(str(e)) from e
+        raise
+    finally:
+        response.close()
+
+    response_json = {
+        'id': last_chunk.get('id'),
+        'model': last_chunk.get('model'),
+        'object': 'chat.completion',
+        'choices': [{
+            'index': 0,
+            'message': {'role': 'assistant', 'content': ''.join(parts)},
+            'finish_reason': finish_reason
+        }]
+    }
+    response_json.update(extra)
+    return response_json, ttft
+
+
+def send_message(messages, api_key=None, enable_live_search=False, model=None, stream=False, on_chunk=None):
     """Send messages to the API and get response with intelligent retry and monitoring
-    
+
+    Deterministic requests (temperature 0) are answered from the response
+    cache when possible, and concurrent identical ones made with the same
+    API key share a single upstream call.
+
     Args:
         messages: List of message objects to send
         api_key: API key for authentication
         enable_live_search: Whether to enable Live Search functionality
         model: Model name to use for the request
-        
+        stream: Whether to read the completion incrementally as an SSE stream
+        on_chunk: Callback invoked with each content delta when streaming
+
     Returns:
         Dictionary containing response or error information
     """
@@ -499,6 +4292,56 @@ def send_message(messages, api_key=None, enable_live_search=False, model=None):
         logger.error("API key not set")
         return {'error': 'Please configure a valid API key in settings'}
     
+    # Use provided model or fallback to environment variable
+    if model is None:
+        model = os.getenv('MODEL_NAME', 'grok-4-latest')
+    temperature = float(os.getenv('TEMPERATURE', '0'))
+    search_parameters = dict(LIVE_SEARCH_PARAMETERS) if enable_live_search else None
+    
+    try:
+        request_key = response_cache.make_key(
+            messages, model, temperature, search_parameters, session_manager.owner_for_key(api_key)
+        )
+    except (TypeError, KeyError, AttributeError):
+        request_key = None  # Malformed messages are rejected by the validation in _send_upstream
+    
+    # Identical deterministic prompts are answered from the response cache without an upstream call
+    if request_key:
+        cached = response_cache.get(request_key)
+        if cached is not None:
+            logger.debug("Response cache hit for model %s", model)
+            if stream and on_chunk:
+                on_chunk(cached['choices'][0]['message']['content'])
+            return {
+                'response': cached,
+                'response_time': 0,
+                'ttft': 0 if stream else None,
+                'token_count': calculate_tokens(messages),
+                'attempt': 0,
+                'cached': True
+            }
+    
+    def fetch(chunk_callback):
+        return _send_upstream(
+            messages, api_key, model, temperature, search_parameters,
+            stream=stream, on_chunk=chunk_callback, request_key=request_key
+        )
+    
+    if request_key and request_coalescer.enabled:
+        return request_coalescer.run(request_key, fetch, stream=stream, on_chunk=on_chunk)
+    return fetch(on_chunk)
+
+def _send_upstream(messages, api_key, model, temperature, search_parameters, stream=False, on_chunk=None,
+                   request_key=None):
+    """Call the upstream API with retries (the uncached, uncoalesced part of send_message)
+
+    Args:
+        search_parameters: Live Search parameters, or None when Live Search is off
+        request_key: Response cache key; successful responses are stored under it
+
+    Returns:
+        Dictionary containing response or error information
+    """
     # 记录请求开始
     monitor_start_time = network_monitor.record_request_start()
     
@@ -515,45 +4358,41 @@ def send_message(messages, api_key=None, enable_live_search=False, model=None):
                 network_monitor.record_request_failure(monitor_start_time, "ValidationError", "Missing required fields")
                 return {'error': 'Invalid message format'}
         
-        # Log request details
-        request_id = datetime.now().strftime('%Y%m%d%H%M%S')
-        logger.debug(f"API request[{request_id}] initializing: message count={len(messages)}")
-        logger.debug(f"API request[{request_id}] URL: {API_URL}")
+        # Log request details under the trace ID so these lines join the handler's
+        request_id = tracer.current_id()
+        logger.debug("API request[%s] initializing: message count=%s", request_id, len(messages))
+        logger.debug("API request[%s] URL: %s", request_id, API_URL)
         
         # DNS预检查
-        from urllib.parse import urlparse
         parsed_url = urlparse(API_URL)
         hostname = parsed_url.hostname
+        live_search = bool(search_parameters)
         
-        if not dns_precheck(hostname):
-            logger.error(f"DNS resolution failed for {hostname}")
+        dns_started = time.perf_counter()
+        with tracer.span('dns', host=hostname):
+            dns_ok = dns_precheck(hostname)
+        network_monitor.record_latency('dns', time.perf_counter() - dns_started, model=model, live_search=live_search)
+        if not dns_ok:
+            logger.error("DNS resolution failed for %s", hostname)
             network_monitor.record_request_failure(monitor_start_time, "DNSError", f"Cannot resolve {hostname}")
             return {'error': f'DNS resolution failed for {hostname}. Please check your network connection.'}
         
-        logger.debug(f"DNS check passed for {hostname}")
+        logger.debug("DNS check passed for %s", hostname)
         
-        # Use provided model or fallback to environment variable
-        if model is None:
-            model = os.getenv('MODEL_NAME', 'grok-4-latest')
-        temperature = float(os.getenv('TEMPERATURE', '0'))
-        logger.debug(f"API request[{request_id}] model: {model}, temperature: {temperature}")
+        logger.debug("API request[%s] model: %s, temperature: %s", request_id, model, temperature)
         
         # Build request data
         data = {
             'messages': messages,
             'model': model,
-            'stream': False,
+            'stream': stream,
             'temperature': temperature
         }
         
         # Add Live Search parameters if enabled
-        if enable_live_search:
-            data['search_parameters'] = {
-                'mode': 'auto',
-                'max_search_results': 5,
-                'time_range': '24h'
-            }
-            logger.debug(f"API request[{request_id}] Live Search enabled")
+        if search_parameters:
+            data['search_parameters'] = search_parameters
+            logger.debug("API request[%s] Live Search enabled", request_id)
         
         # Build request headers
         headers = {
@@ -562,106 +4401,171 @@ def send_message(messages, api_key=None, enable_live_search=False, model=None):
             'User-Agent': 'Grok-API-Client/1.3.0'
         }
         
-        # 智能重试机制
-        max_retries = 3
-        base_delay = 1  # 基础延迟1秒
+        # 智能重试机制：抖动退避、Retry-After、熔断与对冲请求由 retry_policy / circuit_breaker 控制
+        max_attempts = retry_policy.max_attempts
+        delay = None
         
-        for attempt in range(max_retries):
+        for attempt in range(max_attempts):
+            # Fail fast while the upstream is known to be unhealthy
+            if not circuit_breaker.allow():
+                logger.warning("API request[%s] rejected, circuit breaker is open", request_id)
+                network_monitor.record_request_failure(monitor_start_time, "CircuitOpenError", "Upstream API unavailable")
+                return {'error': 'The API is temporarily unavailable, please try again shortly'}
+            
+            # Wait for this key's turn under the per-key and global rate limits
+            with tracer.span('admission'):
+                queue_wait = admission_scheduler.acquire(api_key)
+            if queue_wait is None:
+                logger.warning("API request[%s] rejected, rate limit queue wait exceeded", request_id)
+                network_monitor.record_request_failure(monitor_start_time, "RateLimitError", "Admission queue timeout")
+                return {'error': 'Too many requests with this API key, please try again later'}
+            if queue_wait > 0.01:
+                logger.debug("API request[%s] admitted after %.2fs in the rate limit queue", request_id, queue_wait)
+            
             try:
                 # 计算超时时间（根据尝试次数递增）
-                timeout = 15 + (attempt * 10)  # 15s, 25s, 35s
+                timeout = retry_policy.attempt_timeout(attempt)
                 
-                logger.debug(f"API request[{request_id}] attempt {attempt + 1}/{max_retries}, timeout: {timeout}s")
+                logger.debug("API request[%s] attempt %s/%s, timeout: %ss", request_id, attempt + 1, max_attempts, timeout)
                 
                 start_time = datetime.now()
+                network_monitor.take_connect_time()
                 
-                # Use requests library with proper error handling
-                import requests
+                # Use the pooled keep-alive client to skip per-call TCP+TLS handshakes
+                with tracer.span('upstream_wait', attempt=attempt + 1) as span:
+                    response = retry_policy.hedge(lambda: upstream_client.post(
+                        API_URL,
+                        json=data, 
+                        headers=headers,
+                        timeout=timeout,
+                        stream=stream,
+                        verify=False  # Disable SSL verification to avoid issues
+                    ))
+                    span['status'] = response.status_code
+
+                response_time = (datetime.now() - start_time).total_seconds()
+                logger.debug("API request[%s] response status: %s, time: %ss", request_id, response.status_code, response_time)
                 
-                response = requests.post(
-                    API_URL, 
-                    json=data, 
-                    headers=headers, 
-                    timeout=timeout,
-                    verify=False  # Disable SSL verification to avoid issues
+                # Time to response headers, and the part of it the upstream spent beyond connecting
+                ttfb = response.elapsed.total_seconds()
+                network_monitor.record_latency('ttfb', ttfb, model=model, live_search=live_search)
+                network_monitor.record_latency(
+                    'upstream', max(0.0, ttfb - network_monitor.take_connect_time()), model=model, live_search=live_search
                 )
-                
-                response_time = (datetime.now() - start_time).total_seconds()
-                logger.debug(f"API request[{request_id}] response status: {response.status_code}, time: {response_time}s")
-                    
+
+                # Any answer other than a server error shows the upstream is reachable. A 200 is only
+                # recorded once its body has been read, so a stream that breaks counts as one failure.
+                if response.status_code in [500, 502, 503, 504]:
+                    circuit_breaker.record_failure()
+                elif response.status_code != 200:
+                    circuit_breaker.record_success()
+
                 # Handle different status codes
                 if response.status_code == 200:
-                    response_json = response.json()
+                    ttft = None
+                    if stream:
+                        with tracer.span('stream_read'):
+                            response_json, ttft = read_stream_response(
+                                response, on_chunk, monitor_start_time, model=model, live_search=live_search
+                            )
+                        response_time = (datetime.now() - start_time).total_seconds()
+                    else:
+                        with tracer.span('json_parse'):
+                            response_json = response.json()
+                    circuit_breaker.record_success()
                     token_count = calculate_tokens(messages)
-                    
+                    if request_key and response_json.get('choices'):
+                        response_cache.put(request_key, response_json, live_search=live_search)
+
                     # 记录成功请求
-                    network_monitor.record_request_success(monitor_start_time, len(str(response_json)))
-                    
-                    logger.info(f"API request[{request_id}] successful on attempt {attempt + 1}, total time: {response_time}s")
-                    
+                    admission_scheduler.record_success(api_key)
+                    network_monitor.record_request_success(
+                        monitor_start_time, len(str(response_json)), model=model, live_search=live_search
+                    )
+
+                    logger.info("API request[%s] successful on attempt %s, total time: %ss", request_id, attempt + 1, response_time)
+
                     return {
                         'response': response_json,
                         'response_time': response_time,
+                        'ttft': ttft,
                         'token_count': token_count,
                         'attempt': attempt + 1
                     }
                     
                 elif response.status_code == 401:
                     # 认证错误不重试
+                    response.close()
                     network_monitor.record_request_failure(monitor_start_time, "AuthenticationError", "Invalid API key")
                     return {'error': 'Invalid or expired API key, please update your API key'}
                 elif response.status_code == 429:
-                    # 速率限制，可以重试
-                    if attempt < max_retries - 1:
-                        delay = base_delay * (2 ** attempt)  # 指数退避
-                        logger.warning(f"Rate limit hit, retrying in {delay}s...")
-                        time.sleep(delay)
+                    # 速率限制：降低该密钥的准入速率并按 Retry-After 暂停，重试在准入队列中等待而不是原地 sleep
+                    response.close()
+                    throttled = admission_scheduler.record_rate_limited(api_key, RetryPolicy.parse_retry_after(response))
+                    if attempt < max_attempts - 1:
+                        if not throttled:
+                            # Per-key limits are off and no Retry-After was sent: back off here instead
+                            delay = retry_policy.next_delay(delay)
+                            logger.warning("Rate limit hit, retrying in %.2fs...", delay)
+                            socketio.sleep(delay)
+                        else:
+                            logger.warning("Rate limit hit, retry queued for admission")
                         continue
-                    else:
-                        network_monitor.record_request_failure(monitor_start_time, "RateLimitError", "Rate limit exceeded")
-                        return {'error': 'API request rate limit exceeded, please try again later'}
+                    network_monitor.record_request_failure(monitor_start_time, "RateLimitError", "Rate limit exceeded")
+                    return {'error': 'API request rate limit exceeded, please try again later'}
                 elif response.status_code in [500, 502, 503, 504]:
                     # 服务器错误，可以重试
-                    if attempt < max_retries - 1:
-                        delay = base_delay * (2 ** attempt)
-                        logger.warning(f"Server error {response.status_code}, retrying in {delay}s...")
-                        time.sleep(delay)
-                        continue
-                    else:
-                        network_monitor.record_request_failure(monitor_start_time, "ServerError", f"Server error {response.status_code}")
-                        return {'error': 'API server error, please try again later'}
+                    response.close()
+                    if attempt < max_attempts - 1 and not circuit_breaker.is_open():
+                        delay = retry_policy.next_delay(delay, RetryPolicy.parse_retry_after(response))
+                        if delay is not None:
+                            logger.warning("Server error %s, retrying in %.2fs...", response.status_code, delay)
+                            socketio.sleep(delay)
+                            continue
+                    network_monitor.record_request_failure(monitor_start_time, "ServerError", f"Server error {response.status_code}")
+                    return {'error': 'API server error, please try again later'}
                 else:
                     try:
                         error_data = response.json()
                         error_msg = error_data.get('error', {}).get('message', f'API error: {response.status_code}')
                     except:
                         error_msg = f'API error: {response.status_code}'
+                    response.close()
                     
                     network_monitor.record_request_failure(monitor_start_time, "APIError", error_msg)
                     return {'error': error_msg}
-                    
+
+            except StreamInterruptedError as e:
+                # 已经向客户端推送了部分内容，不再重试
+                circuit_breaker.record_failure()
+                logger.error("API request[%s] stream interrupted: %s", request_id, e)
+                network_monitor.record_request_failure(monitor_start_time, "StreamInterruptedError", str(e))
+                return {'error': 'Response stream was interrupted, please try again'}
             except requests.exceptions.Timeout:
-                if attempt < max_retries - 1:
-                    delay = base_delay * (2 ** attempt)
-                    logger.warning(f"Request timeout on attempt {attempt + 1}, retrying in {delay}s...")
-                    time.sleep(delay)
+                circuit_breaker.record_failure()
+                if attempt < max_attempts - 1 and not circuit_breaker.is_open():
+                    delay = retry_policy.next_delay(delay)
+                    logger.warning("Request timeout on attempt %s, retrying in %.2fs...", attempt + 1, delay)
+                    socketio.sleep(delay)
                     continue
                 else:
-                    logger.error(f"API request[{request_id}] timeout after {max_retries} attempts")
+                    logger.error("API request[%s] timeout after %s attempts", request_id, attempt + 1)
                     network_monitor.record_request_failure(monitor_start_time, "TimeoutError", "Request timeout")
                     return {'error': 'API request timeout after multiple attempts, please check your network connection'}
             except requests.exceptions.ConnectionError as e:
-                if attempt < max_retries - 1:
-                    delay = base_delay * (2 ** attempt)
-                    logger.warning(f"Connection error on attempt {attempt + 1}, retrying in {delay}s...")
-                    time.sleep(delay)
+                circuit_breaker.record_failure()
+                if attempt < max_attempts - 1 and not circuit_breaker.is_open():
+                    delay = retry_policy.next_delay(delay)
+                    logger.warning("Connection error on attempt %s, retrying in %.2fs...", attempt + 1, delay)
+                    socketio.sleep(delay)
                     continue
                 else:
-                    logger.error(f"API request[{request_id}] connection error: {str(e)}")
+                    logger.error("API request[%s] connection error: %s", request_id, e)
                     network_monitor.record_request_failure(monitor_start_time, "ConnectionError", str(e))
                     return {'error': 'Network connection failed after multiple attempts, please check your internet connection'}
             except requests.exceptions.RequestException as e:
-                logger.error(f"API request[{request_id}] request error: {str(e)}")
+                circuit_breaker.record_failure()
+                logger.error("API request[%s] request error: %s", request_id, e)
                 network_monitor.record_request_failure(monitor_start_time, "RequestError", str(e))
                 return {'error': f'API request error: {str(e)}'}
                 
@@ -703,7 +4607,17 @@ def api_status():
         'max_conversations': session_manager.max_conversations,
         'max_messages_per_conversation': session_manager.max_messages_per_conversation,
         'current_conversations': session_manager.get_conversation_count(),
-        'live_search_enabled': True
+        'live_search_enabled': True,
+        'async_mode': socketio.async_mode,
+        'conversation_store': type(session_manager.store).__name__,
+        'conversation_stats': session_manager.get_stats(),
+        'message_jobs': message_jobs.get_stats(),
+        'batches': batch_runner.get_stats(),
+        'context': context_builder.get_stats(),
+        'summaries': conversation_summarizer.get_stats() if conversation_summarizer else None,
+        'conversation_log': session_manager.log.get_stats() if session_manager.log else None,
+        'message_queue': bool(os.getenv('SOCKETIO_MESSAGE_QUEUE')),
+        'log_records_dropped': log_queue_handler.dropped if log_queue_handler else 0
     }
 
 @app.route('/api/validate-key', methods=['POST'])
@@ -721,9 +4635,7 @@ def validate_api_key():
         if not re.match(r'^xai-[A-Za-z0-9]{50,}$', api_key):
             return {'valid': False, 'error': 'API密钥格式不正确'}
         
-        # 使用requests库测试API密钥
-        import requests
-        
+        # 使用共享的上游连接池测试API密钥
         url = API_URL
         headers = {
             'Content-Type': 'application/json',
@@ -738,7 +4650,7 @@ def validate_api_key():
         }
         
         try:
-            response = requests.post(url, headers=headers, json=data_payload, timeout=10, verify=False)
+            response = upstream_client.post(url, headers=headers, json=data_payload, timeout=10, verify=False)
             
             if response.status_code == 200:
                 return {'valid': True, 'message': 'API密钥验证成功'}
@@ -773,6 +4685,12 @@ def get_network_stats():
         return {
             'success': True,
             'stats': stats,
+            'latency': network_monitor.get_latency_stats(),
+            'upstream_pool': upstream_client.get_stats(),
+            'response_cache': response_cache.get_stats(),
+            'request_coalescing': request_coalescer.get_stats(),
+            'rate_limiter': admission_scheduler.get_stats(),
+            'message_jobs': message_jobs.get_stats(),
             'timestamp': datetime.now().isoformat()
         }, 200
     except Exception as e:
@@ -784,6 +4702,12 @@ def get_network_health():
     """Get network health status"""
     try:
         health = network_monitor.get_health_status()
+        health['dns_cache'] = upstream_client.dns_cache.get_stats()
+        health['circuit_breaker'] = circuit_breaker.get_stats()
+        health['retry_policy'] = retry_policy.get_stats()
+        health['rate_limiter'] = admission_scheduler.get_stats()
+        # Requests are shed while the breaker is open
+        health['healthy'] = health['healthy'] and health['circuit_breaker']['state'] != CircuitBreaker.OPEN
         return {
             'success': True,
             'health': health,
@@ -793,6 +4717,88 @@ def get_network_health():
         error_trace = log_exception(e, "Error getting network health")
         return {'success': False, 'error': 'Failed to get network health'}, 500
 
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus/OpenMetrics scrape endpoint"""
+    try:
+        return render_metrics(), 200, {'Content-Type': MetricsWriter.CONTENT_TYPE}
+    except Exception as e:
+        log_exception(e, "Error rendering metrics")
+        return 'Failed to render metrics\n', 500, {'Content-Type': 'text/plain; charset=utf-8'}
+
+@app.route('/api/batch', methods=['POST'])
+def run_batch():
+    """Run a JSONL batch of completions and stream the results back as JSONL
+
+    The API key is taken from the Authorization header (Bearer). Pass
+    ?batch_id= to resume a batch; the ID of a new batch is returned in the
+    X-Batch-Id header. ?concurrency= lowers the per-batch concurrency.
+    """
+    auth = request.headers.get('Authorization', '')
+    api_key = auth[7:].strip() if auth.startswith('Bearer ') else None
+    if not api_key:
+        return {'success': False, 'error': 'Provide the API key as "Authorization: Bearer <key>"'}, 401
+
+    batch_id = request.args.get('batch_id') or batch_runner.new_batch_id()
+    if not BatchRunner.BATCH_ID_PATTERN.match(batch_id):
+        return {'success': False, 'error': 'batch_id may only contain letters, digits, "_" and "-"'}, 400
+    concurrency = request.args.get('concurrency')
+    if concurrency is not None:
+        if not concurrency.isdigit() or int(concurrency) < 1:
+            return {'success': False, 'error': 'concurrency must be a positive integer'}, 400
+        concurrency = int(concurrency)
+    try:
+        items, errors = batch_runner.parse(request.get_data(as_text=True))
+    except ValueError as e:
+        return {'success': False, 'error': str(e)}, 400
+    if errors:
+        return {'success': False, 'error': 'Invalid batch lines', 'lines': errors[:100]}, 400
+    if not items:
+        return {'success': False, 'error': 'The batch is empty'}, 400
+    if not batch_runner.start(batch_id):
+        return {'success': False, 'error': f'Batch {batch_id} is already running'}, 409
+    # Resuming hands back saved completions, so only the key that created the batch may do it
+    owner = session_manager.owner_for_key(api_key)
+    if batch_runner.get_owner(batch_id) not in (None, owner):
+        batch_runner.release(batch_id)
+        return {'success': False, 'error': f'Batch {batch_id} belongs to another API key'}, 403
+
+    logger.info('Batch %s: %s items', batch_id, len(items))
+
+    def generate():
+        for result in batch_runner.run(batch_id, items, api_key, owner, concurrency):
+            yield json.dumps(result, ensure_ascii=False) + '\n'
+
+    response = Response(generate(), mimetype='application/x-ndjson', headers={'X-Batch-Id': batch_id})
+    # Also release the claim if the response is dropped before the body is read
+    response.call_on_close(lambda: batch_runner.release(batch_id))
+    return response
+
+@app.route('/api/traces', methods=['GET'])
+def get_traces():
+    """Get the most recent request traces (debugging)"""
+    try:
+        limit = max(1, min(int(request.args.get('limit', 50)), tracer.recent.maxlen))
+        return {
+            'success': True,
+            'tracing': tracer.get_stats(),
+            'traces': tracer.get_traces(limit),
+            'timestamp': datetime.now().isoformat()
+        }, 200
+    except ValueError:
+        return {'success': False, 'error': 'limit must be an integer'}, 400
+    except Exception as e:
+        log_exception(e, "Error getting traces")
+        return {'success': False, 'error': 'Failed to get traces'}, 500
+
+@app.route('/api/traces/<trace_id>', methods=['GET'])
+def get_trace(trace_id):
+    """Get one recent request trace by its ID (the request_id sent to clients)"""
+    trace = tracer.get_trace(trace_id)
+    if trace is None:
+        return {'success': False, 'error': 'Trace not found'}, 404
+    return {'success': True, 'trace': trace}, 200
+
 @app.route('/api/reset-stats', methods=['POST'])
 def reset_network_stats():
     """Reset network monitoring statistics"""
@@ -807,92 +4813,198 @@ def reset_network_stats():
         error_trace = log_exception(e, "Error resetting network stats")
         return {'success': False, 'error': 'Failed to reset network stats'}, 500
 
+# ===== Conversation List Updates =====
+# Each API key owns its conversations. A socket joins the room of its owner,
+# receives the full list once (update_history) and afterwards only the
+# changed entries (history_delta) with the new list version. A client whose
+# version does not directly precede a delta asks for the full list again.
+def owner_room(owner):
+    return f"owner:{owner}"
+
+def publish_history(owner, version, changes):
+    """Send conversation list changes to the sockets of their owner only"""
+    socketio.emit('history_delta', {'version': version, 'changes': changes}, room=owner_room(owner))
+
+session_manager.publish_history = publish_history
+
+def join_owner_room(api_key):
+    """Subscribe the calling socket to the room of the API key's owner, returning the owner"""
+    owner = session_manager.owner_for_key(api_key)
+    if owner is None:
+        return None
+    room = owner_room(owner)
+    for joined in rooms():
+        if joined.startswith('owner:') and joined != room:
+            leave_room(joined)  # The client switched API keys
+    join_room(room)
+    return owner
+
+def request_owner(data):
+    """Owner of the calling socket, from the event's api_key or the key the socket registered"""
+    api_key = (data or {}).get('api_key') or session_manager.get_api_key(request.sid)
+    if api_key and api_key != session_manager.get_api_key(request.sid):
+        session_manager.set_api_key(request.sid, api_key)
+    return join_owner_room(api_key)
+
 @socketio.on('get_history')
-def get_history():
-    socketio.emit('update_history', {
-        'conversations': [
-            {
-                'id': cid,
-                'title': conv['title'],
-                'timestamp': conv['timestamp']
-            } for cid, conv in conversation_history.items()
-        ]
-    })
+def get_history(data=None):
+    """Send one page of the caller's conversations: the newest without a cursor, older ones with next_cursor"""
+    data = data or {}
+    owner = request_owner(data)
+    cursor = data.get('cursor')
+    if not (isinstance(cursor, list) and len(cursor) == 2):
+        cursor = None
+    if owner:
+        history = session_manager.get_history(owner, cursor, data.get('limit'))
+    else:
+        history = {'conversations': [], 'version': 0, 'cursor': cursor, 'next_cursor': None}
+    socketio.emit('update_history', history, room=request.sid)
 
 @socketio.on('get_conversation')
 def get_conversation(data):
+    """Send one page of a conversation: the newest messages without before, older ones with next_cursor"""
     conversation_id = data['conversation_id']
-    if conversation_id in conversation_history:
+    owner = request_owner(data)
+    before = data.get('before')
+    if not isinstance(before, int):
+        before = None
+    if owner and session_manager.has_conversation(conversation_id, owner):
+        if before is None:
+            session_manager.touch_conversation(conversation_id)
+            # New messages from this socket continue the loaded conversation
+            session_manager.set_current_conversation(request.sid, conversation_id)
+        messages, next_cursor = session_manager.get_message_page(conversation_id, before, data.get('limit'))
         socketio.emit('load_conversation', {
-            'messages': conversation_history[conversation_id]['messages']
-        })
+            'conversation_id': conversation_id,
+            'messages': [msg.to_dict() for msg in messages],
+            'before': before,
+            'next_cursor': next_cursor
+        }, room=request.sid)
 
 @socketio.on('new_conversation')
 def handle_new_conversation():
-    # Reset session ID
-    session['conversation_id'] = datetime.now().strftime('%Y%m%d%H%M%S')
-    # Clear current session history
-    conversation_id = session.get('conversation_id')
-    if conversation_id in conversation_history:
-        del conversation_history[conversation_id]
+    # The next message starts a conversation under a fresh ID
+    session_manager.set_current_conversation(request.sid, new_conversation_id())
     # Notify client that reset is complete
-    socketio.emit('conversation_reset')
+    socketio.emit('conversation_reset', room=request.sid)
 
 @socketio.on('delete_conversation')
 def handle_delete_conversation(data):
     conversation_id = data['conversation_id']
-    if conversation_id in conversation_history:
-        del conversation_history[conversation_id]
-        # Send updated history
-        socketio.emit('update_history', {
-            'conversations': [
-                {
-                    'id': cid,
-                    'title': conv['title'],
-                    'timestamp': conv['timestamp']
-                } for cid, conv in conversation_history.items()
-            ]
-        })
+    owner = request_owner(data)
+    # The owner's sockets receive the deletion as a history_delta
+    if owner:
+        session_manager.delete_conversation(conversation_id, owner)
 
 @socketio.on('send_message')
 def handle_message(data):
-    # 添加请求ID用于跟踪
-    request_id = f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{hash(str(data))}"
-    logger.info(f'Processing message request [ID:{request_id}]')
+    # 请求ID即追踪ID：单调生成，不序列化消息内容（含API密钥）
+    trace = tracer.start_trace('handle_message', sid=request.sid)
+    request_id = trace.trace_id
+    validation_started = time.time()
+    logger.info('Processing message request [ID:%s]', request_id)
+    status = 'rejected'  # Outcome recorded on the trace unless the job is queued
     
     try:
-        # Basic validation
-        if not data.get('message'):
-            logger.error(f'[ID:{request_id}] Message content is empty')
-            socketio.emit('error', {'message': 'Message content cannot be empty'}, room=request.sid)
-            return
+        with tracer.activate(trace):
+            # Basic validation
+            if not data.get('message'):
+                logger.error('[ID:%s] Message content is empty', request_id)
+                socketio.emit('error', {'message': 'Message content cannot be empty'}, room=request.sid)
+                return
 
-        # Check conversation ID
-        conversation_id = get_conversation_id()
-        logger.debug(f'[ID:{request_id}] Conversation ID: {conversation_id}')
-        
-        # Check API key
-        api_key = data.get('api_key') or user_api_keys.get(request.sid)
-        if not api_key:
-            logger.error(f'[ID:{request_id}] API key not set')
-            socketio.emit('error', {'message': 'Please set your API key first'}, room=request.sid)
-            return
+            # Check API key
+            api_key = data.get('api_key') or session_manager.get_api_key(request.sid)
+            if not api_key:
+                logger.error('[ID:%s] API key not set', request_id)
+                socketio.emit('error', {'message': 'Please set your API key first'}, room=request.sid)
+                return
 
-        # Log key request info
-        logger.debug(f'[ID:{request_id}] API URL: {API_URL}')
-        logger.debug(f'[ID:{request_id}] Message length: {len(data.get("message", ""))} characters')
+            # Check conversation ID: the client may name one of its own conversations
+            owner = session_manager.owner_for_key(api_key)
+            conversation_id = data.get('conversation_id')
+            if conversation_id and session_manager.has_conversation(conversation_id, owner):
+                session_manager.set_current_conversation(request.sid, conversation_id)
+            else:
+                conversation_id = get_conversation_id(owner)
+            logger.debug('[ID:%s] Conversation ID: %s', request_id, conversation_id)
+
+            # Log key request info
+            logger.debug('[ID:%s] API URL: %s', request_id, API_URL)
+            logger.debug('[ID:%s] Message length: %s characters', request_id, len(data.get("message", "")))
         
-        # Update API key
-        user_api_keys[request.sid] = api_key
+            # Update API key and follow the owner's conversation list
+            session_manager.set_api_key(request.sid, api_key)
+            join_owner_room(api_key)
         
-        # Handle Live Search settings
-        if 'live_search_enabled' in data:
-            user_live_search_settings[request.sid] = data.get('live_search_enabled')
-
-        # Message length check
-        if len(data.get('message', '')) > 4000:
-            logger.warning(f'[ID:{request_id}] Message too long: {len(data.get("message", ""))} characters')
-            socketio.emit('error', {'message': 'Message is too long, please shorten your message'}, room=request.sid)
+            # Handle Live Search settings
+            if 'live_search_enabled' in data:
+                session_manager.set_live_search_enabled(request.sid, data.get('live_search_enabled'))
+
+            # Message length check
+            if len(data.get('message', '')) > 4000:
+                logger.warning('[ID:%s] Message too long: %s characters', request_id, len(data.get("message", "")))
+                socketio.emit('error', {'message': 'Message is too long, please shorten your message'}, room=request.sid)
+                return
+
+            trace.add_span('validation', validation_started)
+
+            # Queue the rest (history, upstream call, reply) for the worker pool
+            position = message_jobs.submit(request.sid, request_id, process_message, data, conversation_id, api_key, trace)
+            if position is None:
+                status = 'busy'
+                logger.warning('[ID:%s] Message queue full, rejecting request', request_id)
+                socketio.emit('busy', {
+                    'message': 'Server is busy, please try again in a moment',
+                    'request_id': request_id,
+                    'queue_size': message_jobs.max_queue
+                }, room=request.sid)
+            else:
+                status = 'queued'
+                if position > 0:
+                    socketio.emit('queue_position', {'request_id': request_id, 'position': position}, room=request.sid)
+
+    except Exception as e:
+        status = 'error'
+        log_exception(e, f'[ID:{request_id}] Error in main message processing flow')
+        socketio.emit('error', {
+            'message': 'An unknown error occurred, please try again later',
+            'request_id': request_id
+        }, room=request.sid)
+    finally:
+        # Queued traces are finished by the worker
+        if status == 'rejected':
+            trace.add_span('validation', validation_started, valid=False)
+        if status != 'queued':
+            tracer.finish(trace, status=status)
+
+def process_message(job, data, conversation_id, api_key, trace):
+    """Worker half of handle_message: store the user message, call the API and emit the reply
+
+    Args:
+        job: The MessageJob being run (sid, request_id, cancellation flag)
+        data: The send_message event payload
+        conversation_id: Conversation the message belongs to
+        api_key: API key of the client
+        trace: Trace started by handle_message
+    """
+    trace.add_span('queue_wait', time.time() - (time.monotonic() - job.submitted))
+    trace.root.attributes['status'] = 'failed'  # Replaced once the reply is sent or the job is dropped
+    with tracer.activate(trace):
+        try:
+            _process_message(job, data, conversation_id, api_key, trace)
+        finally:
+            tracer.finish(trace)
+
+def _process_message(job, data, conversation_id, api_key, trace):
+    client_sid = job.sid
+    request_id = job.request_id
+    owner = session_manager.owner_for_key(api_key)
+    try:
+        # The client may have disconnected while the job was queued
+        if job.cancelled:
+            logger.info('[ID:%s] Client disconnected before processing, job dropped', request_id)
+            trace.root.attributes['status'] = 'cancelled'
             return
 
         # Build user message
@@ -903,86 +5015,118 @@ def handle_message(data):
         }
 
         # Get current conversation messages
-        current_messages = []
+        current_messages = ()
         try:
-            logger.debug(f'[ID:{request_id}] Attempting to get conversation messages')
-            current_messages = list(session_manager.get_conversation_messages(conversation_id))
-            logger.debug(f'[ID:{request_id}] Current conversation message count: {len(current_messages)}')
+            logger.debug('[ID:%s] Attempting to get conversation messages', request_id)
+            with tracer.span('history_fetch') as span:
+                current_messages = session_manager.get_conversation_messages(conversation_id)
+                span['messages'] = len(current_messages)
+            logger.debug('[ID:%s] Current conversation message count: %s', request_id, len(current_messages))
         except Exception as e:
             error_trace = log_exception(e, f'[ID:{request_id}] Failed to get conversation messages')
-            # Continue processing, use empty list
-            current_messages = []
+            # Continue processing, use empty history
+            current_messages = ()
 
         # Add user message
         try:
-            logger.debug(f'[ID:{request_id}] Attempting to add user message to conversation')
-            session_manager.add_message_to_conversation(conversation_id, user_message)
-            logger.debug(f'[ID:{request_id}] User message added to conversation')
+            logger.debug('[ID:%s] Attempting to add user message to conversation', request_id)
+            with tracer.span('history_append', role='user'):
+                session_manager.add_message_to_conversation(conversation_id, user_message, owner)
+            logger.debug('[ID:%s] User message added to conversation', request_id)
         except Exception as e:
             error_trace = log_exception(e, f'[ID:{request_id}] Failed to add user message')
             socketio.emit('error', {
                 'message': 'Error processing message, please try again', 
                 'request_id': request_id
-            }, room=request.sid)
+            }, room=client_sid)
             return
 
         # Send processing confirmation
         socketio.emit('message_received', {
             'status': 'processing',
             'request_id': request_id
-        }, room=request.sid)
-
-        # Build system message
-        system_message = 'You are a helpful assistant.'
-        logger.debug(f'[ID:{request_id}] Using default system message')
-
-        # Build API request message list - Fix the logic here to ensure messages are added in the correct order
-        messages = [{'role': 'system', 'content': system_message}]
-        
-        # If there are existing conversation messages, add them after the system message
-        if current_messages:
-            messages.extend(current_messages)
-        
-        # Don't need to add the user message that's already been added to the conversation history
-        # Check if the last message is already the current user message
-        if not messages or messages[-1]['role'] != 'user' or messages[-1]['content'] != user_message['content']:
-            messages.append(user_message)
-            
-        logger.debug(f'[ID:{request_id}] Ready to send API request, total messages: {len(messages)}, including system message: {system_message[:50]}...')
+        }, room=client_sid)
 
         # Get model from request data or use default
         model = data.get('model', os.getenv('MODEL_NAME', 'grok-4-latest'))
-        logger.debug(f'[ID:{request_id}] Using model: {model}')
+        logger.debug('[ID:%s] Using model: %s', request_id, model)
+
+        # Build API request message list: system prompt, then the newest history that fits the
+        # model's token budget, then the new user message (history was read before it was added).
+        # Turns covered by the conversation's summary are replaced by the summary.
+        with tracer.span('context_build') as span:
+            summary = {'summarized': 0, 'saved_tokens': 0}
+            prompt_history = current_messages
+            if conversation_summarizer:
+                prompt_history, summary = conversation_summarizer.apply(conversation_id, current_messages)
+            messages, context = context_builder.build(prompt_history, user_message, model)
+            span.update(tokens=context['tokens'], budget=context['budget'], dropped=context['dropped'],
+                        summarized=summary['summarized'], saved_tokens=summary['saved_tokens'])
+        logger.debug(
+            '[ID:%s] Ready to send API request, total messages: %s, prompt tokens: %s/%s, dropped history: %s',
+            request_id, len(messages), context['tokens'], context['budget'], context['dropped']
+        )
+
+        # Stream deltas to the client's room as they arrive
+        stream = data.get('stream', STREAM_RESPONSES)
+        if isinstance(stream, str):
+            # Parsed like the env flags, so "false" from a form or query string turns streaming off
+            stream = stream.lower() == 'true'
+        stream = bool(stream)
+
+        def emit_chunk(delta):
+            if job.cancelled:
+                return
+            socketio.emit('response_chunk', {
+                'delta': delta,
+                'conversation_id': conversation_id,
+                'request_id': request_id
+            }, room=client_sid)
+
+        if job.cancelled:
+            logger.info('[ID:%s] Client disconnected, skipping API call', request_id)
+            trace.root.attributes['status'] = 'cancelled'
+            return
 
         # Call API
         try:
-            logger.debug(f'[ID:{request_id}] Starting API call')
-            response_data = send_message(messages, api_key, user_live_search_settings.get(request.sid, False), model)
-            logger.debug(f'[ID:{request_id}] API call completed, checking response')
+            logger.debug('[ID:%s] Starting API call, stream: %s', request_id, stream)
+            live_search = session_manager.get_live_search_enabled(client_sid)
+            with tracer.span('send_message', model=model, stream=stream, live_search=live_search) as span:
+                response_data = send_message(
+                    messages,
+                    api_key,
+                    live_search,
+                    model,
+                    stream=stream,
+                    on_chunk=emit_chunk if stream else None
+                )
+                span.update(cached=response_data.get('cached', False), coalesced=response_data.get('coalesced', False))
+            logger.debug('[ID:%s] API call completed, checking response', request_id)
         except Exception as e:
             error_trace = log_exception(e, f'[ID:{request_id}] API call failed')
             socketio.emit('error', {
                 'message': 'API call failed, please try again later',
                 'request_id': request_id
-            }, room=request.sid)
+            }, room=client_sid)
             return
 
         # Check for error response
         if 'error' in response_data:
-            logger.error(f'[ID:{request_id}] API returned error: {response_data["error"]}')
+            logger.error('[ID:%s] API returned error: %s', request_id, response_data["error"])
             socketio.emit('error', {
                 'message': response_data['error'],
                 'request_id': request_id
-            }, room=request.sid)
+            }, room=client_sid)
             return
 
         # Validate response format
         if not (response_data and 'response' in response_data and 'choices' in response_data['response']):
-            logger.error(f'[ID:{request_id}] API response format does not match expected: {json.dumps(response_data)}')
+            logger.error('[ID:%s] API response format does not match expected: %s', request_id, response_data)
             socketio.emit('error', {
                 'message': 'API response format error',
                 'request_id': request_id
-            }, room=request.sid)
+            }, room=client_sid)
             return
 
         # Process API response
@@ -990,36 +5134,36 @@ def handle_message(data):
             # Extract assistant reply
             choices = response_data['response']['choices']
             if not choices or not isinstance(choices, list) or len(choices) == 0:
-                logger.error(f'[ID:{request_id}] API response choices empty or format error')
+                logger.error('[ID:%s] API response choices empty or format error', request_id)
                 socketio.emit('error', {
                     'message': 'Incomplete API response data',
                     'request_id': request_id
-                }, room=request.sid)
+                }, room=client_sid)
                 return
 
             # Check message format
             first_choice = choices[0]
             if not isinstance(first_choice, dict) or 'message' not in first_choice:
-                logger.error(f'[ID:{request_id}] API response choice format error: {json.dumps(first_choice)}')
+                logger.error('[ID:%s] API response choice format error: %s', request_id, first_choice)
                 socketio.emit('error', {
                     'message': 'API response data format error',
                     'request_id': request_id
-                }, room=request.sid)
+                }, room=client_sid)
                 return
 
             # Extract message content
             message_obj = first_choice['message']
             if not isinstance(message_obj, dict) or 'content' not in message_obj:
-                logger.error(f'[ID:{request_id}] API response message format error: {json.dumps(message_obj)}')
+                logger.error('[ID:%s] API response message format error: %s', request_id, message_obj)
                 socketio.emit('error', {
                     'message': 'API response message format error',
                     'request_id': request_id
-                }, room=request.sid)
+                }, room=client_sid)
                 return
 
             # Get content
             assistant_message = message_obj['content']
-            logger.debug(f'[ID:{request_id}] Successfully extracted assistant reply, length: {len(assistant_message)} characters')
+            logger.debug('[ID:%s] Successfully extracted assistant reply, length: %s characters', request_id, len(assistant_message))
             
             # Build assistant message object
             assistant_message_obj = {
@@ -1030,45 +5174,49 @@ def handle_message(data):
 
             # Add assistant message to conversation
             try:
-                logger.debug(f'[ID:{request_id}] Attempting to add assistant reply to conversation')
-                session_manager.add_message_to_conversation(conversation_id, assistant_message_obj)
-                logger.debug(f'[ID:{request_id}] Assistant reply added to conversation')
+                logger.debug('[ID:%s] Attempting to add assistant reply to conversation', request_id)
+                with tracer.span('history_append', role='assistant'):
+                    session_manager.add_message_to_conversation(conversation_id, assistant_message_obj, owner)
+                logger.debug('[ID:%s] Assistant reply added to conversation', request_id)
             except Exception as e:
                 error_trace = log_exception(e, f'[ID:{request_id}] Failed to add assistant reply to conversation')
                 # Try to return response to user even if adding to conversation fails
 
-            # Send response to client
-            logger.debug(f'[ID:{request_id}] Sending response to client')
-            socketio.emit('response', {
-                'message': assistant_message,
-                'conversation_id': conversation_id,
-                'response_time': round(response_data.get('response_time', 0), 2),
-                'token_count': response_data.get('token_count', 0),
-                'request_id': request_id
-            }, room=request.sid)
+            # Summarize older turns in the background once the conversation grows past the threshold
+            if conversation_summarizer:
+                try:
+                    conversation_summarizer.maybe_schedule(
+                        conversation_id, (user_message, assistant_message_obj),
+                        lambda: session_manager.get_conversation_messages(conversation_id), api_key, model
+                    )
+                except Exception as e:
+                    log_exception(e, f'[ID:{request_id}] Failed to schedule conversation summary')
 
-            # Update conversation list
-            try:
-                logger.debug(f'[ID:{request_id}] Updating conversation list')
-                conversations = [
-                    {
-                        'id': cid,
-                        'title': conv['title'],
-                        'timestamp': conv['timestamp']
-                    } for cid, conv in session_manager.conversation_history.items()
-                ]
-                socketio.emit('update_history', {'conversations': conversations}, room=request.sid)
-                logger.info(f'[ID:{request_id}] Message processing completed')
-            except Exception as e:
-                error_trace = log_exception(e, f'[ID:{request_id}] Failed to update conversation list')
-                # Don't block main functionality
+            # Send response to client
+            logger.debug('[ID:%s] Sending response to client', request_id)
+            with tracer.span('emit', event='response'):
+                socketio.emit('response', {
+                    'message': assistant_message,
+                    'conversation_id': conversation_id,
+                    'response_time': round(response_data.get('response_time', 0), 2),
+                    'ttft': round(response_data['ttft'], 2) if response_data.get('ttft') is not None else None,
+                    'streamed': stream,
+                    'cached': response_data.get('cached', False),
+                    'coalesced': response_data.get('coalesced', False),
+                    'token_count': response_data.get('token_count', 0),
+                    'prompt_tokens_saved': summary['saved_tokens'],
+                    'request_id': request_id
+                }, room=client_sid)
+            trace.root.attributes['status'] = 'ok'
+            # The conversation list was updated through history_delta events as the messages were stored
+            logger.info('[ID:%s] Message processing completed', request_id)
 
         except Exception as e:
             error_trace = log_exception(e, f'[ID:{request_id}] Failed to process API response')
             socketio.emit('error', {
                 'message': 'Error processing response, please try again',
                 'request_id': request_id
-            }, room=request.sid)
+            }, room=client_sid)
             return
 
     except Exception as e:
@@ -1076,7 +5224,7 @@ def handle_message(data):
         socketio.emit('error', {
             'message': f'An unknown error occurred, please try again later',
             'request_id': request_id
-        }, room=request.sid)
+        }, room=client_sid)
 
 @app.route('/socket-test')
 def socket_test():
@@ -1231,6 +5379,8 @@ def handle_connect():
     environ = {k: v for k, v in request.environ.items() if k.startswith('HTTP_') or k.startswith('REMOTE_')}
     
     logger.info(f"客户端连接: {client_id}, IP: {client_ip}, 传输: {transport}")
+    network_monitor.record_socket(True)
+    start_cleanup_task()
     
     # 发送调试信息给客户端
     socketio.emit('debug_info', {
@@ -1248,12 +5398,11 @@ def handle_disconnect():
     from flask import request  # 确保导入request
     client_id = request.sid
     logger.info(f"客户端断开连接: {client_id}")
+    network_monitor.record_socket(False)
     
     # 清理客户端相关的数据
-    if client_id in user_api_keys:
-        del user_api_keys[client_id]
-    if client_id in user_live_search_settings:
-        del user_live_search_settings[client_id]
+    session_manager.clear_client(client_id)
+    message_jobs.cancel(client_id)
 
 @app.route('/simple-socket-test')
 def simple_socket_test():
@@ -1310,9 +5459,7 @@ def simple_socket_test():
 
 if __name__ == '__main__':
     # Start cleanup task
-    from threading import Thread
-    cleanup_thread = Thread(target=cleanup_task, daemon=True)
-    cleanup_thread.start()
+    start_cleanup_task()
     
     # Get port from environment variables, adapt to cloud platform requirements
     port = int(os.getenv('PORT', 10000))
@@ -1325,6 +5472,7 @@ if __name__ == '__main__':
     logger.info(f"🔗 API URL: {API_URL}")
     logger.info(f"🤖 Model: {os.getenv('MODEL_NAME', 'grok-4-latest')}")
     logger.info(f"🔧 Debug Mode: {debug_mode}")
+    logger.info(f"⚡ Async Mode: {socketio.async_mode}")
     logger.info(f"💾 Max Conversations: {session_manager.max_conversations}")
     logger.info(f"💬 Max Messages per Conversation: {session_manager.max_messages_per_conversation}")
     logger.info(f"🔍 Live Search: Integrated with xAI API")
@@ -1338,8 +5486,7 @@ if __name__ == '__main__':
             debug=debug_mode,
             use_reloader=False,  # Disable reloader for production
             log_output=debug_mode,  # Only log output in debug mode
-            allow_unsafe_werkzeug=True,  # Allow Werkzeug in development
-            cors_allowed_origins="*"  # Ensure CORS is properly configured
+            allow_unsafe_werkzeug=True  # Allow Werkzeug in threading mode (ignored by eventlet/gevent)
         )
     except Exception as e:
         logger.error(f"❌ Failed to start server: {str(e)}")
@@ -0,0 +1,32 @@
+"""
+pytest 公共配置：在导入 chat.py 之前把上游地址指向本地 mock xAI 服务器
+"""
+import os
+import tempfile
+
+import pytest
+
+from mock_xai_server import MockXAIServer
+
+mock_server = MockXAIServer(latency=0.0, tokens=5, live_search_latency=0.0)
+mock_server.start()
+
+# chat.py reads its configuration at import time
+os.environ.update({
+    'API_URL': mock_server.api_url,
+    'BATCH_DIR': tempfile.mkdtemp(prefix='batches-'),
+    'RATE_LIMIT_KEY_RPS': '0',
+    'UPSTREAM_MAX_ATTEMPTS': '1',
+    'CIRCUIT_RESET_TIMEOUT': '0.05',
+    'LOG_ASYNC': 'False',
+    'LOG_LEVEL': 'WARNING'
+})
+
+
+@pytest.fixture
+def mock_xai():
+    """The shared mock xAI server, with clean stats and no injected errors"""
+    mock_server.reset_stats()
+    yield mock_server
+    mock_server.error_rate = 0.0
+    mock_server.rate_limit_rate = 0.0
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+xAI Chat Completions 本地模拟服务器
+
+用于基准测试与负载测试，代替真实的 API_URL，不消耗 API 额度:
+    python mock_xai_server.py --port 8081 --latency 0.5 --token-delay 0.02
+    API_URL=http://127.0.0.1:8081/v1/chat/completions python chat.py
+
+支持:
+    - 可配置的响应延迟（含随机抖动）与流式输出（SSE，逐 token 间隔）
+    - 按比例注入 429（带 Retry-After）与 5xx 错误
+    - 请求包含 search_parameters 时模拟 Live Search（额外延迟与 citations）
+    - GET /stats 返回请求计数，POST /stats/reset 清零
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FILLER_WORDS = ('the', 'model', 'answers', 'with', 'a', 'short', 'mock', 'reply', 'about', 'your', 'question')
+
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    """Threaded server that ignores clients closing pooled connections"""
+    request_queue_size = 4096
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class MockXAIServer:
+    """Threaded HTTP stand-in for the xAI chat completions endpoint"""
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.5, jitter=0.0, tokens=50, token_delay=0.0,
+                 rate_limit_rate=0.0, retry_after=1, error_rate=0.0, error_status=503,
+                 live_search_latency=1.0, citations=3):
+        """
+        Args:
+            host: Address to listen on
+            port: Port to listen on (0 picks a free port)
+            latency: Seconds before the response headers are sent
+            jitter: Maximum random seconds added to or removed from latency
+            tokens: Words in each reply
+            token_delay: Seconds between streamed chunks
+            rate_limit_rate: Share of requests answered with 429
+            retry_after: Retry-After seconds sent with 429 responses
+            error_rate: Share of requests answered with error_status
+            error_status: Status code of injected server errors
+            live_search_latency: Extra seconds for requests with search_parameters
+            citations: Citations returned for Live Search requests
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.tokens = tokens
+        self.token_delay = token_delay
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.live_search_latency = live_search_latency
+        self.citations = citations
+        self.stats = self._initial_stats()
+        self.lock = threading.Lock()
+
+        self.server = QuietHTTPServer((host, port), self._handler_class())
+        self.thread = None
+
+    @staticmethod
+    def _initial_stats():
+        return {
+            'requests': 0,
+            'streamed': 0,
+            'live_search': 0,
+            'rate_limited': 0,
+            'server_errors': 0,
+            'unauthorized': 0,
+            'completed': 0
+        }
+
+    @property
+    def api_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1/chat/completions"
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def get_stats(self):
+        with self.lock:
+            return self.stats.copy()
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = self._initial_stats()
+
+    def start(self):
+        """Serve from a daemon thread and return self"""
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reply_text(self, messages):
+        """Echo the start of the last message, padded with filler words to the reply length"""
+        last = str(messages[-1].get('content', '')) if messages else ''
+        words = last.split()[:self.tokens // 2]
+        while len(words) < self.tokens:
+            words.append(FILLER_WORDS[len(words) % len(FILLER_WORDS)])
+        return ' '.join(words)
+
+    def citation_list(self):
+        return [f"https://example.com/mock-source-{i + 1}" for i in range(self.citations)]
+
+    def _handler_class(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, status, payload, headers=None):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def write_chunk(self, data):
+                data = data.encode()
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+                self.wfile.flush()
+
+            def do_GET(self):
+                if self.path == '/stats':
+                    self.send_json(200, mock.get_stats())
+                else:
+                    self.send_json(404, {'error': {'message': 'Not found'}})
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                raw = self.rfile.read(length) if length else b''
+                if self.path == '/stats/reset':
+                    mock.reset_stats()
+                    self.send_json(200, {'reset': True})
+                    return
+                if not self.path.startswith('/v1/chat/completions'):
+                    self.send_json(404, {'error': {'message': 'Not found'}})
+                    return
+                mock.count('requests')
+
+                if not self.headers.get('Authorization', '').startswith('Bearer '):
+                    mock.count('unauthorized')
+                    self.send_json(401, {'error': {'message': 'Missing API key'}})
+                    return
+                try:
+                    body = json.loads(raw or b'{}')
+                except ValueError:
+                    self.send_json(400, {'error': {'message': 'Invalid JSON'}})
+                    return
+
+                # Injected failures answer right away, like a proxy or overloaded upstream would
+                roll = random.random()
+                if roll < mock.rate_limit_rate:
+                    mock.count('rate_limited')
+                    self.send_json(429, {'error': {'message': 'Rate limit exceeded'}},
+                                   {'Retry-After': str(mock.retry_after)})
+                    return
+                if roll < mock.rate_limit_rate + mock.error_rate:
+                    mock.count('server_errors')
+                    self.send_json(mock.error_status, {'error': {'message': 'Injected server error'}})
+                    return
+
+                live_search = bool(body.get('search_parameters'))
+                delay = mock.latency + random.uniform(-mock.jitter, mock.jitter)
+                if live_search:
+                    mock.count('live_search')
+                    delay += mock.live_search_latency
+                time.sleep(max(0.0, delay))
+
+                model = body.get('model', 'grok-mock')
+                words = mock.reply_text(body.get('messages') or []).split(' ')
+                usage = {
+                    'prompt_tokens': sum(len(str(m.get('content', '')).split()) for m in body.get('messages') or []),
+                    'completion_tokens': len(words)
+                }
+                usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+                extra = {'usage': usage}
+                if live_search:
+                    extra['citations'] = mock.citation_list()
+
+                if body.get('stream'):
+                    mock.count('streamed')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/event-stream')
+                    self.send_header('Transfer-Encoding', 'chunked')
+                    self.end_headers()
+                    for index, word in enumerate(words):
+                        if index and mock.token_delay:
+                            time.sleep(mock.token_delay)
+                        chunk = {
+                            'id': 'mock-completion',
+                            'model': model,
+                            'choices': [{'index': 0, 'delta': {'content': word if index == 0 else ' ' + word}}]
+                        }
+                        self.write_chunk(f"data: {json.dumps(chunk)}\n\n")
+                    final = {'id': 'mock-completion', 'model': model,
+                             'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]}
+                    final.update(extra)
+                    self.write_chunk(f"data: {json.dumps(final)}\n\n")
+                    self.write_chunk('data: [DONE]\n\n')
+                    self.wfile.write(b'0\r\n\r\n')
+                else:
+                    response = {
+                        'id': 'mock-completion',
+                        'object': 'chat.completion',
+                        'model': model,
+                        'choices': [{
+                            'index': 0,
+                            'message': {'role': 'assistant', 'content': ' '.join(words)},
+                            'finish_reason': 'stop'
+                        }]
+                    }
+                    response.update(extra)
+                    self.send_json(200, response)
+                mock.count('completed')
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local mock of the xAI chat completions API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.5, help='seconds before response headers')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random +/- seconds added to latency')
+    parser.add_argument('--tokens', type=int, default=50, help='words per reply')
+    parser.add_argument('--token-delay', type=float, default=0.0, help='seconds between streamed chunks')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='share of requests answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds of 429 responses')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with a 5xx')
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--live-search-latency', type=float, default=1.0, help='extra seconds with search_parameters')
+    parser.add_argument('--citations', type=int, default=3, help='citations returned for Live Search requests')
+    args = parser.parse_args()
+
+    server = MockXAIServer(
+        host=args.host, port=args.port, latency=args.latency, jitter=args.jitter, tokens=args.tokens,
+        token_delay=args.token_delay, rate_limit_rate=args.rate_limit_rate, retry_after=args.retry_after,
+        error_rate=args.error_rate, error_status=args.error_status,
+        live_search_latency=args.live_search_latency, citations=args.citations
+    )
+    print(f"Mock xAI API listening on {server.api_url}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
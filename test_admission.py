@@ -0,0 +1,93 @@
+"""
+测试按 API 密钥的令牌桶准入与 429 退避
+"""
+import threading
+import time
+
+import chat
+from chat import AdmissionScheduler, RetryPolicy
+
+
+def test_burst_is_admitted_then_rate_limited():
+    scheduler = AdmissionScheduler(global_rate=0, key_rate=20, key_burst=2, max_wait=5)
+    assert scheduler.acquire('key-a') < 0.01
+    assert scheduler.acquire('key-a') < 0.01
+    waited = scheduler.acquire('key-a')
+    assert 0.02 < waited < 0.5
+
+
+def test_keys_do_not_share_a_bucket():
+    scheduler = AdmissionScheduler(global_rate=0, key_rate=1, key_burst=1, max_wait=5)
+    scheduler.acquire('key-a')
+    assert scheduler.acquire('key-b') < 0.01
+
+
+def test_waiting_keys_are_served_round_robin():
+    scheduler = AdmissionScheduler(global_rate=20, global_burst=1, key_rate=0, max_wait=5)
+    scheduler.acquire('warm-up')  # Empty the global bucket so everyone queues
+    order = []
+
+    def acquire(api_key):
+        scheduler.acquire(api_key)
+        order.append(api_key)
+
+    threads = []
+    for api_key in ['key-a', 'key-a', 'key-a', 'key-b']:
+        thread = threading.Thread(target=acquire, args=(api_key,))
+        thread.start()
+        threads.append(thread)
+        time.sleep(0.005)
+    for thread in threads:
+        thread.join(5)
+
+    # key-b waits behind one key-a request, not behind its whole burst
+    assert order.index('key-b') <= 1
+
+
+def test_wait_beyond_max_wait_is_rejected():
+    scheduler = AdmissionScheduler(global_rate=0, key_rate=1, key_burst=1, max_wait=0.05)
+    scheduler.acquire('key-a')
+    assert scheduler.acquire('key-a') is None
+    assert scheduler.get_stats()['rejected'] == 1
+    assert scheduler.get_stats()['queue_depth'] == 0
+
+
+def test_rate_limited_key_backs_off_and_recovers():
+    scheduler = AdmissionScheduler(global_rate=0, key_rate=10, key_burst=5, max_wait=5)
+    assert scheduler.record_rate_limited('key-a', retry_after=None) is True
+    bucket = scheduler.keys[chat.SessionManager.owner_for_key('key-a')].bucket
+    assert bucket.rate == 5
+    assert scheduler.get_stats()['throttled_keys'] == 1
+    for _ in range(5):
+        scheduler.record_success('key-a')
+    assert bucket.rate == 10
+
+
+def test_retry_after_blocks_the_key():
+    scheduler = AdmissionScheduler(global_rate=0, key_rate=0, max_wait=5)
+    assert scheduler.record_rate_limited('key-a', retry_after=0.1) is True
+    assert scheduler.acquire('key-a') >= 0.09
+    assert scheduler.acquire('key-b') < 0.01
+
+
+def test_retry_after_beyond_max_wait_is_rejected_up_front():
+    scheduler = AdmissionScheduler(global_rate=0, key_rate=0, max_wait=0.5)
+    scheduler.record_rate_limited('key-a', retry_after=10)
+    started = time.monotonic()
+    assert scheduler.acquire('key-a') is None
+    assert time.monotonic() - started < 0.1
+
+
+def test_unpaced_429_falls_back_to_backoff(mock_xai, monkeypatch):
+    # No per-key rate and no Retry-After: the retry must still wait
+    monkeypatch.setattr(chat, 'admission_scheduler', AdmissionScheduler(global_rate=0, key_rate=0))
+    monkeypatch.setattr(chat, 'retry_policy', RetryPolicy(max_attempts=2, base_delay=0.1, max_delay=0.1))
+    monkeypatch.setattr(mock_xai, 'retry_after', '')
+    mock_xai.rate_limit_rate = 1.0
+
+    started = time.monotonic()
+    result = chat.send_message([{'role': 'user', 'content': 'rate limited'}], 'test-key')
+    assert 'error' in result
+    assert mock_xai.get_stats()['rate_limited'] == 2
+    assert time.monotonic() - started >= 0.1
+    assert chat.retry_policy.get_stats()['retries'] == 1
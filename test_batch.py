@@ -0,0 +1,101 @@
+"""
+测试 JSONL 批量接口的断点续跑与所有权校验
+"""
+import json
+
+import pytest
+
+import chat
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(chat.batch_runner, 'directory', str(tmp_path))
+    return chat.app.test_client()
+
+
+def batch_body(count):
+    return '\n'.join(json.dumps({'id': f'q{i}', 'message': f'question {i}'}) for i in range(count))
+
+
+def post_batch(client, body, api_key='key-a', **params):
+    response = client.post('/api/batch', query_string=params, data=body,
+                           headers={'Authorization': f'Bearer {api_key}'})
+    # Reading the body runs the batch to completion
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    return response, lines
+
+
+def test_resume_skips_finished_items(client, mock_xai):
+    response, lines = post_batch(client, batch_body(2), batch_id='resume')
+    assert response.status_code == 200
+    assert response.headers['X-Batch-Id'] == 'resume'
+    assert sorted(line['id'] for line in lines) == ['q0', 'q1']
+    assert all('error' not in line and line['content'] for line in lines)
+    assert mock_xai.get_stats()['requests'] == 2
+
+    response, lines = post_batch(client, batch_body(3), batch_id='resume')
+    assert response.status_code == 200
+    resumed = {line['id']: line.get('resumed', False) for line in lines}
+    assert resumed == {'q0': True, 'q1': True, 'q2': False}
+    assert mock_xai.get_stats()['requests'] == 3
+
+
+def test_failed_items_run_again_on_resume(client, mock_xai):
+    mock_xai.error_rate = 1.0
+    mock_xai.error_status = 400  # A per-request error, so the circuit breaker stays closed
+    try:
+        _, lines = post_batch(client, batch_body(2), batch_id='retry')
+    finally:
+        mock_xai.error_status = 503
+    assert all('error' in line for line in lines)
+
+    mock_xai.error_rate = 0.0
+    _, lines = post_batch(client, batch_body(2), batch_id='retry')
+    assert all('error' not in line and not line.get('resumed') for line in lines)
+    assert mock_xai.get_stats()['completed'] == 2
+
+
+def test_other_key_cannot_resume(client, mock_xai):
+    post_batch(client, batch_body(2), batch_id='owned')
+    requests_sent = mock_xai.get_stats()['requests']
+
+    response = client.post('/api/batch?batch_id=owned', data=batch_body(2),
+                           headers={'Authorization': 'Bearer key-b'})
+    assert response.status_code == 403
+    assert response.get_json()['success'] is False
+    assert mock_xai.get_stats()['requests'] == requests_sent
+
+    # The rejected attempt released the batch, so its owner can still resume it
+    response, lines = post_batch(client, batch_body(2), batch_id='owned')
+    assert response.status_code == 200
+    assert all(line.get('resumed') for line in lines)
+
+
+def test_results_file_records_the_owner(client, mock_xai, tmp_path):
+    post_batch(client, batch_body(1), batch_id='header')
+    with open(tmp_path / 'header.jsonl', encoding='utf-8') as results:
+        header = json.loads(results.readline())
+    assert header == {'batch_id': 'header', 'owner': chat.SessionManager.owner_for_key('key-a')}
+
+
+@pytest.mark.parametrize('body, params', [
+    ('{"id": "q0", "message": "hi", "model": 5}', {}),
+    ('{"id": "q0"}', {}),
+    ('{"id": "q0", "message": "hi"}\n{"id": "q0", "message": "again"}', {}),
+    ('', {}),
+    (batch_body(1), {'concurrency': 'abc'}),
+    (batch_body(1), {'concurrency': '0'}),
+    (batch_body(1), {'batch_id': '../escape'}),
+])
+def test_invalid_requests_are_rejected(client, mock_xai, body, params):
+    response = client.post('/api/batch', query_string=params, data=body,
+                           headers={'Authorization': 'Bearer key-a'})
+    assert response.status_code == 400
+    assert response.get_json()['success'] is False
+    assert mock_xai.get_stats()['requests'] == 0
+
+
+def test_missing_api_key_is_rejected(client):
+    response = client.post('/api/batch', data=batch_body(1))
+    assert response.status_code == 401
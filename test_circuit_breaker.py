@@ -0,0 +1,106 @@
+"""
+测试熔断器的打开、半开探测与恢复
+"""
+import time
+
+import chat
+from chat import CircuitBreaker
+
+
+def open_breaker(reset_timeout=0.05):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=reset_timeout)
+    breaker.record_failure()
+    breaker.record_failure()
+    return breaker
+
+
+def test_consecutive_failures_open_the_breaker():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.is_open()
+    assert not breaker.allow()
+    assert breaker.get_stats()['rejected'] == 1
+
+
+def test_success_resets_the_consecutive_count():
+    breaker = CircuitBreaker(failure_threshold=2, failure_rate=100, reset_timeout=60)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_failure_rate_opens_the_breaker():
+    breaker = CircuitBreaker(failure_threshold=100, failure_rate=50, window=10, min_requests=4, reset_timeout=60)
+    for succeeded in (True, False, True, False):
+        if succeeded:
+            breaker.record_success()
+        else:
+            breaker.record_failure()
+    assert breaker.is_open()
+
+
+def test_half_open_lets_one_probe_through():
+    breaker = open_breaker()
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+
+
+def test_probe_success_closes_the_breaker():
+    breaker = open_breaker()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.get_stats()['recent_requests'] == 0
+    assert breaker.allow() and breaker.allow()
+
+
+def test_probe_failure_reopens_the_breaker():
+    breaker = open_breaker()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.is_open()
+    assert breaker.get_stats()['opened'] == 2
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+
+
+def test_lost_probe_is_replaced_after_reset_timeout():
+    breaker = open_breaker()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert not breaker.allow()
+    # The probe never reported an outcome
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+
+def test_upstream_calls_record_one_outcome_each(mock_xai, monkeypatch):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    monkeypatch.setattr(chat, 'circuit_breaker', breaker)
+    messages = [{'role': 'user', 'content': 'breaker outcome'}]
+
+    result = chat.send_message(messages, 'test-key', stream=True, on_chunk=lambda delta: None)
+    assert 'error' not in result
+    assert list(breaker.outcomes) == [True]
+
+    mock_xai.error_rate = 1.0
+    for _ in range(2):
+        assert 'error' in chat.send_message(messages, 'test-key')
+    assert list(breaker.outcomes) == [True, False, False]
+    assert breaker.is_open()
+
+    # An open breaker fails fast without reaching the upstream
+    requests_sent = mock_xai.get_stats()['requests']
+    assert 'error' in chat.send_message(messages, 'test-key')
+    assert mock_xai.get_stats()['requests'] == requests_sent
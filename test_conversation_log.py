@@ -0,0 +1,84 @@
+"""
+测试会话 WAL 日志的崩溃恢复：残缺尾部与快照
+"""
+import os
+
+from chat import ConversationLog
+
+
+def recover(directory):
+    log = ConversationLog(str(directory))
+    conversations = []
+    events = []
+    stats = log.recover(conversations.append, events.append)
+    return log, conversations, events, stats
+
+
+def test_torn_tail_is_dropped_and_truncated(tmp_path):
+    log, _, _, _ = recover(tmp_path)
+    for i in range(3):
+        log.append({'type': 'add', 'n': i})
+    log.close()
+
+    wal_path = log._wal_path(log.generation)
+    clean_size = os.path.getsize(wal_path)
+    with open(wal_path, 'ab') as f:
+        f.write(b'{"type":"add","n":3')  # Crash mid-append
+
+    log, _, events, stats = recover(tmp_path)
+    assert [event['n'] for event in events] == [0, 1, 2]
+    assert stats == {'restored_conversations': 0, 'replayed_events': 3}
+    assert os.path.getsize(wal_path) == clean_size
+
+    # New appends start on a clean line and survive the next recovery
+    log.append({'type': 'add', 'n': 3})
+    log.close()
+    log, _, events, _ = recover(tmp_path)
+    log.close()
+    assert [event['n'] for event in events] == [0, 1, 2, 3]
+
+
+def test_corrupt_last_record_is_dropped(tmp_path):
+    log, _, _, _ = recover(tmp_path)
+    log.append({'type': 'add', 'n': 0})
+    log.close()
+    with open(log._wal_path(log.generation), 'ab') as f:
+        f.write(b'{"type":\n')
+
+    log, _, events, _ = recover(tmp_path)
+    log.close()
+    assert events == [{'type': 'add', 'n': 0}]
+
+
+def test_snapshot_then_wal_tail(tmp_path):
+    log, _, _, _ = recover(tmp_path)
+    log.append({'type': 'add', 'n': 0})
+    log.append({'type': 'add', 'n': 1})
+    old_wal = log._wal_path(log.generation)
+
+    generation = log.rotate()
+    log.write_snapshot(generation, [{'id': 'c1', 'messages': ['first', 'second']}])
+    log.append({'type': 'add', 'n': 2})
+    log.close()
+
+    assert not os.path.exists(old_wal)
+    log, conversations, events, stats = recover(tmp_path)
+    log.close()
+    assert conversations == [{'id': 'c1', 'messages': ['first', 'second']}]
+    assert events == [{'type': 'add', 'n': 2}]
+    assert stats == {'restored_conversations': 1, 'replayed_events': 1}
+    assert log.generation == generation
+
+
+def test_snapshot_without_tail_events(tmp_path):
+    log, _, _, _ = recover(tmp_path)
+    log.append({'type': 'add', 'n': 0})
+    generation = log.rotate()
+    log.write_snapshot(generation, [{'id': 'c1'}, {'id': 'c2'}])
+    log.close()
+
+    log, conversations, events, stats = recover(tmp_path)
+    log.close()
+    assert [conversation['id'] for conversation in conversations] == ['c1', 'c2']
+    assert events == []
+    assert stats['replayed_events'] == 0
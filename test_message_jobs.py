@@ -0,0 +1,89 @@
+"""
+测试消息任务队列的背压与取消计数
+"""
+import threading
+import time
+
+from chat import MessageJobQueue
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.005)
+
+
+def finished(jobs):
+    stats = jobs.get_stats()
+    return stats['completed'] + stats['failed'] + stats['cancelled']
+
+
+def test_full_queue_rejects_and_reports_positions():
+    jobs = MessageJobQueue(workers=1, max_queue=2)
+    release = threading.Event()
+    assert jobs.submit('a', 'r1', lambda job: release.wait(5)) == 0
+    wait_for(lambda: jobs.get_stats()['busy_workers'] == 1)
+
+    assert jobs.submit('b', 'r2', lambda job: None) == 1
+    assert jobs.submit('c', 'r3', lambda job: None) == 2
+    assert jobs.submit('d', 'r4', lambda job: None) is None
+    release.set()
+    wait_for(lambda: finished(jobs) == 3)
+
+    stats = jobs.get_stats()
+    assert (stats['submitted'], stats['rejected'], stats['completed']) == (3, 1, 3)
+    assert stats['queue_depth'] == 0 and stats['busy_workers'] == 0
+
+
+def test_cancel_counts_each_job_once():
+    jobs = MessageJobQueue(workers=1, max_queue=5)
+    release = threading.Event()
+    ran = []
+
+    def blocking(job):
+        release.wait(5)
+        ran.append(job.request_id)
+
+    jobs.submit('a', 'running', blocking)
+    wait_for(lambda: jobs.get_stats()['busy_workers'] == 1)
+    jobs.submit('a', 'queued-a1', lambda job: ran.append(job.request_id))
+    jobs.submit('b', 'queued-b', lambda job: ran.append(job.request_id))
+    jobs.submit('a', 'queued-a2', lambda job: ran.append(job.request_id))
+
+    jobs.cancel('a')
+    # Dropped jobs count right away; the running one only when its worker finishes
+    assert jobs.get_stats()['cancelled'] == 2
+    assert jobs.get_stats()['queue_depth'] == 1
+    release.set()
+    wait_for(lambda: finished(jobs) == 4)
+
+    stats = jobs.get_stats()
+    assert ran == ['running', 'queued-b']
+    assert (stats['cancelled'], stats['completed'], stats['failed']) == (3, 1, 0)
+    assert stats['submitted'] == stats['cancelled'] + stats['completed'] + stats['failed']
+
+
+def test_cancelling_twice_does_not_count_twice():
+    jobs = MessageJobQueue(workers=1, max_queue=5)
+    release = threading.Event()
+    jobs.submit('a', 'running', lambda job: release.wait(5))
+    wait_for(lambda: jobs.get_stats()['busy_workers'] == 1)
+    jobs.cancel('a')
+    jobs.cancel('a')
+    release.set()
+    wait_for(lambda: jobs.get_stats()['busy_workers'] == 0)
+    assert jobs.get_stats()['cancelled'] == 1
+
+
+def test_failed_job_is_counted_and_worker_survives():
+    jobs = MessageJobQueue(workers=1, max_queue=5)
+
+    def fail(job):
+        raise RuntimeError('boom')
+
+    jobs.submit('a', 'fails', fail)
+    jobs.submit('a', 'works', lambda job: None)
+    wait_for(lambda: finished(jobs) == 2)
+    stats = jobs.get_stats()
+    assert (stats['failed'], stats['completed']) == (1, 1)
@@ -0,0 +1,190 @@
+"""
+测试相同上游请求的合并：流式分发与主请求失败
+"""
+import threading
+import time
+
+from chat import NetworkMonitor, RequestCoalescer
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.005)
+
+
+def start_follower(coalescer, key, fetch, outcomes, chunks):
+    def follow():
+        outcomes.append(coalescer.run(key, fetch, stream=True, on_chunk=chunks.append))
+    thread = threading.Thread(target=follow)
+    thread.start()
+    return thread
+
+
+def success(content):
+    return {'response': {'choices': [{'message': {'content': content}}]}, 'response_time': 0.1}
+
+
+def test_streamed_deltas_fan_out_to_followers():
+    monitor = NetworkMonitor()
+    coalescer = RequestCoalescer(monitor)
+    release = threading.Event()
+    fetch_calls = []
+
+    def leader_fetch(on_chunk):
+        fetch_calls.append('leader')
+        on_chunk('Hello')
+        release.wait(5)
+        on_chunk(' world')
+        return success('Hello world')
+
+    def follower_fetch(on_chunk):
+        fetch_calls.append('follower')
+        return success('unexpected')
+
+    leader_chunks = []
+    leader_outcome = []
+    leader = threading.Thread(target=lambda: leader_outcome.append(
+        coalescer.run('key', leader_fetch, stream=True, on_chunk=leader_chunks.append)))
+    leader.start()
+    wait_for(lambda: fetch_calls)
+
+    outcomes = []
+    follower_chunks = [[], []]
+    followers = [start_follower(coalescer, 'key', follower_fetch, outcomes, chunks) for chunks in follower_chunks]
+    wait_for(lambda: monitor.request_stats['coalesced_requests'] == 2)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+
+    assert fetch_calls == ['leader']
+    assert leader_chunks == ['Hello', ' world']
+    assert 'coalesced' not in leader_outcome[0]
+    for chunks in follower_chunks:
+        assert chunks == ['Hello', ' world']
+    for outcome in outcomes:
+        assert outcome['coalesced'] is True
+        assert outcome['response']['choices'][0]['message']['content'] == 'Hello world'
+    assert coalescer.get_stats()['in_flight'] == 0
+
+
+def test_non_streamed_result_is_delivered_as_one_chunk():
+    coalescer = RequestCoalescer(NetworkMonitor())
+    release = threading.Event()
+    started = threading.Event()
+
+    def leader_fetch(on_chunk):
+        started.set()
+        release.wait(5)
+        return success('full answer')
+
+    leader = threading.Thread(target=lambda: coalescer.run('key', leader_fetch))
+    leader.start()
+    started.wait(5)
+    outcomes = []
+    chunks = []
+    follower = start_follower(coalescer, 'key', lambda on_chunk: success('unexpected'), outcomes, chunks)
+    wait_for(lambda: coalescer.monitor.request_stats['coalesced_requests'] == 1)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert chunks == ['full answer']
+    assert outcomes[0]['coalesced'] is True
+
+
+def test_follower_retries_itself_when_leader_fails_before_streaming():
+    coalescer = RequestCoalescer(NetworkMonitor())
+    release = threading.Event()
+    started = threading.Event()
+
+    def leader_fetch(on_chunk):
+        started.set()
+        release.wait(5)
+        return {'error': 'Invalid API key'}
+
+    follower_calls = []
+
+    def follower_fetch(on_chunk):
+        follower_calls.append(True)
+        on_chunk('own answer')
+        return success('own answer')
+
+    leader_outcome = []
+    leader = threading.Thread(target=lambda: leader_outcome.append(coalescer.run('key', leader_fetch)))
+    leader.start()
+    started.wait(5)
+    outcomes = []
+    chunks = []
+    follower = start_follower(coalescer, 'key', follower_fetch, outcomes, chunks)
+    wait_for(lambda: coalescer.monitor.request_stats['coalesced_requests'] == 1)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert leader_outcome == [{'error': 'Invalid API key'}]
+    assert follower_calls == [True]
+    assert chunks == ['own answer']
+    assert 'coalesced' not in outcomes[0]
+
+
+def test_follower_gets_error_when_leader_fails_mid_stream():
+    coalescer = RequestCoalescer(NetworkMonitor())
+    release = threading.Event()
+    started = threading.Event()
+
+    def leader_fetch(on_chunk):
+        on_chunk('partial')
+        started.set()
+        release.wait(5)
+        return {'error': 'Stream interrupted'}
+
+    follower_calls = []
+    leader = threading.Thread(target=lambda: coalescer.run('key', leader_fetch, stream=True))
+    leader.start()
+    started.wait(5)
+    outcomes = []
+    chunks = []
+    follower = start_follower(coalescer, 'key', lambda on_chunk: follower_calls.append(True), outcomes, chunks)
+    wait_for(lambda: chunks)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert chunks == ['partial']
+    assert outcomes == [{'error': 'Stream interrupted'}]
+    assert follower_calls == []
+
+
+def test_leader_exception_releases_the_flight():
+    coalescer = RequestCoalescer(NetworkMonitor())
+    release = threading.Event()
+    started = threading.Event()
+
+    def leader_fetch(on_chunk):
+        started.set()
+        release.wait(5)
+        raise RuntimeError('boom')
+
+    leader_errors = []
+
+    def lead():
+        try:
+            coalescer.run('key', leader_fetch)
+        except RuntimeError as e:
+            leader_errors.append(e)
+
+    leader = threading.Thread(target=lead)
+    leader.start()
+    started.wait(5)
+    outcomes = []
+    follower = start_follower(coalescer, 'key', lambda on_chunk: success('own answer'), outcomes, [])
+    wait_for(lambda: coalescer.monitor.request_stats['coalesced_requests'] == 1)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert len(leader_errors) == 1
+    assert outcomes[0]['response']['choices'][0]['message']['content'] == 'own answer'
+    assert coalescer.get_stats()['in_flight'] == 0
@@ -0,0 +1,70 @@
+"""
+测试确定性请求的响应缓存
+"""
+import time
+
+import chat
+from chat import ResponseCache
+
+MESSAGES = [{'role': 'system', 'content': 'Be brief.'}, {'role': 'user', 'content': 'What is  2+2?'}]
+
+
+def test_only_temperature_zero_is_cached():
+    cache = ResponseCache(enabled=True)
+    assert cache.make_key(MESSAGES, 'grok', 0.7) is None
+    assert cache.make_key(MESSAGES, 'grok', 0) is not None
+
+
+def test_key_normalizes_whitespace_and_scopes_by_owner():
+    cache = ResponseCache(enabled=True)
+    spaced = [dict(msg, content=f"  {msg['content']}\n") for msg in MESSAGES]
+    assert cache.make_key(MESSAGES, 'grok', 0, owner='a') == cache.make_key(spaced, 'grok', 0, owner='a')
+    assert cache.make_key(MESSAGES, 'grok', 0, owner='a') != cache.make_key(MESSAGES, 'grok', 0, owner='b')
+    assert cache.make_key(MESSAGES, 'grok', 0) != cache.make_key(MESSAGES, 'grok-mini', 0)
+    assert cache.make_key(MESSAGES, 'grok', 0) != cache.make_key(MESSAGES, 'grok', 0, {'mode': 'auto'})
+
+
+def test_lru_eviction_and_stats():
+    cache = ResponseCache(enabled=True, max_entries=2)
+    cache.put('a', {'n': 1})
+    cache.put('b', {'n': 2})
+    assert cache.get('a') == {'n': 1}  # 'b' is now least recently used
+    cache.put('c', {'n': 3})
+    assert cache.get('b') is None
+    assert cache.get('c') == {'n': 3}
+    stats = cache.get_stats()
+    assert (stats['hits'], stats['misses'], stats['evictions'], stats['entries']) == (2, 1, 1, 2)
+    assert stats['bytes_saved'] > 0
+
+
+def test_live_search_entries_expire_sooner():
+    cache = ResponseCache(enabled=True, ttl=60, live_search_ttl=0.02)
+    cache.put('plain', {'n': 1})
+    cache.put('live', {'n': 2}, live_search=True)
+    time.sleep(0.03)
+    assert cache.get('live') is None
+    assert cache.get('plain') == {'n': 1}
+    assert cache.get_stats()['expirations'] == 1
+
+
+def test_disabled_cache_stores_nothing():
+    cache = ResponseCache(enabled=False)
+    cache.put('a', {'n': 1})
+    assert cache.get('a') is None
+    assert cache.get_stats()['entries'] == 0
+
+
+def test_repeated_prompt_is_served_from_cache(mock_xai, monkeypatch):
+    monkeypatch.setattr(chat, 'response_cache', ResponseCache(enabled=True))
+    monkeypatch.setenv('TEMPERATURE', '0')
+    messages = [{'role': 'user', 'content': 'cached question'}]
+
+    first = chat.send_message(messages, 'key-a')
+    second = chat.send_message(messages, 'key-a')
+    assert mock_xai.get_stats()['requests'] == 1
+    assert second.get('cached') is True
+    assert second['response'] == first['response']
+
+    # Another key pays for its own completion
+    chat.send_message(messages, 'key-b')
+    assert mock_xai.get_stats()['requests'] == 2